@@ -3,11 +3,105 @@
 #   (2) Build a long dataframe: labgroupid × trigger_var × affected_var × original_value_clean
 #   (3) Append new cases (status "Unchecked") to the specified Excel sheet
 #   (4) Pull back cleaned values where value_changed == "Y" into *_clean columns
+# The sheet is read from the workbook's snapshot (workbook_snapshot.py) unless the workbook was edited
+# Values are matched to observations by id_cols with merges and an index lookup (no per-case scan of
+# the dataset), see benchmark_cleaning.py for a comparison with the row-by-row version
 
+import numpy as np
 import pandas as pd
-from openpyxl import load_workbook
 import os
 
+import workbook_snapshot
+from pipeline_profiling import profiled
+from workbook_writer import append_frame
+
+# Helper for Step 4: current value of the affected variable of each case (NA if not in df). The
+# *_clean column is preferred when present so reviews/editing always target cleaned values. The
+# needed columns of the rows with cases are melted to long form once and matched on id_cols.
+def _original_values(df, df_aff, id_cols, case_rows):
+    value_cols = {}
+    for var in df_aff["affected_var"].dropna().unique():
+        col = f"{var}_clean" if f"{var}_clean" in df.columns else var
+        if col in df.columns:
+            value_cols[var] = col
+
+    if not value_cols:
+        return pd.Series(pd.NA, index=df_aff.index, dtype=object)
+
+    # One block per value column (values as objects, so that columns of different dtypes
+    # keep their values when stacked)
+    rows = df.loc[case_rows]
+    long = pd.concat(
+        [rows[id_cols].assign(value_col=col, original_value=rows[col].astype(object))
+         for col in dict.fromkeys(value_cols.values())],
+        ignore_index=True,
+    )
+
+    cases = df_aff[id_cols].assign(value_col=df_aff["affected_var"].map(value_cols))
+    matched = cases.merge(long, on=id_cols + ["value_col"], how="left")
+    return pd.Series(matched["original_value"].to_numpy(dtype=object), index=df_aff.index)
+
+
+# Helper for Step 8: dtype a typed column needs to take values (typed with infer_objects), upcast as when
+# values are set one by one: numbers widen numeric columns, missing values fit all but integer and boolean
+# columns (integers become floats), anything else that does not fit makes the column object
+def _pull_back_dtype(dtype, values):
+    present = values[values.notna()]
+    if pd.api.types.is_string_dtype(dtype):
+        return dtype if all(isinstance(v, str) for v in present) else object
+    if isinstance(dtype, np.dtype) and dtype.kind in "iuf":
+        if present.empty:
+            return dtype if dtype.kind == "f" or not len(values) else np.dtype("float64")
+        if values.dtype.kind in "iuf":
+            return np.result_type(dtype, values.dtype)
+        return object
+    return dtype if values.dtype == dtype else object
+
+
+# Helper for Step 8: write the cleaned_value of each changed case into the *_clean column of the
+# observation with the case's ids (later cases win). Observations are found with one indexed lookup.
+def _pull_back(df, changed, id_cols):
+    clean_cols = [f"{v}_clean" for v in changed["affected_var"]]
+
+    # Missing *_clean columns start as a copy of the raw variable (or missing), in order of first use
+    for var, clean_col in dict(zip(changed["affected_var"], clean_cols)).items():
+        if clean_col not in df.columns:
+            df[clean_col] = df[var] if var in df.columns else pd.NA
+
+    if changed.empty:
+        return df
+
+    index = pd.MultiIndex.from_frame(df[id_cols])
+    positions = index.get_indexer(pd.MultiIndex.from_frame(changed[id_cols]))
+
+    updates = pd.DataFrame({
+        "clean_col": clean_cols,
+        "position": positions,
+        # Kept as object: a plain object array of strings would be inferred as str, turning None into NaN
+        "cleaned_value": pd.Series(changed["cleaned_value"].to_numpy(dtype=object), dtype=object),
+    })
+    updates = updates[updates["position"] >= 0].drop_duplicates(["clean_col", "position"], keep="last")
+    for clean_col, group in updates.groupby("clean_col", sort=False):
+        col = df.columns.get_loc(clean_col)
+        values = group["cleaned_value"]
+        dtype = df.dtypes.iloc[col]
+        if dtype != object:
+            # Typed column: values as one typed array (missing as NaN; strings for string columns), the column
+            # upcast first if they do not fit
+            values = values.where(values.notna(), np.nan)
+            if not pd.api.types.is_string_dtype(dtype):
+                values = values.infer_objects()
+            target = _pull_back_dtype(dtype, values)
+            if target != dtype:
+                df[clean_col] = df[clean_col].astype(target)
+                if target == object:
+                    values = group["cleaned_value"]
+        df.iloc[group["position"].to_numpy(), col] = values.to_numpy()
+
+    return df
+
+
+@profiled
 def clean_affected_vars(df, file_name, sheet_name, data_dict=None, id_cols=None):
     """
     Export affected-variable cases to an Excel review sheet and pull back
@@ -113,23 +207,7 @@ def clean_affected_vars(df, file_name, sheet_name, data_dict=None, id_cols=None)
         df_aff = df_aff.drop(columns=["Variable", "No variables"], errors="ignore")
 
     # Step 4: Attach the current cleaned value of each affected variable if exists
-    def _extract_original_value(row):
-        var = row["affected_var"]
-        clean_var = f"{var}_clean"
-
-        # Prefer the *_clean column when present so reviews/editing always target cleaned values.
-        value_col = clean_var if clean_var in df.columns else var
-        if value_col not in df.columns:
-            return pd.NA
-        mask = pd.Series(True, index=df.index)
-        for c in id_cols:
-            mask &= df[c] == row[c]
-        matches = df.loc[mask, value_col]
-        if matches.empty:
-            return pd.NA
-        return matches.iloc[0]
-
-    df_aff["original_value"] = df_aff.apply(_extract_original_value, axis=1)
+    df_aff["original_value"] = _original_values(df, df_aff, id_cols, df[aff_var_cols].notna().any(axis=1))
 
     # Step 5: Build new-cases frame with standard columns
     new_cases = df_aff[id_cols + ["trigger_var", "affected_var", "original_value"]].copy()
@@ -140,12 +218,10 @@ def clean_affected_vars(df, file_name, sheet_name, data_dict=None, id_cols=None)
     # Step 6: Load existing sheet from workbook
     if not os.path.exists(file_name):
         raise FileNotFoundError(f"Workbook not found: {file_name}. Run create_empty_aff_vars_sheet first.")
-    wb = load_workbook(file_name)
-    if sheet_name not in wb.sheetnames:
+    # (from the workbook's snapshot if it has not been edited since)
+    rows = workbook_snapshot.sheet_rows(file_name, sheet_name)
+    if rows is None:
         raise ValueError(f"Sheet '{sheet_name}' not found. Run create_empty_aff_vars_sheet first.")
-    ws = wb[sheet_name]
-
-    rows = list(ws.values)
     if rows:
         sheet_cols = list(rows[0])
     else:
@@ -182,37 +258,19 @@ def clean_affected_vars(df, file_name, sheet_name, data_dict=None, id_cols=None)
             if c not in rows_to_write.columns:
                 rows_to_write[c] = ""
         rows_to_write = rows_to_write[col_order]
-        rows_to_write = rows_to_write.where(rows_to_write.notna(), None)
-
-        next_row = ws.max_row + 1
-        for _, row in rows_to_write.iterrows():
-            for col_idx, val in enumerate(row, start=1):
-                ws.cell(row=next_row, column=col_idx, value=val)
-            next_row += 1
-        wb.save(file_name)
+
+        # One block below the last row (missing values as empty cells)
+        append_frame(file_name, sheet_name, rows_to_write)
         print(f"Appended {len(to_append)} new affected variable case(s) to '{sheet_name}'.")
     else:
         print("No new affected variable cases found.")
-    wb.close()
 
     # Step 8: Pull back cleaned values only if value_changed == "Y"
     if not existing.empty and "value_changed" in existing.columns:
         changed = existing[
             existing["value_changed"].astype(str).str.strip().str.upper() == "Y"
         ]
-        for _, row in changed.iterrows():
-            clean_col = f"{row['affected_var']}_clean"
-            if clean_col not in df.columns:
-                src_col = row["affected_var"]
-                if src_col in df.columns:
-                    df[clean_col] = df[src_col]
-                else:
-                    df[clean_col] = pd.NA
-
-            mask = pd.Series(True, index=df.index)
-            for c in id_cols:
-                mask &= df[c] == row[c]
-            df.loc[mask, clean_col] = row["cleaned_value"]
+        df = _pull_back(df, changed, id_cols)
     
     # Step 9: Print report of number of changed values
     num_changed = existing[
@@ -220,4 +278,4 @@ def clean_affected_vars(df, file_name, sheet_name, data_dict=None, id_cols=None)
     ].shape[0]
     print(f"Pulled back cleaned values for {num_changed} affected variable case(s) where value_changed == 'Y'.")
 
-    return df
\ No newline at end of file
+    return df
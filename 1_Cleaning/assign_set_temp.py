@@ -11,4 +11,57 @@ def assign_set_temp(temp, setpoints):
         return np.nan
 
     temp_value = float(temp)
-    return min(valid_setpoints, key=lambda sp: abs(temp_value - float(sp)))
\ No newline at end of file
+    return min(valid_setpoints, key=lambda sp: abs(temp_value - float(sp)))
+
+
+# Helper: closest setpoint to each value of a float array (NaN stays NaN), with np.searchsorted on the
+# sorted setpoints. On a tie the setpoint listed first wins, as with min(..., key=abs) above (repeated
+# setpoints are dropped first, keeping the first occurrence, so each tie compares where they are first listed)
+def _snap(values, setpoints):
+    setpoints = pd.unique(np.array([float(sp) for sp in setpoints if not pd.isna(sp)], dtype=float))
+    if setpoints.size == 0:
+        return np.full(values.shape, np.nan)
+
+    order = np.argsort(setpoints, kind="stable")
+    sorted_setpoints = setpoints[order]
+
+    # Neighbouring setpoints below and above each value
+    pos = np.searchsorted(sorted_setpoints, values)
+    below = np.clip(pos - 1, 0, len(sorted_setpoints) - 1)
+    above = np.clip(pos, 0, len(sorted_setpoints) - 1)
+    dist_below = np.abs(values - sorted_setpoints[below])
+    dist_above = np.abs(values - sorted_setpoints[above])
+    take_above = (dist_above < dist_below) | ((dist_above == dist_below) & (order[above] < order[below]))
+
+    snapped = sorted_setpoints[np.where(take_above, above, below)]
+    snapped[np.isnan(values)] = np.nan
+    return snapped
+
+
+# Helper: temperatures as a float Series (numeric strings are converted, missing values become NaN)
+def _temps_to_float(temps):
+    temps = temps if isinstance(temps, pd.Series) else pd.Series(temps)
+    return pd.to_numeric(temps, errors="raise").astype("float64")
+
+
+# Assign every temperature of a column to the closest setpoint in one vectorized pass
+# (same result as temps.apply(lambda t: assign_set_temp(t, setpoints)), as floats).
+def assign_set_temps(temps, setpoints):
+    temps = _temps_to_float(temps)
+    return pd.Series(_snap(temps.to_numpy(), setpoints), index=temps.index, name=temps.name)
+
+
+# Assign every temperature to the closest setpoint of its group (e.g. equipment type), with a
+# table of setpoints per group, e.g. {"ult": [-70, -75, -80], "bath": [37, 65, 90]}.
+# Temperatures of groups without setpoints are kept as they are.
+def assign_set_temps_by_group(temps, groups, setpoints_by_group):
+    temps = _temps_to_float(temps)
+    groups = np.asarray(groups, dtype=object)
+    values = temps.to_numpy()
+
+    snapped = values.copy()
+    for group, setpoints in setpoints_by_group.items():
+        in_group = groups == group
+        if in_group.any():
+            snapped[in_group] = _snap(values[in_group], setpoints)
+    return pd.Series(snapped, index=temps.index, name=temps.name)
@@ -0,0 +1,694 @@
+# Benchmark of the cleaning helpers on a synthetic panel:
+#   (1) Build a synthetic panel (labgroupid × equipment × type_no × survey) with *_clean, *_status
+#       and *_aff_vars columns and the review sheets that go with it
+#   (2) Time the current implementation of each step against the row-by-row implementation it
+#       replaced (kept below as the legacy reference) and check that both give identical results
+#   (3) Time appending a block of rows to review sheets of growing size (openpyxl load, cells written one
+#       by one and save vs workbook_writer.append_frame, which also extends the workbook's snapshot) and
+#       check that the snapshot gives the rows of the saved workbook. Both load and save the whole workbook,
+#       so these times are reported apart from the speed-ups
+#   (4) Time the annual energy use formulas of 2_5 on a synthetic equipment panel (the notebook's
+#       full-frame cells vs energy_formulas.compute_energy_use), and a batch of counterfactual scenarios
+#       (a copy of the panel and a recomputation per scenario vs energy_scenarios.evaluate_scenarios)
+#   (5) Time the calculator merge of 2_4 (the notebook's cells, which prepare the calculator table and
+#       merge piece by piece, vs calculator_index.merge_calculator on a prebuilt index)
+#
+# Usage (from the cleaning folder):
+#   python benchmark_cleaning.py                 # 50,000 rows
+#   python benchmark_cleaning.py --rows 200000 --repeat 3 --legacy-items 1000
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+import workbook_snapshot
+from affected_vars_cleaning import _original_values, _pull_back
+from calculator_index import MERGE_COLS, build_calculator_index, merge_calculator, prepare_calculator_table
+from energy_formulas import HOURS_PER_YEAR, compute_energy_use
+from energy_scenarios import evaluate_scenarios
+from split_types_cleaning import _replace_with_splits, _row_keys
+from workbook_writer import append_frame, write_sheets
+
+ID_COLS = ["labgroupid", "equipment", "type_no", "survey"]
+
+
+# ---------------------------
+# Synthetic data
+# ---------------------------
+
+def make_panel(n_rows=50_000, n_vars=20, seed=0):
+    """Synthetic panel with unique ids, string and numeric *_clean columns and *_aff_vars columns."""
+    rng = np.random.default_rng(seed)
+    equipment = np.array(["fridge", "freezer", "fume_hood", "incubator", "autoclave"])
+    per_lab = len(equipment) * 3 * 2
+    n_labs = -(-n_rows // per_lab)
+
+    ids = pd.MultiIndex.from_product(
+        [[f"L{i:05d}" for i in range(n_labs)], equipment, [1, 2, 3], ["BL", "EL"]], names=ID_COLS
+    ).to_frame(index=False).iloc[:n_rows]
+    df = ids.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+    var_names = [f"var{i}" for i in range(n_vars)]
+    for i, var in enumerate(var_names):
+        if i % 4 == 3:
+            # Numeric variable without a *_clean column (raw value is pulled)
+            df[var] = rng.choice([1.0, 2.5, 4.0, np.nan], n_rows)
+        else:
+            df[var] = rng.choice(np.array(["a", "b", "None", None], dtype=object), n_rows)
+            df[f"{var}_clean"] = df[var].str.upper()
+            if i % 4 == 1:
+                df[var] = df[var].astype("string")  # as after clean_unique_values
+            df[f"{var}_status"] = rng.choice(["Cleaned", "Pending", "Split"], n_rows, p=[0.9, 0.098, 0.002])
+
+    # ~5% of the rows of a few trigger variables affect one to three other variables
+    names = np.array(var_names + ["not_in_data"])
+    for var in var_names[:n_vars // 2]:
+        aff = np.full(n_rows, None, dtype=object)
+        rows = np.flatnonzero(rng.random(n_rows) < 0.05)
+        aff[rows] = [", ".join(rng.choice(names, rng.integers(1, 4), replace=False)) for _ in rows]
+        df[f"{var}_aff_vars"] = aff
+    return df
+
+
+def make_cases(df):
+    """The long cases frame of clean_affected_vars (Steps 1-2)."""
+    parts = []
+    for col in [c for c in df.columns if c.endswith("_aff_vars")]:
+        subset = df.loc[df[col].notna(), ID_COLS + [col]].rename(columns={col: "aff_vars"})
+        parts.append(subset.assign(trigger_var=col.replace("_aff_vars", "")))
+    cases = pd.concat(parts, ignore_index=True)
+    cases["affected_var"] = cases["aff_vars"].str.split(",")
+    cases = cases.explode("affected_var").reset_index(drop=True)
+    cases["affected_var"] = cases["affected_var"].str.strip()
+    return cases.drop(columns="aff_vars")
+
+
+def make_changed(df, cases, seed=0):
+    """Review rows with value_changed == "Y": half of the cases, some repeated, some of unknown labs."""
+    rng = np.random.default_rng(seed)
+    changed = cases.sample(frac=0.5, random_state=seed)
+    changed = pd.concat([changed, changed.head(len(changed) // 20)], ignore_index=True)
+    changed.loc[changed.sample(frac=0.01, random_state=seed).index, "labgroupid"] = "unknown"
+    # Numeric variables (no *_clean column) get numeric values
+    values = rng.choice(np.array(["fixed", "also fixed", None], dtype=object), len(changed))
+    numeric = changed["affected_var"].isin(df.columns[df.dtypes == float]).to_numpy()
+    values[numeric] = rng.choice(np.array([0.5, 3, None], dtype=object), numeric.sum())
+    changed["cleaned_value"] = values
+    # Rows as they are read from the review sheet
+    rows = [tuple(r) for r in changed.itertuples(index=False)]
+    return pd.DataFrame(rows, columns=list(changed.columns))
+
+
+def make_split_rows(df, seed=0):
+    """Rows with a "Split" status and the split rows a reviewer made of them (as read from the sheet)."""
+    rng = np.random.default_rng(seed)
+    status_cols = [c for c in df.columns if c.endswith("_status")]
+    candidates = df.loc[df[status_cols].eq("Split").any(axis=1)].copy()
+    candidates["original_key"] = _row_keys(candidates, ID_COLS)
+
+    # Two or three split rows for 80% of the originals: new type_no (or none, to be numbered),
+    # some edited clean values
+    originals = candidates.sample(frac=0.8, random_state=seed)
+    split_rows = originals.loc[originals.index.repeat(rng.integers(2, 4, len(originals)))].copy()
+    split_rows["type_no"] = np.arange(len(split_rows)) + 100.0
+    split_rows.loc[split_rows.sample(frac=0.3, random_state=seed).index, "type_no"] = np.nan
+    split_rows["type_no"] = split_rows["type_no"].fillna(
+        split_rows.groupby(["labgroupid", "equipment", "survey"]).cumcount() + 10.0
+    )
+    clean_cols = [c for c in df.columns if c.endswith("_clean")]
+    for col in clean_cols[:3]:
+        values = split_rows[col].to_numpy(dtype=object)
+        values[rng.random(len(values)) < 0.5] = None
+        split_rows[col] = values
+    split_rows.insert(0, "split_type", "Split")
+    return candidates, split_rows[["split_type", "original_key"] + ID_COLS + clean_cols].reset_index(drop=True)
+
+
+def make_energy_panel(n_rows=100_000, seed=0):
+    """Synthetic equipment panel merged with calculator values and penalties, as read in 2_5."""
+    rng = np.random.default_rng(seed)
+    equipment = rng.choice(
+        ["fridge", "freezer", "ult", "incubator", "bath", "heater", "it", "cryostat", "glassware",
+         "microbio", "fc", "other"], n_rows
+    )
+    df = pd.DataFrame({
+        "labgroupid": [f"L{i:05d}" for i in rng.integers(0, max(n_rows // 50, 1), n_rows)],
+        "equipment": equipment,
+        "number": rng.integers(1, 4, n_rows),
+    })
+
+    def penalty(low=1.0, high=1.5, missing=0.0):
+        values = rng.uniform(low, high, n_rows)
+        values[rng.random(n_rows) < missing] = np.nan
+        return values
+
+    df["electricity_use_kwh_per_hour"] = penalty(0.01, 2.0)
+    df["hours"] = rng.choice([0, 2, 8, 9, 24], n_rows).astype(float)
+    df["days"] = rng.choice([0, 100, 255, 365], n_rows).astype(float)
+    df["door_openings"] = rng.choice([0, 1, 5, 10], n_rows).astype(float)
+    df["door_opening_penalty_xbl_xminutes_open"] = penalty(0.0, 0.1)
+    df["no_drawers_penalty_xblx_minutes_open"] = penalty()
+    df["size_freezer_1"] = rng.choice(["Upright", "Chest", "Under Bench"], n_rows)
+    df["drawers"] = rng.choice(["No there are no drawers or most are missing", "Plastic", "Wire"], n_rows)
+    df["icing"] = rng.choice(["Yes, iced up", "No, clear of ice"], n_rows)
+    df["ice_penalty_xbl"] = penalty()
+    df["refrigerant"] = rng.choice(np.array(["HFCs", "Hydrocarbons", None], dtype=object), n_rows)
+    df["hfc_not_hc_coolant_penalty_xbl"] = penalty()
+    for col in ["damaged_seals_penalty", "no_spacing_penalty", "clogged_filter_penalty", "lid_off_penalty",
+                "beads_penalty", "fan_penalty", "ducting_penalty"]:
+        df[col] = rng.choice([0.0, 1.0, np.nan], n_rows, p=[0.45, 0.45, 0.1])
+    for col in ["damaged_seals_penalty_xbl", "no_spacing_penalty_xbl", "clogged_filters_penalty_xbl",
+                "no_spacing_and_clogged_filters_penalty_xbl", "damaged_seals_and_clogged_filters_penalty",
+                "damaged_seals_and_no_spacing_penalty_xbl",
+                "no_spacing_and_clogged_filters_and_damaged_seal_penalty_xbl", "ducted_electricity_penalty_xbl"]:
+        df[col] = penalty()
+    for col in ["lid_off_penalty_xbl", "beads_not_water_penalty_xbl", "fan_penalty_xbl"]:
+        df[col] = penalty(missing=0.2)
+    df["sleep_mode"] = rng.choice(["No Energy Saving Mode Available", "Energy Saving Mode Available", "Other"],
+                                  n_rows, p=[0.45, 0.45, 0.1])
+    df["standby_penalty"] = penalty(0.3, 0.6)
+    df["ducted_gas_penalty_additional_kwh_per_hour"] = penalty(0.1, 1.0, missing=0.1)
+    df["sash_width"] = rng.choice([1.2, 1.5, 1.8], n_rows)
+    df["face_velocity_m/s"] = rng.choice([0.2, 0.3, 0.5], n_rows)
+    df["controller_type"] = rng.choice(["CAV", "VAV", "Other"], n_rows, p=[0.45, 0.45, 0.1])
+    df["surface"] = rng.choice([0.0, 0.25, 0.5], n_rows)
+    df["lifted"] = rng.choice(["Yes", "No"], n_rows)
+    df["hours_open"] = rng.choice([1.0, 4.0, 8.0], n_rows)
+    return df
+
+
+# Counterfactual scenarios of the energy benchmark (scenario name -> overrides)
+ENERGY_SCENARIOS = {
+    "baseline": {},
+    "clean ULT filters": {"clogged_filter_penalty": {"ult": 0}},
+    "intact ULT seals": {"damaged_seals_penalty": {"ult": 0}},
+    "bath lids on": {"lid_off_penalty": {"bath": 0}},
+    "baths 4h/day": {"hours": {"bath": 4.0}},
+    "no freezer icing": {"icing": {"freezer": "No, clear of ice"}},
+    "cryostat standby": {"sleep_mode": {"cryostat": "Energy Saving Mode Available"}},
+    "all FCs VAV": {"controller_type": {"fc": "VAV"}},
+    "FC sashes 4h/day": {"hours_open": {"fc": 4.0}},
+    "IT off at weekends": {"days": {"it": 255.0}},
+}
+
+
+def make_calculator_data(n_rows=100_000, seed=0):
+    """
+    Synthetic calculator table (as read from equipment_calculations.csv), equipment panel (as read in
+    2_4, incl. IT and FC rows) and merge overrides (for keys missing from the calculator).
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for equipment, types, setpoints in [("ult_freezer", ["Upright", "Chest"], [-70.0, -80.0]),
+                                        ("water_bath", ["Shaking", "Standard"], [37.0, 65.0]),
+                                        ("heat_block", ["Dry"], [37.0, 95.0])]:
+        for type_, size, age, set_temp in np.array(np.meshgrid(
+            types, ["Small", "Large", ""], ["<10yrs", ">10yrs"], setpoints), dtype=object
+        ).reshape(4, -1).T:
+            rows.append({"Equipment_Type": equipment, "Type": type_, "Size": size or None, "Age": age,
+                         "N_Blocks": 2.0 if equipment == "heat_block" else np.nan, "Set_Temp": set_temp})
+    rows += [{"Equipment_Type": "it_equipment", "Type": type_} for type_ in ["Desktop", "Laptop"]]
+    rows += [{"Equipment_Type": "it_equipment", "Type": "Computer Screen", "Size": size, "Brightness": brightness}
+             for size in ["21in", "27in"] for brightness in ["High", "Low"]]
+    calculations = pd.DataFrame(rows, columns=["Equipment_Type", "Type", "Work_Surface_Width", "Size", "N_Blocks",
+                                               "Age", "Set_Temp", "Brightness"])
+    calculations["Electricity_Use_kWh_per_Hour"] = rng.uniform(0.01, 1.0, len(calculations))
+
+    # Panel: calculator combinations, IT, FCs and a few combinations only known through the overrides
+    non_it = prepare_calculator_table(calculations).query("equipment != 'it'")
+    n_it, n_fc, n_override = n_rows // 10, n_rows // 20, n_rows // 100
+    equipment = non_it[MERGE_COLS].sample(n_rows - n_it - n_fc - n_override, replace=True, random_state=seed)
+    it = pd.DataFrame({
+        "equipment": "it",
+        "type": rng.choice(["Desktop", "Laptop", "Screen only"], n_it),
+        "size": rng.choice(["21in", "27in", "No monitor"], n_it),
+        "monitor_brightness": rng.choice(["High", "Low"], n_it),
+    })
+    override = non_it[MERGE_COLS].sample(n_override, replace=True, random_state=seed + 1)
+    new_age = rng.random(n_override) < 0.5
+    override["age"] = override["age"].where(~new_age, "new")
+    override["width"] = np.where(new_age, np.nan, 1.5)
+    equipment = pd.concat([equipment, it, pd.DataFrame({"equipment": ["fc"] * n_fc}), override])
+    equipment = equipment.sample(frac=1, random_state=seed).reset_index(drop=True)
+    for col in ["equipment", "type", "size", "age", "monitor_brightness"]:
+        equipment[col] = equipment[col].astype(object).where(equipment[col].notna(), None)
+    equipment["labgroupid"] = [f"L{i:05d}" for i in rng.integers(0, max(n_rows // 50, 1), n_rows)]
+
+    merge_overrides = override[MERGE_COLS].drop_duplicates()
+    new_age = (merge_overrides["age"] == "new").to_numpy()
+    merge_overrides["match_strategy"] = np.where(new_age, "override_age", "ignore_width")
+    merge_overrides["override_age"] = np.where(new_age, "<10yrs", None)
+    return calculations, equipment, merge_overrides.reset_index(drop=True)
+
+
+# ---------------------------
+# Legacy reference (row by row)
+# ---------------------------
+
+def legacy_original_values(df, df_aff, id_cols):
+    def _extract_original_value(row):
+        var = row["affected_var"]
+        clean_var = f"{var}_clean"
+        value_col = clean_var if clean_var in df.columns else var
+        if value_col not in df.columns:
+            return pd.NA
+        mask = pd.Series(True, index=df.index)
+        for c in id_cols:
+            mask &= df[c] == row[c]
+        matches = df.loc[mask, value_col]
+        if matches.empty:
+            return pd.NA
+        return matches.iloc[0]
+
+    return df_aff.apply(_extract_original_value, axis=1)
+
+
+def legacy_pull_back(df, changed, id_cols):
+    for _, row in changed.iterrows():
+        clean_col = f"{row['affected_var']}_clean"
+        if clean_col not in df.columns:
+            src_col = row["affected_var"]
+            if src_col in df.columns:
+                df[clean_col] = df[src_col]
+            else:
+                df[clean_col] = pd.NA
+
+        mask = pd.Series(True, index=df.index)
+        for c in id_cols:
+            mask &= df[c] == row[c]
+        df.loc[mask, clean_col] = row["cleaned_value"]
+    return df
+
+
+def legacy_row_keys(frame, id_cols, sep="||"):
+    def _row_key(row, id_cols, sep="||"):
+        parts = [str(row[c]).strip() for c in id_cols]
+        return sep.join(parts)
+
+    return frame.apply(lambda r: _row_key(r, id_cols, sep), axis=1)
+
+
+def legacy_replace_with_splits(out, candidates, valid_split_rows, id_cols, clean_cols):
+    base_lookup = candidates.set_index("original_key", drop=False)
+    new_rows = []
+    for _, split_row in valid_split_rows.iterrows():
+        base = base_lookup.loc[split_row["original_key"]].copy()
+        for col in id_cols + clean_cols:
+            if col in split_row.index and pd.notna(split_row[col]):
+                base[col] = split_row[col]
+        base["ind_split_type"] = 1
+        new_rows.append(base)
+
+    new_rows_df = pd.DataFrame(new_rows)
+    keys_to_replace = set(valid_split_rows["original_key"].tolist())
+    out_keys = legacy_row_keys(out, id_cols)
+    out_remaining = out.loc[~out_keys.isin(keys_to_replace)].copy()
+    if "ind_split_type" not in out_remaining.columns:
+        out_remaining["ind_split_type"] = 0
+    else:
+        out_remaining["ind_split_type"] = out_remaining["ind_split_type"].fillna(0).astype(int)
+
+    for c in out.columns:
+        if c not in new_rows_df.columns:
+            new_rows_df[c] = pd.NA
+
+    combined = pd.concat([out_remaining, new_rows_df[out.columns.tolist() + [c for c in new_rows_df.columns if c not in out.columns]]], ignore_index=True)
+    return combined, new_rows_df, keys_to_replace
+
+
+def legacy_append(file_name, sheet_name, frame):
+    """Append rows cell by cell below the last row (load and save the whole workbook)."""
+    wb = load_workbook(file_name)
+    ws = wb[sheet_name]
+    start_row = ws.max_row + 1
+    for i, row in enumerate(frame.itertuples(index=False), start=start_row):
+        for j, value in enumerate(row, start=1):
+            ws.cell(row=i, column=j, value=None if pd.isna(value) else value)
+    wb.save(file_name)
+    wb.close()
+
+
+def legacy_energy_use(equipment, elec_per_m3, gas_per_m3):
+    """Annual energy use as the cells of 2_5 computed it (full-frame penalty arrays, masked per type)."""
+    equipment = equipment.copy()
+    equipment["electricity_use_kwh_year"] = np.nan
+    equipment["gas_use_kwh_year"] = np.nan
+
+    mask = equipment["equipment"] == "fridge"
+    door_term = equipment["door_openings"] * equipment["door_opening_penalty_xbl_xminutes_open"]
+    equipment.loc[mask, "electricity_use_kwh_year"] = (
+        365 * 24 * equipment.loc[mask, "electricity_use_kwh_per_hour"] * (1 + door_term[mask])
+    )
+
+    mask = equipment["equipment"] == "freezer"
+    no_drawers_applies = (
+        (equipment["size_freezer_1"] == "Upright") &
+        (equipment["drawers"] == "No there are no drawers or most are missing")
+    )
+    door_term = np.where(
+        no_drawers_applies,
+        equipment["door_openings"] * equipment["no_drawers_penalty_xblx_minutes_open"]
+        * equipment["door_opening_penalty_xbl_xminutes_open"],
+        equipment["door_openings"] * equipment["door_opening_penalty_xbl_xminutes_open"],
+    )
+    ice_factor = np.where(equipment["icing"] == "Yes, iced up", equipment["ice_penalty_xbl"], 1.0)
+    hfc_factor = np.where(equipment["refrigerant"].str.contains("HFCs", na=False),
+                          equipment["hfc_not_hc_coolant_penalty_xbl"], 1.0)
+    equipment.loc[mask, "electricity_use_kwh_year"] = (
+        equipment.loc[mask, "electricity_use_kwh_per_hour"] * ice_factor[mask] * hfc_factor[mask]
+        * 365 * (24 + door_term[mask])
+    )
+
+    mask = equipment["equipment"] == "ult"
+    seals_mask = equipment["damaged_seals_penalty"] == 1
+    spacing_mask = equipment["no_spacing_penalty"] == 1
+    filter_mask = equipment["clogged_filter_penalty"] == 1
+    condition_factor = 1.0
+    condition_factor = np.where(seals_mask & ~spacing_mask & ~filter_mask, equipment["damaged_seals_penalty_xbl"], condition_factor)
+    condition_factor = np.where(~seals_mask & spacing_mask & ~filter_mask, equipment["no_spacing_penalty_xbl"], condition_factor)
+    condition_factor = np.where(~seals_mask & ~spacing_mask & filter_mask, equipment["clogged_filters_penalty_xbl"], condition_factor)
+    condition_factor = np.where(~seals_mask & spacing_mask & filter_mask, equipment["no_spacing_and_clogged_filters_penalty_xbl"], condition_factor)
+    condition_factor = np.where(seals_mask & ~spacing_mask & filter_mask, equipment["damaged_seals_and_clogged_filters_penalty"], condition_factor)
+    condition_factor = np.where(seals_mask & spacing_mask & ~filter_mask, equipment["damaged_seals_and_no_spacing_penalty_xbl"], condition_factor)
+    condition_factor = np.where(seals_mask & spacing_mask & filter_mask, equipment["no_spacing_and_clogged_filters_and_damaged_seal_penalty_xbl"], condition_factor)
+    door_term = equipment["door_openings"] * equipment["door_opening_penalty_xbl_xminutes_open"]
+    equipment.loc[mask, "electricity_use_kwh_year"] = (
+        365 * 24 * equipment.loc[mask, "electricity_use_kwh_per_hour"] * condition_factor[mask] * (1 + door_term[mask])
+    )
+
+    mask = equipment["equipment"] == "incubator"
+    equipment.loc[mask, "electricity_use_kwh_year"] = HOURS_PER_YEAR * equipment.loc[mask, "electricity_use_kwh_per_hour"]
+
+    mask = equipment["equipment"] == "bath"
+    lid_factor = np.where(equipment["lid_off_penalty"] == 1, equipment["lid_off_penalty_xbl"].fillna(1.0), 1.0)
+    bead_factor = np.where(equipment["beads_penalty"] == 1, equipment["beads_not_water_penalty_xbl"].fillna(1.0), 1.0)
+    equipment.loc[mask, "electricity_use_kwh_year"] = (
+        equipment.loc[mask, "hours"] * equipment.loc[mask, "days"] * equipment.loc[mask, "electricity_use_kwh_per_hour"]
+        * lid_factor[mask] * bead_factor[mask]
+    )
+
+    for eq_type in ["heater", "it"]:
+        mask = equipment["equipment"] == eq_type
+        equipment.loc[mask, "electricity_use_kwh_year"] = (
+            equipment.loc[mask, "hours"] * equipment.loc[mask, "days"] * equipment.loc[mask, "electricity_use_kwh_per_hour"]
+        )
+
+    mask = equipment["equipment"] == "cryostat"
+    no_standby = mask & (equipment["sleep_mode"] == "No Energy Saving Mode Available")
+    has_standby = mask & (equipment["sleep_mode"] == "Energy Saving Mode Available")
+    usage_hours = equipment["hours"] * equipment["days"]
+    equipment.loc[no_standby, "electricity_use_kwh_year"] = (
+        HOURS_PER_YEAR * equipment.loc[no_standby, "electricity_use_kwh_per_hour"]
+    )
+    equipment.loc[has_standby, "electricity_use_kwh_year"] = (
+        usage_hours[has_standby] * equipment.loc[has_standby, "electricity_use_kwh_per_hour"]
+        + (HOURS_PER_YEAR - usage_hours[has_standby])
+        * equipment.loc[has_standby, "electricity_use_kwh_per_hour"]
+        * equipment.loc[has_standby, "standby_penalty"]
+    )
+
+    mask = equipment["equipment"] == "glassware"
+    fan_factor = np.where(equipment["fan_penalty"] == 1, equipment["fan_penalty_xbl"].fillna(1.0), 1.0)
+    equipment.loc[mask, "electricity_use_kwh_year"] = (
+        equipment.loc[mask, "hours"] * equipment.loc[mask, "days"] * equipment.loc[mask, "electricity_use_kwh_per_hour"]
+        * fan_factor[mask]
+    )
+
+    mask = equipment["equipment"] == "microbio"
+    is_ducted = equipment["ducting_penalty"] == 1
+    ducting_factor = np.where(is_ducted, equipment["ducted_electricity_penalty_xbl"], 1.0)
+    equipment.loc[mask, "electricity_use_kwh_year"] = (
+        equipment.loc[mask, "hours"] * equipment.loc[mask, "days"] * equipment.loc[mask, "electricity_use_kwh_per_hour"]
+        * ducting_factor[mask]
+    )
+    equipment.loc[mask, "gas_use_kwh_year"] = np.where(
+        is_ducted[mask],
+        equipment.loc[mask, "hours"] * equipment.loc[mask, "days"]
+        * equipment.loc[mask, "ducted_gas_penalty_additional_kwh_per_hour"],
+        0.0,
+    )
+
+    fc_mask = equipment["equipment"] == "fc"
+    sash_width = equipment["sash_width"] - 0.3
+    face_vel = equipment["face_velocity_m/s"] * 1.075
+    Q = face_vel * (0.5 * sash_width)
+    cav_mask = fc_mask & (equipment["controller_type"] == "CAV")
+    cav_volume = Q * 3600 * HOURS_PER_YEAR
+    equipment.loc[cav_mask, "electricity_use_kwh_year"] = cav_volume[cav_mask] * elec_per_m3
+    equipment.loc[cav_mask, "gas_use_kwh_year"] = cav_volume[cav_mask] * gas_per_m3
+    vav_mask = fc_mask & (equipment["controller_type"] == "VAV")
+    loading_factor = equipment["surface"] * 1.1 * np.where(equipment["lifted"] == "Yes", 0, 1)
+    open_hours = equipment["hours_open"] * equipment["days"]
+    closed_hours = HOURS_PER_YEAR - open_hours
+    vav_volume = ((open_hours * Q * (1 + loading_factor)) + (closed_hours * Q * 0.25)) * 3600
+    equipment.loc[vav_mask, "electricity_use_kwh_year"] = vav_volume[vav_mask] * elec_per_m3
+    equipment.loc[vav_mask, "gas_use_kwh_year"] = vav_volume[vav_mask] * gas_per_m3
+
+    return equipment[["electricity_use_kwh_year", "gas_use_kwh_year"]]
+
+
+def legacy_scenarios(df, scenarios, elec_per_m3, gas_per_m3, co2_per_kwh_electricity, co2_per_kwh_gas):
+    """Per-lab energy use of each scenario by editing a copy of the panel and recomputing it."""
+    results = []
+    for name, overrides in scenarios.items():
+        panel = df.copy()
+        for col, value in overrides.items():
+            if isinstance(value, dict):
+                for equipment_value, v in value.items():
+                    panel.loc[panel["equipment"] == equipment_value, col] = v
+            else:
+                panel[col] = value
+        use = compute_energy_use(panel, elec_per_m3, gas_per_m3)
+        lab = pd.DataFrame({
+            "labgroupid": panel["labgroupid"],
+            "electricity_use_kwh_year": use["electricity_use_kwh_year"] * panel["number"],
+            "gas_use_kwh_year": use["gas_use_kwh_year"].fillna(0.0) * panel["number"],
+        }).groupby("labgroupid", as_index=False).sum()
+        lab.insert(1, "scenario", name)
+        results.append(lab)
+    out = pd.concat(results).sort_values("labgroupid", kind="stable").reset_index(drop=True)
+    out["total_energy_kwh_year"] = out["electricity_use_kwh_year"] + out["gas_use_kwh_year"]
+    out["co2_kg_year"] = (
+        out["electricity_use_kwh_year"] * co2_per_kwh_electricity + out["gas_use_kwh_year"] * co2_per_kwh_gas
+    )
+    return out
+
+
+def legacy_merge_calculator(equipment, equipment_calculations, merge_overrides):
+    """Calculator merge of 2_4 as in the notebook's cells (checks left out), rows back in panel order."""
+    equipment, equipment_calculations = equipment.copy(), equipment_calculations.copy()
+    equipment_calculations.columns = equipment_calculations.columns.str.lower()
+    equipment_calculations = equipment_calculations.rename(columns={
+        "equipment_type": "equipment", "work_surface_width": "width", "n_blocks": "blocks",
+        "brightness": "monitor_brightness"})
+    equipment_calculations["equipment"] = equipment_calculations["equipment"].replace({
+        "heat_block": "heater", "it_equipment": "it", "microbial_safety_cabinet": "microbio", "water_bath": "bath",
+        "freezer_20": "freezer", "ult_freezer": "ult", "drying_cabinet": "glassware", "co2_incubator": "incubator"})
+    for col in ["equipment", "type", "size", "age", "monitor_brightness"]:
+        equipment[col] = equipment[col].astype("string")
+        equipment_calculations[col] = equipment_calculations[col].astype("string")
+    for col in ["width", "blocks", "set_temp"]:
+        equipment[col] = pd.to_numeric(equipment[col], errors="raise")
+        equipment_calculations[col] = pd.to_numeric(equipment_calculations[col], errors="raise")
+    it_rows = equipment_calculations[equipment_calculations["equipment"] == "it"].copy()
+    non_it_rows = equipment_calculations[equipment_calculations["equipment"] != "it"].copy()
+    non_it_rows.drop(columns=["monitor_brightness"], inplace=True)
+
+    merge_cols_1 = MERGE_COLS
+    strategy_col = "match_strategy"
+    override_value_cols = [c for c in merge_overrides.columns if c.startswith("override_")]
+    overrides = merge_overrides[merge_cols_1 + [strategy_col] + override_value_cols].drop_duplicates()
+    overrides = overrides.astype({col: "string" for col in ["equipment", "type", "size", "age", "override_age"]})
+    eq = equipment.reset_index(drop=False).rename(columns={"index": "__row_id"})
+    eq = eq.merge(overrides, on=merge_cols_1, how="left")
+    standard_rows = eq[eq[strategy_col].isna()]
+    override_rows = eq[eq[strategy_col].notna()]
+    pieces = [standard_rows.merge(non_it_rows, on=merge_cols_1, how="left", indicator=True)]
+    for strategy, group in override_rows.groupby(strategy_col):
+        group = group.copy()
+        if strategy.startswith("ignore_"):
+            ignore_cols = [c for c in strategy.removeprefix("ignore_").split("_") if c in merge_cols_1]
+            merged = group.merge(non_it_rows, on=[c for c in merge_cols_1 if c not in ignore_cols], how="left",
+                                 indicator=True, suffixes=("_original", "_calculator"))
+        else:
+            target_cols = [c for c in strategy.removeprefix("override_").split("_") if c in merge_cols_1]
+            for col in target_cols:
+                group[f"{col}_original"] = group[col]
+                group[col] = group[f"override_{col}"]
+            merged = group.merge(non_it_rows, on=merge_cols_1, how="left", indicator=True)
+        pieces.append(merged)
+    equipment_1 = pd.concat(pieces, ignore_index=True).drop(
+        columns=[strategy_col, "_merge"] + override_value_cols, errors="ignore")
+
+    non_screen_it_rows = it_rows[it_rows["type"] != "Computer Screen"].rename(
+        columns={"electricity_use_kwh_per_hour": "electricity_non_screen"})[["equipment", "type", "electricity_non_screen"]]
+    screen_it_rows = it_rows[it_rows["type"] == "Computer Screen"].rename(
+        columns={"electricity_use_kwh_per_hour": "electricity_screen"})[
+        ["equipment", "type", "size", "monitor_brightness", "electricity_screen"]]
+    equipment_2 = equipment_1.merge(non_screen_it_rows, on=["equipment", "type"], how="left", suffixes=("", "_non_screen"))
+    equipment_3 = equipment_2.merge(screen_it_rows, on=["equipment", "size", "monitor_brightness"], how="left",
+                                    suffixes=("", "_screen"))
+    it_mask = equipment_3["equipment"] == "it"
+    for col in ["electricity_screen", "electricity_non_screen"]:
+        equipment_3.loc[it_mask, col] = equipment_3.loc[it_mask, col].fillna(0)
+    equipment_3.loc[it_mask, "electricity_use_kwh_per_hour"] = (
+        equipment_3.loc[it_mask, "electricity_non_screen"] + equipment_3.loc[it_mask, "electricity_screen"]
+    )
+    equipment_3 = equipment_3.sort_values("__row_id").drop(columns=["__row_id", "type_screen"])
+    return equipment_3.reset_index(drop=True)
+
+
+# ---------------------------
+# Benchmarks
+# ---------------------------
+
+def _time(func, repeat):
+    """Best wall time of repeat calls (seconds) and the result of the last call."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _same_values(a, b):
+    """Elementwise equality of two object arrays, treating all missing values as equal."""
+    a, b = np.asarray(a, dtype=object), np.asarray(b, dtype=object)
+    return a.shape == b.shape and all((pd.isna(x) and pd.isna(y)) or x == y for x, y in zip(a, b))
+
+
+def bench_affected_vars(df, repeat=1, legacy_items=500):
+    """
+    Steps 4 (original values) and 8 (pull-back) of clean_affected_vars, legacy vs current.
+
+    The legacy implementation is run on the first legacy_items cases only (its cost grows
+    linearly with the number of cases), its time for all cases is extrapolated.
+    """
+    cases = make_cases(df)
+    changed = make_changed(df, cases)
+    case_rows = df[[c for c in df.columns if c.endswith("_aff_vars")]].notna().any(axis=1)
+
+    results = []
+    sample = cases.head(legacy_items)
+    t_new, _ = _time(lambda: _original_values(df, cases, ID_COLS, case_rows), repeat)
+    t_old, old = _time(lambda: legacy_original_values(df, sample, ID_COLS), 1)
+    assert _same_values(old, _original_values(df, sample, ID_COLS, case_rows)), "original values differ"
+    results.append(("affected vars: original values", len(cases), t_old * len(cases) / len(sample), t_new))
+
+    sample = changed.head(legacy_items)
+    t_new, _ = _time(lambda: _pull_back(df.copy(), changed, ID_COLS), repeat)
+    t_old, old = _time(lambda: legacy_pull_back(df.copy(), sample, ID_COLS), 1)
+    pd.testing.assert_frame_equal(old, _pull_back(df.copy(), sample, ID_COLS))
+    results.append(("affected vars: pull-back", len(changed), t_old * len(changed) / len(sample), t_new))
+    return results
+
+
+def bench_split_types(df, repeat=1):
+    """Row keys and split-row materialisation of clean_split_types, legacy vs current."""
+    candidates, split_rows = make_split_rows(df)
+    clean_cols = [c for c in df.columns if c.endswith("_clean")]
+
+    results = []
+    t_new, new = _time(lambda: _row_keys(df, ID_COLS), repeat)
+    t_old, old = _time(lambda: legacy_row_keys(df, ID_COLS), 1)
+    assert _same_values(old, new), "row keys differ"
+    results.append(("split types: row keys", len(df), t_old, t_new))
+
+    t_new, new = _time(lambda: _replace_with_splits(df, candidates, split_rows, ID_COLS, clean_cols), repeat)
+    t_old, old = _time(lambda: legacy_replace_with_splits(df, candidates, split_rows, ID_COLS, clean_cols), 1)
+    pd.testing.assert_frame_equal(old[0], new[0])
+    assert old[2] == new[2], "replaced keys differ"
+    results.append(("split types: split rows", len(split_rows), t_old, t_new))
+    return results
+
+
+def bench_append(df, repeat=1, sheet_sizes=(1_000, 10_000, 50_000), n_append=50):
+    """Appending n_append rows to a review sheet with sheet_sizes rows, legacy vs current."""
+    cols = ID_COLS + [c for c in df.columns if c.endswith("_clean")][:4]
+    new_rows = df[cols].tail(n_append)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sheet_sizes:
+            sheet = df[cols].head(size)
+            old_file, new_file = os.path.join(tmp, "legacy.xlsx"), os.path.join(tmp, "current.xlsx")
+
+            def run(append, file_name):
+                write_sheets(file_name, {"Review": {"frame": sheet, "freeze_panes": "A2"}})
+                workbook_snapshot.load_rows(file_name)  # sheets already read, as in the cleaning functions
+                start = time.perf_counter()
+                append(file_name, "Review", new_rows)
+                return time.perf_counter() - start
+
+            t_old = min(run(legacy_append, old_file) for _ in range(repeat))
+            t_new = min(run(append_frame, new_file) for _ in range(repeat))
+            old_values = list(load_workbook(old_file, read_only=True)["Review"].values)
+            assert old_values == list(load_workbook(new_file, read_only=True)["Review"].values), "sheets differ"
+            assert workbook_snapshot.sheet_rows(new_file, "Review") == old_values, "snapshot differs"
+            results.append((f"append to {size:,}-row sheet", n_append, t_old, t_new))
+    return results
+
+
+def bench_energy_formulas(n_rows=100_000, repeat=1, elec_per_m3=0.05, gas_per_m3=0.2):
+    """Annual energy use of a synthetic equipment panel, the notebook's cells vs the formula registry."""
+    df = make_energy_panel(n_rows)
+    t_new, new = _time(lambda: compute_energy_use(df, elec_per_m3, gas_per_m3), repeat)
+    t_old, old = _time(lambda: legacy_energy_use(df, elec_per_m3, gas_per_m3), 1)
+    pd.testing.assert_frame_equal(old, new)
+    results = [("energy formulas (2_5)", n_rows, t_old, t_new)]
+
+    factors = (elec_per_m3, gas_per_m3, 0.1, 0.2)
+    t_new, new = _time(lambda: evaluate_scenarios(df, ENERGY_SCENARIOS, *factors), repeat)
+    t_old, old = _time(lambda: legacy_scenarios(df, ENERGY_SCENARIOS, *factors), 1)
+    pd.testing.assert_frame_equal(old, new, check_exact=False, rtol=1e-12)
+    results.append((f"energy scenarios ({len(ENERGY_SCENARIOS)})", n_rows, t_old, t_new))
+    return results
+
+
+def bench_calculator_merge(n_rows=100_000, repeat=1):
+    """Calculator merge of 2_4, the notebook's cells vs merge_calculator on a prebuilt index."""
+    calculations, equipment, merge_overrides = make_calculator_data(n_rows)
+    index = build_calculator_index(prepare_calculator_table(calculations))
+    t_new, (new, _) = _time(lambda: merge_calculator(equipment, index, merge_overrides), repeat)
+    t_old, old = _time(lambda: legacy_merge_calculator(equipment, calculations, merge_overrides), 1)
+    pd.testing.assert_frame_equal(old, new[old.columns])
+    return [("calculator merge (2_4)", n_rows, t_old, t_new)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cleaning helpers on a synthetic panel.")
+    parser.add_argument("--rows", type=int, default=50_000, help="rows of the synthetic panel")
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs of the current implementation")
+    parser.add_argument("--legacy-items", type=int, default=500,
+                        help="items the legacy implementation is run on (its time for all items is extrapolated)")
+    parser.add_argument("--energy-rows", type=int, default=100_000, help="rows of the synthetic equipment panel")
+    args = parser.parse_args()
+
+    df = make_panel(args.rows)
+    results = bench_affected_vars(df, args.repeat, args.legacy_items)
+    results += bench_split_types(df, args.repeat)
+    results += bench_energy_formulas(args.energy_rows, args.repeat)
+    results += bench_calculator_merge(args.energy_rows, args.repeat)
+    appends = bench_append(df, args.repeat, sheet_sizes=sorted({min(n, len(df)) for n in (1_000, 10_000, len(df))}))
+
+    print(f"Synthetic panel: {len(df):,} rows, {df.shape[1]} columns")
+    print(f"(results identical to legacy on up to {args.legacy_items} items per step, legacy time extrapolated)")
+    print(f"{'step':<34} {'items':>8} {'legacy (s)':>11} {'current (s)':>12} {'speed-up':>9}")
+    for step, n_items, t_old, t_new in results:
+        print(f"{step:<34} {n_items:>8,} {t_old:>11.3f} {t_new:>12.3f} {t_old / t_new:>8.0f}x")
+
+    print()
+    print("Appending rows (openpyxl load and save in both, no speed-up expected)")
+    print(f"{'step':<34} {'rows':>8} {'legacy (s)':>11} {'current (s)':>12}")
+    for step, n_items, t_old, t_new in appends:
+        print(f"{step:<34} {n_items:>8,} {t_old:>11.3f} {t_new:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+# Functions to merge the equipment panel with the equipment calculators (2_4_merge_calculator) through a
+# prebuilt index of the calculator table:
+#   (1) prepare_calculator_table: lower-case and rename the columns and equipment values of
+#       equipment_calculations.csv to the panel's names and type the merge keys (strings / floats)
+#   (2) build_calculator_index: split the table into non-IT rows, IT non-screen rows and IT screen rows
+#       and hash the merge keys of each part ({key tuple: calculator rows}, missing keys match missing keys
+#       as in pd.merge). Duplicate merge keys raise an error listing them (or, with duplicates="first",
+#       print them and keep the first row of each key).
+#       load_calculator_index stores the prepared parts next to the calculator file
+#       (.calculator_index/<sha256 of the file>/<part>.parquet), so that a new session reads them instead
+#       of preparing the CSV again, until the file's content changes
+#   (3) merge_calculator: look up all panel rows in one call - exact match on the seven merge keys, merge
+#       overrides (merge_overrides.xlsx), optionally the nearest setpoint when no calculator row has the
+#       row's set_temp, and the IT path (non-screen electricity by type + screen electricity by size and
+#       brightness) - and return the merged panel with per-row match diagnostics
+
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from assign_set_temp import assign_set_temp
+from extraction_cache import hash_file
+
+MERGE_COLS = ["equipment", "type", "width", "size", "blocks", "age", "set_temp"]
+STRING_KEYS = ["equipment", "type", "size", "age", "monitor_brightness"]
+NUMERIC_KEYS = ["width", "blocks", "set_temp"]
+IT_NON_SCREEN_KEYS = ["equipment", "type"]
+IT_SCREEN_KEYS = ["equipment", "size", "monitor_brightness"]
+
+# Calculator column and equipment names -> panel names
+CALCULATOR_COLUMNS = {
+    "equipment_type": "equipment",
+    "work_surface_width": "width",
+    "n_blocks": "blocks",
+    "brightness": "monitor_brightness",
+}
+CALCULATOR_EQUIPMENT = {
+    "heat_block": "heater",
+    "it_equipment": "it",
+    "microbial_safety_cabinet": "microbio",
+    "water_bath": "bath",
+    "freezer_20": "freezer",
+    "ult_freezer": "ult",
+    "drying_cabinet": "glassware",
+    "co2_incubator": "incubator",
+}
+
+# Bump to rebuild all stored indexes when the stored parts or their preparation change
+INDEX_VERSION = 1
+
+INDEX_PARTS = ["table", "it_non_screen", "it_screen", "duplicates"]
+
+# Indexes loaded by load_calculator_index in this process ({resolved path: ((size, mtime_ns), index)})
+_INDEXES = {}
+
+
+# ---------------------------
+# Keys
+# ---------------------------
+
+def type_merge_keys(frame):
+    """
+    Type the merge keys of a frame in place: string keys as "string", numeric keys as floats
+    (missing values stay missing, they do not become the string "nan").
+    """
+    for col in STRING_KEYS:
+        if col in frame.columns:
+            frame[col] = frame[col].astype("string")
+    for col in NUMERIC_KEYS:
+        if col in frame.columns:
+            frame[col] = pd.to_numeric(frame[col], errors="raise").astype("float64")
+    return frame
+
+
+def _key_tuples(frame, key_cols):
+    """Key tuple of every row of frame, with None for missing values (so that NA matches NA)."""
+    columns = [frame[col].astype(object).where(frame[col].notna(), None).tolist() for col in key_cols]
+    return list(zip(*columns))
+
+
+def _unique_keys(frame, key_cols):
+    """
+    Code of every row's key and the distinct key tuples (by code), so that each distinct key is
+    hashed and looked up once.
+    """
+    codes = frame.groupby(key_cols, dropna=False, sort=False).ngroup().to_numpy()
+    first_rows = np.unique(codes, return_index=True)[1]
+    return codes, _key_tuples(frame.iloc[first_rows], key_cols)
+
+
+def _equals(series, value):
+    """series == value, with missing values as False."""
+    return (series == value).fillna(False).astype(bool)
+
+
+def _strategy_columns(suffix):
+    """Merge columns named in a strategy suffix, e.g. "width_size" -> ["width", "size"], "set_temp" -> ["set_temp"]."""
+    tokens = suffix.split("_")
+    cols = []
+    i = 0
+    while i < len(tokens):
+        for j in range(len(tokens), i, -1):
+            if "_".join(tokens[i:j]) in MERGE_COLS:
+                cols.append("_".join(tokens[i:j]))
+                i = j
+                break
+        else:
+            i += 1
+    return cols
+
+
+def _parse_strategy(strategy):
+    """("ignore" or "override", merge columns) of a merge override strategy."""
+    if strategy.startswith("ignore_"):
+        kind, cols = "ignore", _strategy_columns(strategy.removeprefix("ignore_"))
+    else:
+        prefix = "use_override_" if strategy.startswith("use_override_") else "override_"
+        kind, cols = "override", _strategy_columns(strategy.removeprefix(prefix))
+    if not cols:
+        raise ValueError(f"Strategy '{strategy}' does not reference a valid merge column.")
+    return kind, cols
+
+
+# ---------------------------
+# Index
+# ---------------------------
+
+def prepare_calculator_table(equipment_calculations):
+    """
+    Calculator table (equipment_calculations.csv as read in 2_4) with the panel's column names,
+    equipment names and merge key types.
+    """
+    table = equipment_calculations.copy()
+    table.columns = table.columns.str.lower()
+    table = table.rename(columns=CALCULATOR_COLUMNS)
+    table["equipment"] = table["equipment"].replace(CALCULATOR_EQUIPMENT)
+    return type_merge_keys(table)
+
+
+def _index_parts(calculator_table):
+    """Non-IT, IT non-screen and IT screen parts of a prepared calculator table, deduplicated, and the duplicates."""
+    is_it = _equals(calculator_table["equipment"], "it")
+    is_screen = _equals(calculator_table["type"], "Computer Screen")
+    parts = {
+        "table": (
+            calculator_table[~is_it].drop(columns=["monitor_brightness"], errors="ignore"),
+            MERGE_COLS,
+        ),
+        "it_non_screen": (
+            calculator_table.loc[is_it & ~is_screen & calculator_table["type"].notna()]
+            .rename(columns={"electricity_use_kwh_per_hour": "electricity_non_screen"})
+            [IT_NON_SCREEN_KEYS + ["electricity_non_screen"]],
+            IT_NON_SCREEN_KEYS,
+        ),
+        "it_screen": (
+            calculator_table.loc[is_it & is_screen]
+            .rename(columns={"electricity_use_kwh_per_hour": "electricity_screen"})
+            [IT_SCREEN_KEYS + ["electricity_screen"]],
+            IT_SCREEN_KEYS,
+        ),
+    }
+
+    out = {}
+    duplicates = []
+    for name, (part, key_cols) in parts.items():
+        duplicated = part.duplicated(subset=key_cols, keep=False)
+        if duplicated.any():
+            duplicates.append(part[duplicated].sort_values(key_cols))
+        out[name] = part.drop_duplicates(subset=key_cols).reset_index(drop=True)
+    out["duplicates"] = pd.concat(duplicates) if duplicates else calculator_table.iloc[:0]
+    return out
+
+
+def _index_from_parts(parts, duplicates="raise"):
+    """Index of the stored or built parts, after checking them for duplicate merge keys."""
+    if duplicates not in ["raise", "first"]:
+        raise ValueError(f"Unknown duplicates '{duplicates}', use 'raise' or 'first'.")
+    if not parts["duplicates"].empty:
+        message = f"{len(parts['duplicates'])} calculator rows have the same merge keys as another row:\n" \
+                  f"{parts['duplicates'].to_string()}"
+        if duplicates == "raise":
+            raise ValueError(message + "\nRemove the duplicates or pass duplicates='first' to use the first row of each key.")
+        print("Warning: " + message + "\nOnly the first row of each key is used.")
+
+    index = dict(parts, lookups={})
+    # Lookups of the IT parts (one row per key)
+    for name, key_cols in [("it_non_screen", IT_NON_SCREEN_KEYS), ("it_screen", IT_SCREEN_KEYS)]:
+        index[f"{name}_lookup"] = {key: pos for pos, key in enumerate(_key_tuples(index[name], key_cols))}
+    return index
+
+
+def build_calculator_index(calculator_table, duplicates="raise"):
+    """
+    Hash index of a prepared calculator table (see prepare_calculator_table).
+
+    Parameters
+    ----------
+    calculator_table : pd.DataFrame
+        Prepared calculator table.
+    duplicates : str
+        "raise": raise a ValueError listing the calculator rows whose merge keys are not unique in their
+        part (a merge would match several rows); "first": print them and use the first row of each key.
+
+    Returns
+    -------
+    dict
+        "table": non-IT calculator rows, one per combination of MERGE_COLS,
+        "it_non_screen" / "it_screen": IT rows with electricity_non_screen by IT_NON_SCREEN_KEYS and
+        electricity_screen by IT_SCREEN_KEYS,
+        "duplicates": calculator rows whose merge keys are not unique in their part (all copies),
+        "lookups": {key columns: {key tuple: positions in "table"}}, filled on first use.
+    """
+    return _index_from_parts(_index_parts(calculator_table), duplicates)
+
+
+def _lookup(index, key_cols):
+    """{key tuple: positions in index["table"]} on key_cols, built once per set of key columns."""
+    key_cols = tuple(key_cols)
+    if key_cols not in index["lookups"]:
+        positions = {}
+        for pos, key in enumerate(_key_tuples(index["table"], key_cols)):
+            positions.setdefault(key, []).append(pos)
+        index["lookups"][key_cols] = positions
+    return index["lookups"][key_cols]
+
+
+def load_calculator_index(path, duplicates="raise"):
+    """
+    Index of a calculator file (equipment_calculations.csv), see build_calculator_index.
+
+    The prepared parts are stored in .calculator_index/<sha256 of the file> next to the file and read
+    from there while the file's content is unchanged (within a process, the index is reused while the
+    file's size and modification time are unchanged).
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    signature = (stat.st_size, stat.st_mtime_ns)
+    cached = _INDEXES.get(path)
+    if cached is not None and cached[0] == signature:
+        return _index_from_parts(cached[1], duplicates)
+
+    folder = path.parent / ".calculator_index"
+    stored = folder / f"{path.name}.v{INDEX_VERSION}.{hash_file(path)}"
+    if all((stored / f"{name}.parquet").exists() for name in INDEX_PARTS):
+        parts = {name: pd.read_parquet(stored / f"{name}.parquet") for name in INDEX_PARTS}
+    else:
+        equipment_calculations = pd.read_csv(
+            path,
+            keep_default_na=False,  # Keep "None" as a string, not NaN
+            na_values=[""],  # Only treat empty strings as NaN
+        )
+        parts = _index_parts(prepare_calculator_table(equipment_calculations))
+
+        # Replace the stored parts of earlier versions of the file (written to a temporary folder first)
+        folder.mkdir(exist_ok=True)
+        tmp = Path(f"{stored}.tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+        for name in INDEX_PARTS:
+            parts[name].to_parquet(tmp / f"{name}.parquet")
+        for old in folder.glob(f"{path.name}.v*"):
+            if old != tmp:
+                shutil.rmtree(old, ignore_errors=True)
+        os.replace(tmp, stored)
+
+    _INDEXES[path] = (signature, parts)
+    return _index_from_parts(parts, duplicates)
+
+
+# ---------------------------
+# Merge
+# ---------------------------
+
+def _prepare_overrides(merge_overrides):
+    """Merge overrides typed like the panel, one per combination of MERGE_COLS (first kept)."""
+    strategy_col = next((c for c in ["match_strategy", "merge_strategy"] if c in merge_overrides.columns), None)
+    if strategy_col is None:
+        raise KeyError("merge_overrides must contain 'match_strategy' or 'merge_strategy'.")
+
+    override_value_cols = [c for c in merge_overrides.columns if c.startswith("override_")]
+    overrides = merge_overrides[MERGE_COLS + [strategy_col] + override_value_cols].drop_duplicates()
+    overrides = type_merge_keys(overrides.copy())
+    for col in override_value_cols:
+        key_col = col.removeprefix("override_")
+        if key_col in STRING_KEYS:
+            overrides[col] = overrides[col].astype("string")
+        elif key_col in NUMERIC_KEYS:
+            overrides[col] = pd.to_numeric(overrides[col], errors="raise").astype("float64")
+    overrides = overrides.drop_duplicates(subset=MERGE_COLS).rename(columns={strategy_col: "strategy"})
+    return overrides.reset_index(drop=True)
+
+
+def merge_calculator(equipment, index, merge_overrides=None, nearest_set_temp=False):
+    """
+    Merge the equipment panel with the equipment calculators in one call.
+
+    Parameters
+    ----------
+    equipment : pd.DataFrame
+        Panel dataset (panel_processed_3), not modified.
+    index : dict
+        Calculator index (build_calculator_index / load_calculator_index).
+    merge_overrides : pd.DataFrame, optional
+        Merge overrides (merge_overrides.xlsx): MERGE_COLS, a match_strategy (or merge_strategy)
+        column and override_<col> values. Rows with the override's keys are looked up
+            - "ignore_<cols>": without these columns; they are kept as <col>_original (panel value)
+              and <col>_calculator (value of the calculator row) and left missing in <col>
+            - "override_<cols>" / "use_override_<cols>": with the override_<col> values instead of
+              the panel's; the panel values are kept as <col>_original
+    nearest_set_temp : bool
+        Rows without a calculator row for their set_temp are matched with the calculator row of the
+        nearest setpoint for the same other keys (set_temp itself is not changed).
+
+    Returns
+    -------
+    merged : pd.DataFrame
+        Panel (rows in the same order, merge keys typed) with the calculator columns,
+        electricity_non_screen and electricity_screen. For IT rows, electricity_use_kwh_per_hour is
+        electricity_non_screen + electricity_screen (missing parts count as 0).
+    matches : pd.DataFrame
+        Per row (same index as merged): match ("exact", "override", "ignore", "nearest_set_temp" or
+        "unmatched"; IT rows are not in the non-IT calculator table), strategy, calculator_row (row of
+        index["table"], -1 if unmatched), candidates (calculator rows with the row's key; with an
+        ignore strategy the first is used), calculator_set_temp, it_non_screen and it_screen (IT parts
+        found).
+    """
+    out = type_merge_keys(equipment.reset_index(drop=True).copy())
+    n = len(out)
+    table = index["table"]
+
+    match = np.full(n, "exact", dtype=object)
+    strategies = np.full(n, None, dtype=object)
+    positions = np.full(n, -1)
+    candidates = np.zeros(n, dtype=int)
+    extra = {}  # <col>_original / <col>_calculator columns
+
+    # Rows with merge overrides: tag them, apply the overrides and note the key columns they are looked up on
+    codes, keys = _unique_keys(out, MERGE_COLS)
+    tagged = np.full(n, -1)
+    lookup_groups = {}  # key columns -> rows looked up on them after the overrides
+    ignored = {}
+    if merge_overrides is not None and n:
+        overrides = _prepare_overrides(merge_overrides)
+        override_rows = {key: i for i, key in enumerate(_key_tuples(overrides, MERGE_COLS))}
+        tagged = np.array([override_rows.get(key, -1) for key in keys], dtype=int)[codes]
+
+        for strategy, rows_in_overrides in overrides.groupby("strategy", sort=True).indices.items():
+            rows = np.flatnonzero(np.isin(tagged, rows_in_overrides))
+            if not len(rows):
+                continue
+            kind, cols = _parse_strategy(strategy)
+            strategies[rows] = strategy
+            match[rows] = kind
+            for col in cols:
+                original = extra.setdefault(f"{col}_original", out[col].iloc[:0].reindex(out.index))
+                original.iloc[rows] = out[col].iloc[rows].to_numpy()
+            if kind == "ignore":
+                key_cols = tuple(c for c in MERGE_COLS if c not in cols)
+                ignored.setdefault(tuple(cols), []).append(rows)
+            else:
+                key_cols = tuple(MERGE_COLS)
+                for col in cols:
+                    out.loc[rows, col] = overrides[f"override_{col}"].to_numpy()[tagged[rows]]
+            lookup_groups.setdefault(key_cols, []).append(rows)
+
+    # Exact lookups (each distinct key once): rows without overrides on their panel keys, then the
+    # override rows on their new keys
+    standard_rows = np.flatnonzero(tagged < 0)
+    groups = [(tuple(MERGE_COLS), standard_rows, codes[standard_rows], keys)]
+    for key_cols, row_groups in lookup_groups.items():
+        rows = np.concatenate(row_groups)
+        groups.append((key_cols, rows) + _unique_keys(out.iloc[rows], list(key_cols)))
+
+    for key_cols, rows, row_codes, row_keys in groups:
+        lookup = _lookup(index, key_cols)
+        found = [lookup.get(key, ()) for key in row_keys]
+        if len(rows):
+            positions[rows] = np.array([f[0] if f else -1 for f in found], dtype=int)[row_codes]
+            candidates[rows] = np.array([len(f) for f in found], dtype=int)[row_codes]
+
+        # Nearest setpoint for rows without an exact match
+        if nearest_set_temp and "set_temp" in key_cols:
+            rest_cols = tuple(c for c in key_cols if c != "set_temp")
+            rest_lookup = _lookup(index, rest_cols)
+            unmatched = rows[(positions[rows] < 0) & out["set_temp"].iloc[rows].notna().to_numpy()]
+            for row, key in zip(unmatched, _key_tuples(out.iloc[unmatched], rest_cols)):
+                found = rest_lookup.get(key, ())
+                setpoints = table["set_temp"].to_numpy()[found] if found else []
+                nearest = assign_set_temp(out["set_temp"].iat[row], setpoints)
+                if pd.isna(nearest):
+                    continue
+                positions[row] = next(pos for pos, sp in zip(found, setpoints) if sp == nearest)
+                candidates[row] = len(found)
+                match[row] = "nearest_set_temp"
+
+    matched = positions >= 0
+    match[~matched] = "unmatched"
+
+    # Calculator values of the matched rows (missing for unmatched rows)
+    value_cols = [c for c in table.columns if c not in MERGE_COLS]
+    values = table[value_cols].reindex(positions).reset_index(drop=True)
+    values.columns = [f"{c}_calculator" if c in out.columns else c for c in value_cols]
+
+    # Ignored keys: calculator value in <col>_calculator, left missing in <col>
+    for cols, row_groups in ignored.items():
+        rows = np.concatenate(row_groups)
+        for col in cols:
+            calculator = extra.setdefault(f"{col}_calculator", table[col].iloc[:0].reindex(out.index))
+            calculator.iloc[rows] = table[col].reindex(positions[rows]).to_numpy()
+            out.loc[rows, col] = pd.NA
+
+    merged = pd.concat([out, values, pd.DataFrame(extra, index=out.index)], axis=1)
+
+    # IT: non-screen electricity by type, screen electricity by size and brightness
+    it_rows = np.flatnonzero(_equals(merged["equipment"], "it").to_numpy())
+    it_parts = {}
+    for name, key_cols, value_col in [("it_non_screen", IT_NON_SCREEN_KEYS, "electricity_non_screen"),
+                                      ("it_screen", IT_SCREEN_KEYS, "electricity_screen")]:
+        lookup = index[f"{name}_lookup"]
+        found = np.full(len(it_rows), -1)
+        if len(it_rows):
+            codes, keys = _unique_keys(merged.iloc[it_rows], key_cols)
+            found = np.array([lookup.get(key, -1) for key in keys], dtype=int)[codes]
+        # Keys not found (all keys, if the calculator has no rows for this part) count as 0
+        part_table = index[name][value_col].to_numpy(dtype=float)
+        part_values = np.full(n, np.nan)
+        part_values[it_rows] = (
+            np.where(found >= 0, part_table[np.maximum(found, 0)], 0.0) if len(part_table) else 0.0
+        )
+        merged[value_col] = part_values
+        it_parts[name] = np.zeros(n, dtype=bool)
+        it_parts[name][it_rows] = found >= 0
+    merged.loc[it_rows, "electricity_use_kwh_per_hour"] = (
+        merged["electricity_non_screen"].iloc[it_rows] + merged["electricity_screen"].iloc[it_rows]
+    )
+
+    matches = pd.DataFrame({
+        "match": pd.array(match, dtype="string"),
+        "strategy": pd.array(strategies, dtype="string"),
+        "calculator_row": positions,
+        "candidates": candidates,
+        "calculator_set_temp": table["set_temp"].reindex(positions).to_numpy(dtype=float),
+        "it_non_screen": it_parts["it_non_screen"],
+        "it_screen": it_parts["it_screen"],
+    }, index=merged.index)
+    return merged, matches
@@ -1,5 +1,10 @@
 # Function to create variable(s) from cell(s) in individual survey files
 # All variables created as string type to aid cleaning
+
+from pipeline_profiling import profiled
+
+
+@profiled(file_args=())
 def create_var(ws, labs, mask, var_name,
                cell,
                multiple_cells=False,
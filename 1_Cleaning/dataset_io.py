@@ -0,0 +1,171 @@
+# Functions to write and read the numbered processed datasets (individual_processed_N, panel_processed_N):
+#   (1) Store each dataset as Parquet (explicit column dtypes, "None" strings kept distinct from missing)
+#   (2) Normalise on write, column by column, to the values and dtypes that the CSV read settings used
+#       throughout the pipeline would give (keep_default_na=False, na_values=[""]), so reading back needs no
+#       settings: empty strings become missing, numeric-looking and True/False columns become numbers / booleans
+#   (3) Optionally write the CSV as a side output (e.g. for the descriptives notebooks)
+#   (4) Optionally keep written datasets in memory, so that stages run in one process (run_all.py
+#       --in-process) pass DataFrames to each other without re-reading them (files are still written)
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Read csv settings to ensure "None" is always treated as a string and not converted to NaN
+READ_CSV_SETTINGS = {
+    "keep_default_na": False,
+    "na_values": [""]
+}
+
+# Texts that read_csv parses as booleans
+TRUE_VALUES = ["True", "TRUE", "true"]
+FALSE_VALUES = ["False", "FALSE", "false"]
+
+# In-memory copies of written datasets ({resolved parquet path: DataFrame}), None if disabled
+_memory_store = None
+
+
+def enable_memory_store():
+    """Keep datasets written from now on in memory and serve read_dataset from memory."""
+    global _memory_store
+    if _memory_store is None:
+        _memory_store = {}
+
+
+def disable_memory_store():
+    """Stop keeping datasets in memory and free the stored copies."""
+    global _memory_store
+    _memory_store = None
+
+
+# Helper: the text a value is written as in a CSV (missing values and empty strings as None)
+def _csv_text(v):
+    if v is None or v is pd.NA or v is pd.NaT or (isinstance(v, float) and np.isnan(v)):
+        return None
+    text = str(v)
+    return text if text != "" else None
+
+
+# Helper: dates and times as to_csv writes them (dates only if all values are at midnight)
+def _datetime_text(s):
+    fmt = "%Y-%m-%d" if (s.dropna() == s.dropna().dt.normalize()).all() else "%Y-%m-%d %H:%M:%S"
+    return s.dt.strftime(fmt).astype(object).where(s.notna(), None)
+
+
+def _normalize_column(s):
+    """Return one column with the values and dtype it would have after a CSV write and re-read."""
+    # Boolean, integer and float64 columns keep their values (floats are written with full precision);
+    # with missing values they are read back as object (booleans) or float
+    is_bool = pd.api.types.is_bool_dtype(s.dtype)
+    is_int = pd.api.types.is_integer_dtype(s.dtype)
+    if is_bool or is_int or s.dtype == "float64":
+        if not s.isna().any():
+            return s.astype(bool if is_bool else "int64" if is_int else "float64")
+        return s.astype(object).where(s.notna(), np.nan) if is_bool else s.astype("float64")
+
+    # All other columns: parse the written text as read_csv does (numbers, True/False, else strings)
+    if pd.api.types.is_datetime64_any_dtype(s.dtype):
+        texts = _datetime_text(s)
+    elif pd.api.types.infer_dtype(s, skipna=True) in ["string", "empty"]:
+        texts = s.astype(object).where(s.notna() & (s != ""), None)
+    else:
+        texts = s.astype(object).map(_csv_text)
+    missing = texts.isna()
+    present = texts[~missing]
+
+    if len(present) == 0:
+        return pd.Series(np.nan, index=s.index, name=s.name, dtype="float64")
+
+    # Distinct values are parsed first, so text columns are not parsed value by value
+    if pd.to_numeric(pd.Series(present.unique(), dtype=object), errors="coerce").notna().all():
+        numbers = pd.to_numeric(present)
+        if not missing.any() and pd.api.types.is_integer_dtype(numbers.dtype):
+            return numbers.astype("int64")
+        return numbers.astype("float64").reindex(s.index)
+
+    if present.isin(TRUE_VALUES + FALSE_VALUES).all():
+        bools = present.isin(TRUE_VALUES)
+        if not missing.any():
+            return bools.astype(bool)
+        return bools.astype(object).reindex(s.index)
+
+    # Strings with NaN for missing values, in the dtype read_csv infers for them (object, or str on pandas 3)
+    return pd.Series(texts.where(~missing, np.nan).to_numpy(dtype=object), index=s.index, name=s.name)
+
+
+def _normalize(df):
+    """Return df with the values and dtypes it would have after a CSV write and re-read."""
+    df = df.reset_index(drop=True)
+    return pd.DataFrame({col: _normalize_column(df[col]) for col in df.columns}, columns=df.columns)
+
+
+def _missing_as_nan(df):
+    """Use NaN (as read_csv does) instead of None for missing values in object columns."""
+    obj_cols = df.columns[df.dtypes == object]
+    if len(obj_cols):
+        df[obj_cols] = df[obj_cols].where(df[obj_cols].notna(), np.nan)
+    return df
+
+
+def write_dataset(df, path, csv=False):
+    """
+    Write a processed dataset as Parquet.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Dataset to write (the index is not written).
+    path : path-like
+        Output file, e.g. config.PROCESSED_DATA / "panel_processed_1.parquet".
+    csv : bool, default False
+        Also write the dataset as CSV next to the Parquet file (same name, .csv).
+
+    Notes
+    -----
+    Values are stored exactly as the pipeline reads them from CSV: numeric-looking
+    columns as int/float, all other columns as strings with "None" kept as a
+    string and only empty values missing.
+    """
+    path = Path(path).with_suffix(".parquet")
+    df = _normalize(df)
+
+    tmp_path = path.with_suffix(".parquet.tmp")
+    df.to_parquet(tmp_path, index=False)
+    tmp_path.replace(path)
+
+    if _memory_store is not None:
+        _memory_store[path.resolve()] = _missing_as_nan(df)
+
+    if csv:
+        df.to_csv(path.with_suffix(".csv"), index=False)
+
+
+def read_dataset(path, columns=None):
+    """
+    Read a processed dataset written by write_dataset.
+
+    Parameters
+    ----------
+    path : path-like
+        Dataset file, with or without suffix. If no Parquet file exists, the
+        CSV of the same name is read with the pipeline's CSV settings.
+    columns : list[str], optional
+        Only read these columns.
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    path = Path(path)
+    parquet_path = path.with_suffix(".parquet")
+
+    # Copy, so that changes in one stage do not affect the stored dataset
+    if _memory_store is not None and parquet_path.resolve() in _memory_store:
+        df = _memory_store[parquet_path.resolve()]
+        return (df[columns] if columns is not None else df).copy()
+
+    if parquet_path.exists():
+        return _missing_as_nan(pd.read_parquet(parquet_path, columns=columns))
+
+    return pd.read_csv(path.with_suffix(".csv"), usecols=columns, **READ_CSV_SETTINGS)
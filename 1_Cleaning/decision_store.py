@@ -0,0 +1,452 @@
+# Functions to keep the cleaning decisions of a cleaning workbook in an SQLite database:
+#   (1) Import the sheets of the cleaning workbook (one table per sheet, rows in sheet order) with
+#       indexed, normalised merge keys (raw_value, raw_value_fc, comment, comment_fc) in a key table per sheet
+#   (2) Clean unique values against the database: look up decisions with SQL joins on the keys and
+#       insert new combinations as "Unchecked" rows (same result as clean_unique_values_batch)
+#   (3) Export the new rows to the workbook (appended in one save) so that reviewers keep working in Excel
+#
+# Typical use in a cleaning notebook:
+#   import_from_xlsx(db_path, file_name)                 # pick up reviewers' edits (if the workbook changed)
+#   df = clean_unique_values_db(df, db_path, variables)  # same variables list as clean_unique_values_batch
+#   export_to_xlsx(db_path, file_name)                   # append the new "Unchecked" rows for review
+#
+# Cells are stored as SQLite values (text, integer, real or NULL); other types (dates, times, booleans)
+# are stored as text with their type recorded in cell_types, so that values come back as the workbook
+# gives them. Keys are normalised with the dtype of the variables cleaned against the sheet (strings stripped,
+# numbers as floats, dates as ISO dates) and stored once per dtype (a dtype column in the key table), so that
+# variables of different dtypes on one sheet each use their own keys. Keys are compared null-safely (IS).
+
+import json
+import sqlite3
+from contextlib import closing
+
+import pandas as pd
+
+import workbook_snapshot
+from extraction_cache import decode_value, encode_value, hash_file
+from pipeline_profiling import profiled
+from unique_values_cleaning import (_enforce_dtypes, _merge_lookup, _prepare_df, _print_report,
+                                    _read_sheet, _rows_to_append)
+from workbook_writer import append_rows
+
+KEY_COLUMNS = ["raw_value", "raw_value_fc", "comment", "comment_fc"]
+
+# Column names of the sheet tables besides the sheet's own columns
+RESERVED_COLUMNS = {"row_no", "exported", "cell_types"}
+
+# Types SQLite stores and returns unchanged
+NATIVE_TYPES = (str, int, float, type(None))
+
+
+# ---------------------------
+# Database
+# ---------------------------
+
+def _connect(db_path):
+    con = sqlite3.connect(db_path)
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS sheets (
+            sheet TEXT PRIMARY KEY,
+            table_name TEXT NOT NULL UNIQUE,
+            headers TEXT NOT NULL,    -- JSON list of the sheet's column headers
+            columns TEXT NOT NULL,    -- JSON list of the table columns holding them
+            key_dtypes TEXT NOT NULL  -- JSON list of the dtypes the key table holds keys for
+        );
+    """)
+    return con
+
+
+def _get_meta(con, key):
+    row = con.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(con, **values):
+    con.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", values.items())
+
+
+def _sheet_info(con, sheet_name):
+    row = con.execute(
+        "SELECT table_name, headers, columns, key_dtypes FROM sheets WHERE sheet = ?", (sheet_name,)
+    ).fetchone()
+    if row is None:
+        raise ValueError(f"Sheet {sheet_name} does not exist. Please create it first (and run import_from_xlsx).")
+    return {"sheet": sheet_name, "table": row[0], "headers": json.loads(row[1]),
+            "columns": json.loads(row[2]), "key_dtypes": json.loads(row[3])}
+
+
+def _column_names(headers):
+    """Table column of each sheet header (the header itself where possible, else c<position>)."""
+    columns = []
+    for i, h in enumerate(headers, start=1):
+        name = h if isinstance(h, str) and h.isidentifier() else None
+        if name is None or name in RESERVED_COLUMNS or name in columns:
+            name = f"c{i}"
+        columns.append(name)
+    return columns
+
+
+def _create_table(con, table, columns):
+    con.execute(f'DROP TABLE IF EXISTS "{table}"')
+    con.execute(f'DROP TABLE IF EXISTS "{table}_keys"')
+    # Sheet columns without a declared type, so values keep their SQLite storage class
+    cell_defs = ", ".join(f'"{c}"' for c in columns)
+    con.execute(
+        f'CREATE TABLE "{table}" (row_no INTEGER PRIMARY KEY, exported INTEGER NOT NULL, '
+        f'cell_types TEXT, {cell_defs})'
+    )
+    # Normalised keys of each row, one set per dtype
+    key_defs = ", ".join(f"k_{c} TEXT" for c in KEY_COLUMNS)
+    con.execute(
+        f'CREATE TABLE "{table}_keys" (dtype TEXT NOT NULL, row_no INTEGER NOT NULL, {key_defs}, '
+        f'PRIMARY KEY (dtype, row_no))'
+    )
+    con.execute(
+        f'CREATE INDEX "{table}_keys_lookup" ON "{table}_keys" '
+        f'(dtype, {", ".join(f"k_{c}" for c in KEY_COLUMNS)}, row_no)'
+    )
+
+
+# ---------------------------
+# Cells and keys
+# ---------------------------
+
+def _encode_cells(row):
+    """Values to store for one row of cells, and the types of cells not stored natively (JSON or None)."""
+    values = []
+    types = {}
+    for i, v in enumerate(row):
+        if isinstance(v, bool) or not isinstance(v, NATIVE_TYPES):
+            types[i], v = encode_value(v)
+        values.append(v)
+    return values, json.dumps(types) if types else None
+
+
+def _decode_cells(values, cell_types, positions=None):
+    """Cell values of one stored row (only those at positions, if given)."""
+    types = json.loads(cell_types) if cell_types else {}
+    positions = range(len(values)) if positions is None else positions
+    return [decode_value(types[str(i)], values[i]) if str(i) in types else values[i] for i in positions]
+
+
+def _key_texts(frame, dtype):
+    """Normalised keys (text, None if missing) of the key columns of a frame typed with _enforce_dtypes."""
+    keys = {}
+    for c in KEY_COLUMNS:
+        if c not in frame.columns:
+            keys[f"k_{c}"] = [None] * len(frame)
+        elif c == "raw_value" and dtype == "numeric":
+            keys[f"k_{c}"] = [None if pd.isna(v) else repr(float(v)) for v in frame[c]]
+        elif c == "raw_value" and dtype == "date":
+            keys[f"k_{c}"] = [None if pd.isna(v) else v.date().isoformat() for v in frame[c]]
+        else:
+            keys[f"k_{c}"] = [None if pd.isna(v) else str(v) for v in frame[c]]
+    return pd.DataFrame(keys, index=frame.index)
+
+
+def _sheet_keys(headers, rows, dtype):
+    """Normalised keys of sheet rows (cell tuples, without header)."""
+    if not rows:
+        return pd.DataFrame(columns=[f"k_{c}" for c in KEY_COLUMNS])
+    frame = _read_sheet([tuple(headers)] + [tuple(r) for r in rows])
+    return _key_texts(_enforce_dtypes(frame, dtype), dtype)
+
+
+def _insert_keys(con, info, dtype, row_nos, keys):
+    placeholders = ", ".join(["?"] * (2 + len(KEY_COLUMNS)))
+    cols = ", ".join(["dtype", "row_no"] + [f"k_{c}" for c in KEY_COLUMNS])
+    con.executemany(
+        f'INSERT INTO "{info["table"]}_keys" ({cols}) VALUES ({placeholders})',
+        [[dtype, row_no, *key] for row_no, key in zip(row_nos, keys.itertuples(index=False))],
+    )
+
+
+def _insert_rows(con, info, rows, exported, first_row_no, keys=None):
+    """Insert rows of cells with their keys for every dtype of the sheet (keys: dtype -> _sheet_keys, if known)."""
+    keys = {} if keys is None else keys
+    row_nos = range(first_row_no, first_row_no + len(rows))
+    placeholders = ", ".join(["?"] * (3 + len(info["columns"])))
+    cols = ", ".join(["row_no", "exported", "cell_types"] + [f'"{c}"' for c in info["columns"]])
+    records = []
+    for row_no, row in zip(row_nos, rows):
+        values, cell_types = _encode_cells(row)
+        records.append([row_no, int(exported), cell_types, *values])
+    con.executemany(f'INSERT INTO "{info["table"]}" ({cols}) VALUES ({placeholders})', records)
+
+    for dtype in info["key_dtypes"]:
+        dtype_keys = keys[dtype] if dtype in keys else _sheet_keys(info["headers"], rows, dtype)
+        _insert_keys(con, info, dtype, row_nos, dtype_keys)
+
+
+def _read_rows(con, info, where="1"):
+    """All cell tuples of a sheet table (in sheet order) matching a condition."""
+    cols = ", ".join(f'"{c}"' for c in info["columns"])
+    out = []
+    for record in con.execute(f'SELECT cell_types, {cols} FROM "{info["table"]}" WHERE {where} ORDER BY row_no'):
+        out.append(tuple(_decode_cells(record[1:], record[0])))
+    return out
+
+
+def _add_key_dtype(con, info, dtype):
+    """Normalise the keys of a sheet table for one more dtype (once; the keys of other dtypes are kept)."""
+    row_nos = [r[0] for r in con.execute(f'SELECT row_no FROM "{info["table"]}" ORDER BY row_no')]
+    _insert_keys(con, info, dtype, row_nos, _sheet_keys(info["headers"], _read_rows(con, info), dtype))
+    info["key_dtypes"] = info["key_dtypes"] + [dtype]
+    con.execute("UPDATE sheets SET key_dtypes = ? WHERE sheet = ?", (json.dumps(info["key_dtypes"]), info["sheet"]))
+
+
+# ---------------------------
+# Sync with the workbook
+# ---------------------------
+
+def _import_sheet(con, sheet_name, rows):
+    headers = list(rows[0])
+    data_rows = [tuple(r) + (None,) * (len(headers) - len(r)) for r in rows[1:]]
+
+    try:
+        old = _sheet_info(con, sheet_name)
+    except ValueError:
+        old = None
+
+    # Rows inserted by cleaning but not exported yet are kept (after the workbook's rows)
+    pending = []
+    if old is not None:
+        for r in _read_rows(con, old, where="exported = 0"):
+            by_header = dict(zip(old["headers"], r))
+            pending.append(tuple(by_header.get(h) for h in headers))
+
+    # Keys for the dtypes already used with the sheet (others are added when first cleaned against)
+    key_dtypes = old["key_dtypes"] if old is not None else []
+    table = old["table"] if old is not None else \
+        f"sheet_{con.execute('SELECT COUNT(*) FROM sheets').fetchone()[0] + 1}"
+    while old is None and con.execute("SELECT 1 FROM sheets WHERE table_name = ?", (table,)).fetchone():
+        table += "_"
+    info = {"sheet": sheet_name, "table": table, "headers": headers,
+            "columns": _column_names(headers), "key_dtypes": key_dtypes}
+
+    _create_table(con, table, info["columns"])
+    con.execute(
+        "INSERT OR REPLACE INTO sheets (sheet, table_name, headers, columns, key_dtypes) VALUES (?, ?, ?, ?, ?)",
+        (sheet_name, table, json.dumps(headers, default=str), json.dumps(info["columns"]), json.dumps(key_dtypes)),
+    )
+
+    keys = {dtype: _sheet_keys(headers, data_rows, dtype) for dtype in key_dtypes}
+    _insert_rows(con, info, data_rows, exported=True, first_row_no=1, keys=keys)
+
+    # Pending rows whose combination (with any of the sheet's dtypes) a reviewer has meanwhile added to
+    # the workbook are dropped
+    if pending:
+        keep = set(range(len(pending)))
+        pending_keys = {dtype: _sheet_keys(headers, pending, dtype) for dtype in key_dtypes}
+        for dtype in key_dtypes:
+            existing = set(keys[dtype].itertuples(index=False, name=None))
+            keep -= {i for i, k in enumerate(pending_keys[dtype].itertuples(index=False, name=None)) if k in existing}
+        keep = sorted(keep)
+        _insert_rows(con, info, [pending[i] for i in keep], exported=False, first_row_no=len(data_rows) + 1,
+                     keys={dtype: k.iloc[keep] for dtype, k in pending_keys.items()})
+
+
+def import_from_xlsx(db_path, file_name, force=False):
+    """
+    Import the cleaning sheets of a workbook into the decision store.
+
+    Sheets are replaced by the workbook's content (reviewers' decisions). Rows that
+    cleaning inserted but that were not exported yet are kept. Does nothing if the
+    workbook is unchanged since the last import or export (unless force=True).
+
+    Parameters
+    ----------
+    db_path : path-like
+        SQLite database (created if it does not exist).
+    file_name : path-like
+        Cleaning workbook. Sheets with a "raw_value" column are imported.
+    force : bool, default False
+        Import even if the workbook is unchanged.
+
+    Returns
+    -------
+    bool
+        True if the workbook was imported.
+    """
+    file_hash = hash_file(file_name)
+    with closing(_connect(db_path)) as con, con:
+        if not force and _get_meta(con, "workbook_sha256") == file_hash:
+            return False
+
+        for sheet_name, rows in workbook_snapshot.load_rows(file_name).items():
+            if rows and "raw_value" in rows[0]:
+                _import_sheet(con, sheet_name, rows)
+
+        _set_meta(con, workbook=str(file_name), workbook_sha256=file_hash)
+    return True
+
+
+def export_to_xlsx(db_path, file_name):
+    """
+    Append the rows inserted by cleaning (status "Unchecked") to the workbook, saving it once.
+
+    Raises ValueError if the workbook was edited since the last import, so that
+    exporting never works from outdated decisions (run import_from_xlsx first).
+
+    Returns
+    -------
+    int
+        Number of rows appended.
+    """
+    with closing(_connect(db_path)) as con, con:
+        synced_hash = _get_meta(con, "workbook_sha256")
+        if synced_hash is not None and hash_file(file_name) != synced_hash:
+            raise ValueError(
+                f"{file_name} was edited since the last import. Run import_from_xlsx first."
+            )
+
+        pending = {}
+        for (sheet_name,) in con.execute("SELECT sheet FROM sheets ORDER BY sheet").fetchall():
+            rows = _read_rows(con, _sheet_info(con, sheet_name), where="exported = 0")
+            if rows:
+                pending[sheet_name] = rows
+        if not pending:
+            return 0
+
+        append_rows(file_name, pending)
+
+        for sheet_name in pending:
+            con.execute(f'UPDATE "{_sheet_info(con, sheet_name)["table"]}" SET exported = 1 WHERE exported = 0')
+        _set_meta(con, workbook_sha256=hash_file(file_name))
+
+    n_rows = sum(len(rows) for rows in pending.values())
+    print(f"Appended {n_rows} new row(s) to {len(pending)} sheet(s) of {file_name}.")
+    return n_rows
+
+
+def sheet_frame(db_path, sheet_name):
+    """Return one sheet of the decision store as a DataFrame (as the workbook would show it)."""
+    with closing(_connect(db_path)) as con:
+        info = _sheet_info(con, sheet_name)
+        return pd.DataFrame(_read_rows(con, info), columns=info["headers"])
+
+
+# ---------------------------
+# Cleaning against the store
+# ---------------------------
+
+def _clean_variable(con, df, info, var_name, dtype="string", comment=False, free_text=False,
+                    mc_fc_vars=False, affected_vars=False):
+    """Steps 1-4 of clean_unique_values for one variable, with lookups and inserts in the store."""
+
+    # Step 1: Prepare the data for merging with the cleaning sheet
+    df, df_subset, merge_cols, rename_back_dict = _prepare_df(df, var_name, dtype, comment, free_text, mc_fc_vars)
+
+    value_cols = ["cleaned_value", "status"] + (["affects_vars"] if affected_vars else [])
+    missing = [c for c in merge_cols + value_cols if c not in info["headers"]]
+    if missing:
+        raise ValueError(f"Sheet {info['sheet']} is missing column(s): {missing}")
+    if dtype not in info["key_dtypes"]:
+        _add_key_dtype(con, info, dtype)
+
+    # Step 2: Look up all key combinations of the dataset (incl. all-missing keys, which the
+    # workbook merge also matches) in the sheet table; all matches per key, in sheet order
+    df_keys = _key_texts(df[merge_cols], dtype)
+    keys = df_keys.drop_duplicates()
+    key_cols = [f"k_{c}" for c in merge_cols]
+
+    con.execute("DROP TABLE IF EXISTS temp.lookup_keys")
+    con.execute(f"CREATE TEMP TABLE lookup_keys (key_id INTEGER PRIMARY KEY, {', '.join(f'{c} TEXT' for c in key_cols)})")
+    con.executemany(
+        f"INSERT INTO temp.lookup_keys VALUES (?, {', '.join(['?'] * len(key_cols))})",
+        [[i, *k] for i, k in enumerate(keys[key_cols].itertuples(index=False))],
+    )
+
+    positions = [info["headers"].index(c) for c in value_cols]
+    value_sql = ", ".join(f'd."{info["columns"][p]}"' for p in positions)
+    join_sql = " AND ".join(f"s.{c} IS k.{c}" for c in key_cols)
+    matches = {}
+    for key_id, cell_types, *values in con.execute(
+        f'SELECT k.key_id, d.cell_types, {value_sql} FROM temp.lookup_keys k '
+        f'JOIN "{info["table"]}_keys" s ON s.dtype = ? AND {join_sql} '
+        f'JOIN "{info["table"]}" d ON d.row_no = s.row_no ORDER BY k.key_id, d.row_no',
+        (dtype,),
+    ):
+        types = json.loads(cell_types) if cell_types else {}
+        decoded = [decode_value(types[str(p)], v) if str(p) in types else v for p, v in zip(positions, values)]
+        matches.setdefault(key_id, []).append(dict(zip(value_cols, decoded)))
+
+    # Step 3: Insert key combinations not in the sheet yet with status "Unchecked" (not all-missing ones)
+    key_ids = {k: i for i, k in enumerate(keys[key_cols].itertuples(index=False, name=None))}
+    subset_ids = [key_ids[k] for k in
+                  _key_texts(df_subset, dtype)[key_cols].itertuples(index=False, name=None)]
+    new_positions = [p for p, i in enumerate(subset_ids) if i not in matches]
+    new_ids = [subset_ids[p] for p in new_positions]
+
+    new_rows = df_subset.iloc[new_positions].copy()
+    new_rows["cleaned_value"] = ""
+    new_rows["status"] = "Unchecked"
+    if affected_vars:
+        new_rows["affects_vars"] = pd.NA
+    if new_ids:
+        rows = [tuple(workbook_snapshot.read_back_value(v) for v in r)
+                for r in _rows_to_append(new_rows, info["headers"]).itertuples(index=False, name=None)]
+        next_row_no = con.execute(f'SELECT COALESCE(MAX(row_no), 0) + 1 FROM "{info["table"]}"').fetchone()[0]
+        _insert_rows(con, info, rows, exported=False, first_row_no=next_row_no)
+
+    # Step 4: Create clean and status variables from the first match of each key (or the new row)
+    lookup_parts = [pd.DataFrame([{"key_id": i, **m[0]} for i, m in matches.items()],
+                                 columns=["key_id"] + value_cols)]
+    if new_ids:
+        lookup_parts.append(new_rows[value_cols].assign(key_id=new_ids)[["key_id"] + value_cols])
+    lookup_df = pd.concat([p for p in lookup_parts if len(p)], ignore_index=True) \
+        if any(len(p) for p in lookup_parts) else lookup_parts[0]
+    lookup_df = keys.assign(key_id=range(len(keys))).merge(lookup_df, on="key_id").drop(columns="key_id")
+
+    df = df.assign(**{c: df_keys[c].to_numpy() for c in key_cols})
+    df = _merge_lookup(df, lookup_df[key_cols + value_cols], key_cols, rename_back_dict, var_name, affected_vars)
+    df = df.drop(columns=key_cols)
+
+    # Statuses of all matches of the dataset's combinations (as in the workbook merge), for the report
+    statuses = [m["status"] for i in subset_ids if i in matches for m in matches[i]]
+    merged_df = pd.DataFrame({"status": statuses + ["Unchecked"] * len(new_ids)})
+    return df, merged_df
+
+
+@profiled(file_args=("db_path",))
+def clean_unique_values_db(df, db_path, variables, report=False):
+    """
+    Clean the unique values of many variables against the decision store.
+
+    Same result as clean_unique_values_batch against the workbook the store was
+    imported from, but new combinations are inserted into the store (export them
+    with export_to_xlsx) and lookups are SQL joins on indexed keys.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Main dataset.
+    db_path : path-like
+        Decision store (see import_from_xlsx).
+    variables : list[dict]
+        As in clean_unique_values_batch.
+    report : bool, default False
+        Print the cleaning progress of every variable (unless set per variable).
+
+    Returns
+    -------
+    pd.DataFrame
+        df with the *_clean, *_status (and *_aff_vars) columns of all variables.
+    """
+    with closing(_connect(db_path)) as con, con:
+        for spec in variables:
+            spec = dict(spec)
+            var_name = spec.pop("var_name")
+            sheet_name = spec.pop("sheet_name", var_name)
+            var_report = spec.pop("report", report)
+
+            info = _sheet_info(con, sheet_name)
+            df, merged_df = _clean_variable(con, df, info, var_name, **spec)
+
+            if var_report:
+                _print_report(var_name, merged_df)
+    return df
@@ -0,0 +1,315 @@
+# Annual energy use formulas per equipment type (used in 2_5_energy_use_formulas):
+#   (1) One vectorized formula per equipment type, registered in ENERGY_FORMULAS under its "equipment" value.
+#       Each formula gets the columns of the rows of its equipment type only (merged with the calculator
+#       values and penalties) as numpy arrays and returns their annual electricity use and, where it
+#       applies, gas use (kWh/year). The formulas only use elementwise numpy operations, so the columns
+#       may also be 2-D (rows × scenarios, see energy_scenarios.py) and the results broadcast
+#   (2) compute_energy_use: split the dataset by equipment type once, evaluate each type's formula on
+#       its rows and put the results back in the dataset's row order
+# Rows of equipment types without a formula (or not covered by their formula, e.g. an unexpected
+# controller type) get NaN, and so does gas use of equipment types without gas use.
+
+import numpy as np
+import pandas as pd
+
+HOURS_PER_YEAR = 24 * 365   # 8760
+
+
+def _fill_missing(values, fill_value):
+    """values with missing values replaced by fill_value (fillna for arrays)."""
+    return np.where(pd.isna(values), fill_value, values)
+
+
+def _contains(values, pattern):
+    """Whether each value is a string containing pattern (str.contains with na=False, any shape)."""
+    values = np.asarray(values, dtype=object)
+    flat = pd.Series(values.ravel(), dtype=object).str.contains(pattern, na=False)
+    return flat.to_numpy(dtype=bool).reshape(values.shape)
+
+
+# ---------------------------
+# (1a) Always-on equipment
+# ---------------------------
+
+def fridge_energy(d, **params):
+    """
+    Fridges: Annual = 365 × 24 × Hourly_Baseline × (1 + Minutes_Open_Per_Day × Door_Opening_Penalty).
+
+    Assumes that the number of openings equals the minutes open.
+    """
+    door_term = d["door_openings"] * d["door_opening_penalty_xbl_xminutes_open"]
+    return 365 * 24 * d["electricity_use_kwh_per_hour"] * (1 + door_term), None
+
+
+def freezer_energy(d, **params):
+    """
+    Freezers: Annual = Hourly_Baseline × Ice_Penalty × HFC_Penalty × 365 × (24 + Door_Term).
+
+    Door_Term is Minutes_Open × Door_Opening_Penalty, with an extra No_Drawers_Penalty multiplier
+    for upright freezers without (most) drawers. Assumes that the number of openings equals the
+    minutes open.
+    """
+    no_drawers_applies = (
+        (d["size_freezer_1"] == "Upright") &
+        (d["drawers"] == "No there are no drawers or most are missing")
+    )
+    door_term = np.where(
+        no_drawers_applies,
+        d["door_openings"] * d["no_drawers_penalty_xblx_minutes_open"] * d["door_opening_penalty_xbl_xminutes_open"],
+        d["door_openings"] * d["door_opening_penalty_xbl_xminutes_open"],
+    )
+    ice_factor = np.where(d["icing"] == "Yes, iced up", d["ice_penalty_xbl"], 1.0)
+    hfc_factor = np.where(_contains(d["refrigerant"], "HFCs"), d["hfc_not_hc_coolant_penalty_xbl"], 1.0)
+
+    return d["electricity_use_kwh_per_hour"] * ice_factor * hfc_factor * 365 * (24 + door_term), None
+
+
+def ult_energy(d, **params):
+    """
+    ULT freezers: Annual = 365 × 24 × Hourly_Baseline × Condition_Factor × (1 + Minutes_Open × Door_Opening_Penalty).
+
+    The penalties for damaged seals, no spacing and clogged filters are not multiplied: each
+    combination of conditions has its own factor. Assumes that the number of openings equals
+    the minutes open.
+    """
+    seals = d["damaged_seals_penalty"] == 1
+    spacing = d["no_spacing_penalty"] == 1
+    clogged = d["clogged_filter_penalty"] == 1
+
+    # Factor column of each combination of conditions (no condition: 1.0)
+    condition_factor = np.select(
+        [
+            seals & ~spacing & ~clogged,
+            ~seals & spacing & ~clogged,
+            ~seals & ~spacing & clogged,
+            ~seals & spacing & clogged,
+            seals & ~spacing & clogged,
+            seals & spacing & ~clogged,
+            seals & spacing & clogged,
+        ],
+        [
+            d["damaged_seals_penalty_xbl"],
+            d["no_spacing_penalty_xbl"],
+            d["clogged_filters_penalty_xbl"],
+            d["no_spacing_and_clogged_filters_penalty_xbl"],
+            d["damaged_seals_and_clogged_filters_penalty"],
+            d["damaged_seals_and_no_spacing_penalty_xbl"],
+            d["no_spacing_and_clogged_filters_and_damaged_seal_penalty_xbl"],
+        ],
+        default=1.0,
+    )
+    door_term = d["door_openings"] * d["door_opening_penalty_xbl_xminutes_open"]
+    return 365 * 24 * d["electricity_use_kwh_per_hour"] * condition_factor * (1 + door_term), None
+
+
+def incubator_energy(d, **params):
+    """CO2 incubators (always on, no penalties): Annual = 8760 × Hourly_Energy_Use."""
+    return HOURS_PER_YEAR * d["electricity_use_kwh_per_hour"], None
+
+
+# ---------------------------
+# (1b) Usage-based equipment
+# ---------------------------
+
+def bath_energy(d, **params):
+    """Water baths: Annual = Hours × Days × Hourly × Lid_Off_Penalty × Bead_Penalty."""
+    lid_factor = np.where(d["lid_off_penalty"] == 1, _fill_missing(d["lid_off_penalty_xbl"], 1.0), 1.0)
+    bead_factor = np.where(d["beads_penalty"] == 1, _fill_missing(d["beads_not_water_penalty_xbl"], 1.0), 1.0)
+    return d["hours"] * d["days"] * d["electricity_use_kwh_per_hour"] * lid_factor * bead_factor, None
+
+
+def usage_energy(d, **params):
+    """Heat blocks and IT equipment (no penalties): Annual = Hours × Days × Hourly_Energy_Use."""
+    return d["hours"] * d["days"] * d["electricity_use_kwh_per_hour"], None
+
+
+def cryostat_energy(d, **params):
+    """
+    Cryostats.
+
+    No energy-saving mode:   Annual = 8760 × Hourly
+    With energy-saving mode: Annual = (Hours × Days × Hourly) + ((8760 - Hours × Days) × Hourly × Standby_Penalty)
+    """
+    hourly = d["electricity_use_kwh_per_hour"]
+    usage_hours = d["hours"] * d["days"]
+
+    electricity = np.select(
+        [d["sleep_mode"] == "No Energy Saving Mode Available", d["sleep_mode"] == "Energy Saving Mode Available"],
+        [HOURS_PER_YEAR * hourly, usage_hours * hourly + (HOURS_PER_YEAR - usage_hours) * hourly * d["standby_penalty"]],
+        default=np.nan,
+    )
+    return electricity, None
+
+
+def glassware_energy(d, **params):
+    """Drying cabinets (glassware): Annual = Hours × Days × Hourly × Fan_Penalty_Multiplier."""
+    fan_factor = np.where(d["fan_penalty"] == 1, _fill_missing(d["fan_penalty_xbl"], 1.0), 1.0)
+    return d["hours"] * d["days"] * d["electricity_use_kwh_per_hour"] * fan_factor, None
+
+
+def microbio_energy(d, **params):
+    """
+    Microbial safety cabinets.
+
+    Electricity: Hours × Days × Hourly × Ducted_Electricity_Penalty (penalty = 1 if not ducted)
+    Gas (ducted only): Hours × Days × Ducted_Gas_Use_Per_Hour, 0 if not ducted
+    """
+    is_ducted = d["ducting_penalty"] == 1
+    ducting_factor = np.where(is_ducted, d["ducted_electricity_penalty_xbl"], 1.0)
+
+    electricity = d["hours"] * d["days"] * d["electricity_use_kwh_per_hour"] * ducting_factor
+    gas = np.where(is_ducted, d["hours"] * d["days"] * d["ducted_gas_penalty_additional_kwh_per_hour"], 0.0)
+    return electricity, gas
+
+
+# ---------------------------
+# (1c) Fume cupboards
+# ---------------------------
+
+def fc_energy(d, elec_per_m3, gas_per_m3, **params):
+    """
+    Fume cupboards: annual air volume extracted × energy per m³ (electricity and gas).
+
+    Sash height 0.5 m (fixed), sash width = survey width - 0.3 m, tested face velocity = survey
+    velocity × 1.075, so Q = velocity × 0.5 × width (m³/s).
+    CAV: constant flow 24/7, Volume = Q × 3600 × 8760
+    VAV: open at design volume (with loading), closed at 25% flow,
+         Volume = (Open_Hours × Q × (1 + Loading_Factor) + Closed_Hours × Q × 0.25) × 3600,
+         Loading_Factor = surface × 1.1 × (0 if contents raised, else 1)
+    """
+    sash_width = d["sash_width"] - 0.3              # m
+    face_vel = d["face_velocity_m/s"] * 1.075       # m/s (tested)
+    Q = face_vel * (0.5 * sash_width)               # m³/s
+
+    cav_volume = Q * 3600 * HOURS_PER_YEAR          # m³/year
+
+    loading_factor = d["surface"] * 1.1 * np.where(d["lifted"] == "Yes", 0, 1)
+    open_hours = d["hours_open"] * d["days"]
+    closed_hours = HOURS_PER_YEAR - open_hours
+    vav_volume = ((open_hours * Q * (1 + loading_factor)) + (closed_hours * Q * 0.25)) * 3600
+
+    volume = np.select(
+        [d["controller_type"] == "CAV", d["controller_type"] == "VAV"],
+        [cav_volume, vav_volume],
+        default=np.nan,
+    )
+    return volume * elec_per_m3, volume * gas_per_m3
+
+
+# Formula of each equipment type ("equipment" value -> formula)
+ENERGY_FORMULAS = {
+    "fridge": fridge_energy,
+    "freezer": freezer_energy,
+    "ult": ult_energy,
+    "incubator": incubator_energy,
+    "bath": bath_energy,
+    "heater": usage_energy,
+    "it": usage_energy,
+    "cryostat": cryostat_energy,
+    "glassware": glassware_energy,
+    "microbio": microbio_energy,
+    "fc": fc_energy,
+}
+
+
+# ---------------------------
+# (2) Evaluating the formulas
+# ---------------------------
+
+def _column_values(column):
+    """Values of a column as a numpy array: floats for numeric columns (NA -> NaN), objects otherwise."""
+    if pd.api.types.is_bool_dtype(column.dtype):
+        return column.to_numpy(dtype=bool)
+    if pd.api.types.is_numeric_dtype(column.dtype):
+        return column.to_numpy(dtype=float, na_value=np.nan)
+    return column.to_numpy(dtype=object)
+
+
+class _ColumnArrays(dict):
+    """
+    Columns of some rows of a dataset as numpy arrays, read when a formula first uses them.
+
+    Without overrides each column is a 1-D array. With overrides (one dict of
+    {column: value} per scenario) each column is 2-D: overridden columns have one column of
+    values per scenario (rows × scenarios), all others a single column (rows × 1) that
+    broadcasts against them, so the base values are not copied per scenario.
+    An override value is a scalar (all rows), a dict {equipment type: scalar} (rows of these
+    types) or an array with one value per row of the dataset.
+    """
+
+    def __init__(self, df, positions, equipment_value, overrides=None):
+        super().__init__()
+        self.df = df
+        self.positions = positions
+        self.equipment_value = equipment_value
+        self.overrides = overrides
+
+    def __missing__(self, col):
+        values = _column_values(self.df[col].iloc[self.positions])
+        if self.overrides is not None:
+            overridden = [i for i, o in enumerate(self.overrides) if col in o]
+            if overridden:
+                base = values
+                values = np.empty((len(base), len(self.overrides)), dtype=base.dtype)
+                values[:] = base[:, None]
+                for i in overridden:
+                    value = self.overrides[i][col]
+                    if isinstance(value, dict):
+                        if self.equipment_value not in value:
+                            continue
+                        value = value[self.equipment_value]
+                    elif np.ndim(value) == 1:
+                        value = np.asarray(value)[self.positions]
+                    values[:, i] = value
+            else:
+                values = values[:, None]
+        self[col] = values
+        return values
+
+
+def _formula_values(values, shape):
+    """Formula result as a float array of the given shape (None -> all NaN)."""
+    if values is None:
+        return np.full(shape, np.nan)
+    return np.broadcast_to(np.asarray(values, dtype=float), shape)
+
+
+def compute_energy_use(df, elec_per_m3, gas_per_m3, equipment_col="equipment", formulas=None):
+    """
+    Annual electricity and gas use per unit of every row, with the formula of its equipment type.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Panel merged with the equipment calculators (one row per equipment type entry).
+    elec_per_m3, gas_per_m3 : float
+        Electricity and gas use per m³ of extracted air (kWh/m³), for fume cupboards.
+    equipment_col : str
+        Column with the equipment type.
+    formulas : dict, optional
+        Equipment type -> formula, defaults to ENERGY_FORMULAS.
+
+    Returns
+    -------
+    pd.DataFrame
+        electricity_use_kwh_year and gas_use_kwh_year, with the index of df.
+    """
+    formulas = ENERGY_FORMULAS if formulas is None else formulas
+
+    electricity = np.full(len(df), np.nan)
+    gas = np.full(len(df), np.nan)
+
+    # Row positions of each equipment type (one pass over the equipment column)
+    for equipment_value, positions in df.groupby(equipment_col, sort=False).indices.items():
+        formula = formulas.get(equipment_value)
+        if formula is None:
+            continue
+        columns = _ColumnArrays(df, positions, equipment_value)
+        elec_values, gas_values = formula(columns, elec_per_m3=elec_per_m3, gas_per_m3=gas_per_m3)
+        electricity[positions] = _formula_values(elec_values, len(positions))
+        gas[positions] = _formula_values(gas_values, len(positions))
+
+    return pd.DataFrame(
+        {"electricity_use_kwh_year": electricity, "gas_use_kwh_year": gas},
+        index=df.index,
+    )
@@ -0,0 +1,104 @@
+# Counterfactual scenarios for annual energy use (e.g. "all ULTs with clean filters", "all baths with lids"):
+#   (1) Each scenario is a set of overrides of the panel's columns (penalty flags, hours/days, baselines, ...)
+#   (2) All scenarios are evaluated at once: the formulas of energy_formulas.py get rows × scenarios arrays
+#       for overridden columns and rows × 1 arrays for all other columns, so the base panel is not copied
+#       per scenario and each formula runs once per equipment type
+#   (3) The results are summed per lab into a tidy table (one row per lab and scenario) of annual kWh and CO2
+# Setpoints affect energy use through the calculator baseline, so a setpoint scenario overrides the
+# baseline column (electricity_use_kwh_per_hour) with the calculator value at the new setpoint.
+
+import numpy as np
+import pandas as pd
+
+from energy_formulas import ENERGY_FORMULAS, _ColumnArrays, _formula_values
+
+
+def evaluate_scenarios(
+    df,
+    scenarios,
+    elec_per_m3,
+    gas_per_m3,
+    co2_per_kwh_electricity,
+    co2_per_kwh_gas,
+    group_cols="labgroupid",
+    equipment_col="equipment",
+    number_col="number",
+    formulas=None,
+):
+    """
+    Annual energy use and CO2 emissions per lab under several scenarios, in one batched pass.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Panel merged with the equipment calculators, as used in 2_5_energy_use_formulas.
+    scenarios : dict
+        Scenario name -> overrides {column: value}, {} for the panel as it is. A value is a
+        scalar (all rows), a dict {equipment type: scalar} (only rows of these types) or an
+        array with one value per row of df, e.g.
+        {"baseline": {},
+         "clean ULT filters": {"clogged_filter_penalty": {"ult": 0}},
+         "bath lids on": {"lid_off_penalty": {"bath": 0}},
+         "baths 4h/day": {"hours": {"bath": 4}}}
+    elec_per_m3, gas_per_m3 : float
+        Electricity and gas use per m³ of extracted air (kWh/m³), for fume cupboards.
+    co2_per_kwh_electricity, co2_per_kwh_gas : float
+        Emission factors (kg CO2e per kWh).
+    group_cols : str or list
+        Columns identifying a lab in the output, e.g. ["labgroupid", "survey"].
+    equipment_col, number_col : str
+        Columns with the equipment type and the number of units.
+    formulas : dict, optional
+        Equipment type -> formula, defaults to energy_formulas.ENERGY_FORMULAS.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per lab and scenario (labs sorted, scenarios in the given order) with
+        electricity_use_kwh_year, gas_use_kwh_year, total_energy_kwh_year and co2_kg_year.
+        Units are counted number_col times; rows without an energy value (no formula for
+        their type) are left out of the sums, gas use counts as 0 for equipment without gas.
+    """
+    formulas = ENERGY_FORMULAS if formulas is None else formulas
+    if isinstance(group_cols, str):
+        group_cols = [group_cols]
+    names = list(scenarios)
+    overrides = [scenarios[name] for name in names]
+
+    # Annual use of every unit type (rows × scenarios), each formula evaluated once for all scenarios
+    shape = (len(df), len(names))
+    electricity = np.full(shape, np.nan)
+    gas = np.full(shape, np.nan)
+    number = np.full(shape, np.nan)
+    for equipment_value, positions in df.groupby(equipment_col, sort=False).indices.items():
+        columns = _ColumnArrays(df, positions, equipment_value, overrides)
+        number[positions] = _formula_values(columns[number_col], (len(positions), len(names)))
+        formula = formulas.get(equipment_value)
+        if formula is None:
+            continue
+        elec_values, gas_values = formula(columns, elec_per_m3=elec_per_m3, gas_per_m3=gas_per_m3)
+        electricity[positions] = _formula_values(elec_values, (len(positions), len(names)))
+        gas[positions] = _formula_values(gas_values, (len(positions), len(names)))
+
+    # Totals over units, summed per lab (groups × scenarios)
+    labs = df.groupby(group_cols, sort=True)
+    codes = labs.ngroup().to_numpy()
+
+    def lab_sums(values):
+        return pd.DataFrame(values).groupby(codes).sum().to_numpy()
+
+    electricity_lab = lab_sums(electricity * number)
+    gas_lab = lab_sums(np.where(np.isnan(gas), 0.0, gas) * number)
+
+    # Tidy table: one row per lab and scenario
+    lab_keys = labs.size().index.to_frame(index=False)
+    out = lab_keys.loc[lab_keys.index.repeat(len(names))].reset_index(drop=True)
+    out["scenario"] = np.tile(names, len(lab_keys))
+    out["electricity_use_kwh_year"] = electricity_lab.ravel()
+    out["gas_use_kwh_year"] = gas_lab.ravel()
+    out["total_energy_kwh_year"] = out["electricity_use_kwh_year"] + out["gas_use_kwh_year"]
+    out["co2_kg_year"] = (
+        out["electricity_use_kwh_year"] * co2_per_kwh_electricity
+        + out["gas_use_kwh_year"] * co2_per_kwh_gas
+    )
+    return out
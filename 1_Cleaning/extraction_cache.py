@@ -0,0 +1,345 @@
+# Functions to cache the records extracted from lab workbooks between runs:
+#   (1) Key each lab file by the sha256 of its content plus a hash of the extraction settings
+#       (extraction function, the source of its module and its arguments, e.g. the survey dictionary rows / cell specs),
+#       so that editing the extraction code (e.g. survey_extraction.py) re-extracts all labs
+#   (2) Store the records of all labs in one long-format Parquet file per cache name
+#       (one row per lab, record and variable, values stored as type-tagged strings)
+#   (3) Re-extract (via extract_labs) only labs whose file or settings changed since the last run
+#   (4) Report cache statistics and invalidate single labs
+
+import datetime
+import functools
+import hashlib
+import inspect
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from parallel_extraction import extract_labs
+
+# Bump to invalidate all caches when the stored format changes (changes to the extraction code are detected
+# through the source hash in hash_settings)
+CACHE_VERSION = 1
+
+RECORD_COLUMNS = ["labgroupid", "record_no", "var_name", "value_type", "value"]
+
+
+# ---------------------------
+# Hashing
+# ---------------------------
+
+def hash_file(path, chunk_size=1 << 20):
+    """Return the sha256 hex digest of a file's content."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _json_default(obj):
+    if isinstance(obj, pd.DataFrame):
+        return obj.to_json(orient="split", date_format="iso")
+    if isinstance(obj, pd.Series):
+        return obj.to_json(orient="split", date_format="iso")
+    return repr(obj)
+
+
+@functools.lru_cache(maxsize=None)
+def hash_source(func):
+    """
+    Return the sha256 of the source of the module defining func (the function itself if the module
+    source is not available), so that changes to the function or its helpers in the same module
+    (e.g. read_survey_cells and the rest of survey_extraction.py) change the settings hash.
+    """
+    module = inspect.getmodule(func)
+    try:
+        source = inspect.getsource(module) if module is not None else inspect.getsource(func)
+    except (OSError, TypeError):
+        try:
+            source = inspect.getsource(func)
+        except (OSError, TypeError):
+            source = ""
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def hash_settings(func, kwargs):
+    """Return a hash of the extraction function, its source and its arguments."""
+    payload = {
+        "version": CACHE_VERSION,
+        "func": f"{func.__module__}.{func.__qualname__}",
+        "source": hash_source(func),
+        "kwargs": kwargs,
+    }
+    text = json.dumps(payload, sort_keys=True, default=_json_default)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# ---------------------------
+# Value encoding (keeps the Python type of extracted values through Parquet)
+# ---------------------------
+
+def encode_value(v):
+    """Encode a cell value as a (type tag, string) pair."""
+    if v is None:
+        return "none", ""
+    if v is pd.NA:
+        return "na", ""
+    if v is pd.NaT:
+        return "nat", ""
+    if isinstance(v, (np.integer, np.floating, np.bool_)):
+        if isinstance(v, np.floating) and np.isnan(v):
+            return f"np.{type(v).__name__}", "nan"
+        return f"np.{type(v).__name__}", repr(v.item())
+    if isinstance(v, np.datetime64):
+        return "np.datetime64", str(v)
+    if isinstance(v, np.generic):
+        return encode_value(v.item())
+    if isinstance(v, bool):
+        return "bool", str(v)
+    if isinstance(v, str):
+        return "str", v
+    if isinstance(v, int):
+        return "int", str(v)
+    if isinstance(v, float):
+        return "float", "nan" if math.isnan(v) else repr(v)
+    if isinstance(v, pd.Timestamp):
+        return "timestamp", v.isoformat()
+    if isinstance(v, datetime.datetime):
+        return "datetime", v.isoformat()
+    if isinstance(v, datetime.date):
+        return "date", v.isoformat()
+    if isinstance(v, datetime.time):
+        return "time", v.isoformat()
+    if isinstance(v, datetime.timedelta):
+        return "timedelta", repr(v.total_seconds())
+    raise TypeError(f"Cannot cache value of type {type(v).__name__}: {v!r}")
+
+
+_DECODERS = {
+    "none": lambda s: None,
+    "na": lambda s: pd.NA,
+    "nat": lambda s: pd.NaT,
+    "bool": lambda s: s == "True",
+    "str": lambda s: s,
+    "int": int,
+    "float": float,
+    "timestamp": pd.Timestamp,
+    "datetime": datetime.datetime.fromisoformat,
+    "date": datetime.date.fromisoformat,
+    "time": datetime.time.fromisoformat,
+    "timedelta": lambda s: datetime.timedelta(seconds=float(s)),
+    "np.datetime64": np.datetime64,
+}
+
+
+def decode_value(value_type, s):
+    """Decode a (type tag, string) pair written by encode_value."""
+    if value_type in _DECODERS:
+        return _DECODERS[value_type](s)
+    if value_type.startswith("np."):
+        scalar_type = getattr(np, value_type[3:])
+        if issubclass(scalar_type, np.bool_):
+            return scalar_type(s == "True")
+        if issubclass(scalar_type, np.floating):
+            return scalar_type(float(s))
+        return scalar_type(int(s))
+    raise ValueError(f"Unknown cached value type: {value_type}")
+
+
+# ---------------------------
+# Storage
+# ---------------------------
+
+def _paths(cache_dir, name):
+    return (
+        os.path.join(cache_dir, f"{name}.parquet"),
+        os.path.join(cache_dir, f"{name}_manifest.json"),
+    )
+
+
+def _load(cache_dir, name):
+    """Return (manifest, records_df) for one cache (empty if not created yet)."""
+    records_path, manifest_path = _paths(cache_dir, name)
+
+    if not (os.path.exists(records_path) and os.path.exists(manifest_path)):
+        return {}, pd.DataFrame(columns=RECORD_COLUMNS)
+
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != CACHE_VERSION:
+        return {}, pd.DataFrame(columns=RECORD_COLUMNS)
+
+    return manifest["labs"], pd.read_parquet(records_path)
+
+
+def _save(cache_dir, name, labs, records_df):
+    """Write the records and manifest of one cache (atomically, via temporary files)."""
+    os.makedirs(cache_dir, exist_ok=True)
+    records_path, manifest_path = _paths(cache_dir, name)
+
+    records_df = records_df[RECORD_COLUMNS].reset_index(drop=True)
+    records_df.to_parquet(records_path + ".tmp", index=False)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"version": CACHE_VERSION, "labs": labs}, f, indent=1)
+
+    os.replace(records_path + ".tmp", records_path)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def _encode_records(labgroupid, records):
+    rows = []
+    for record_no, record in enumerate(records):
+        for var_name, v in record.items():
+            value_type, value = encode_value(v)
+            rows.append((str(labgroupid), record_no, var_name, value_type, value))
+    return rows
+
+
+def _decode_records(lab_rows):
+    """Rebuild the list of record dicts of one lab (variables in their original order)."""
+    records = []
+    for record_no, var_name, value_type, value in zip(
+        lab_rows["record_no"], lab_rows["var_name"], lab_rows["value_type"], lab_rows["value"]
+    ):
+        while len(records) <= record_no:
+            records.append({})
+        records[record_no][var_name] = decode_value(value_type, value)
+    return records
+
+
+# ---------------------------
+# Cached extraction
+# ---------------------------
+
+def cached_extract_labs(cache_dir, name, labgroupids, paths, func, kwargs=None, max_workers=None):
+    """
+    Run extract_labs, re-reading only labs whose file or extraction settings changed.
+
+    Parameters
+    ----------
+    cache_dir : path-like
+        Folder holding the cache files (e.g. config.EXTRACTION_CACHE).
+    name : str
+        Cache name, one per kind of extraction (e.g. "bl_survey", "el_equipment").
+    labgroupids, paths, func, kwargs, max_workers
+        As in parallel_extraction.extract_labs.
+
+    Returns
+    -------
+    list[dict]
+        Per-lab results as returned by extract_labs (same order as labgroupids),
+        with an additional "cached" key (True if the records came from the cache).
+        Only labs read without any error are stored in the cache.
+    """
+    if kwargs is None:
+        kwargs = {}
+    if isinstance(kwargs, dict):
+        kwargs = [kwargs] * len(labgroupids)
+
+    cached_labs, records_df = _load(cache_dir, name)
+
+    # Keys of the current files and settings (settings hashed once per distinct kwargs object)
+    settings_hashes = {}
+    keys = []
+    for path, kw in zip(paths, kwargs):
+        if id(kw) not in settings_hashes:
+            settings_hashes[id(kw)] = hash_settings(func, kw)
+        file_hash = hash_file(path) if os.path.exists(path) else None
+        keys.append({"file_hash": file_hash, "settings_hash": settings_hashes[id(kw)]})
+
+    # Split into cache hits and labs to (re-)extract
+    hits = {}
+    to_extract = []
+    rows_by_lab = {lab: rows for lab, rows in records_df.groupby("labgroupid", sort=False)}
+    for i, (labgroupid, key) in enumerate(zip(labgroupids, keys)):
+        entry = cached_labs.get(str(labgroupid))
+        if key["file_hash"] is not None and entry is not None and entry["file_hash"] == key["file_hash"] \
+                and entry["settings_hash"] == key["settings_hash"]:
+            lab_rows = rows_by_lab.get(str(labgroupid), records_df.iloc[0:0])
+            hits[i] = {
+                "labgroupid": labgroupid,
+                "path": str(paths[i]),
+                "status": "ok",
+                "records": _decode_records(lab_rows),
+                "errors": [],
+                "cached": True,
+            }
+        else:
+            to_extract.append(i)
+
+    extracted = extract_labs(
+        [labgroupids[i] for i in to_extract],
+        [paths[i] for i in to_extract],
+        func,
+        kwargs=[kwargs[i] for i in to_extract],
+        max_workers=max_workers,
+    )
+
+    # Update the cache with the newly extracted labs
+    if to_extract:
+        stale = set()
+        new_rows = []
+        for i, result in zip(to_extract, extracted):
+            result["cached"] = False
+            stale.add(str(labgroupids[i]))
+            cached_labs.pop(str(labgroupids[i]), None)
+
+            if result["status"] == "ok" and not result["errors"]:
+                cached_labs[str(labgroupids[i])] = {"path": str(paths[i]), **keys[i]}
+                new_rows.extend(_encode_records(labgroupids[i], result["records"]))
+
+        records_df = pd.concat(
+            [
+                records_df[~records_df["labgroupid"].isin(stale)],
+                pd.DataFrame(new_rows, columns=RECORD_COLUMNS),
+            ],
+            ignore_index=True,
+        )
+        _save(cache_dir, name, cached_labs, records_df)
+
+    results = [None] * len(labgroupids)
+    for i, result in hits.items():
+        results[i] = result
+    for i, result in zip(to_extract, extracted):
+        results[i] = result
+    return results
+
+
+def cache_stats(cache_dir, name, results=None):
+    """
+    Return statistics of one cache.
+
+    If the results of the last cached_extract_labs call are given, also
+    report the number of cache hits and of labs that were re-extracted.
+    """
+    records_path, _ = _paths(cache_dir, name)
+    labs, records_df = _load(cache_dir, name)
+
+    stats = {
+        "name": name,
+        "labs": len(labs),
+        "records": int(records_df.groupby("labgroupid")["record_no"].nunique().sum()) if len(records_df) else 0,
+        "values": len(records_df),
+        "size_bytes": os.path.getsize(records_path) if os.path.exists(records_path) else 0,
+    }
+    if results is not None:
+        stats["hits"] = sum(bool(r.get("cached")) for r in results)
+        stats["extracted"] = sum(not r.get("cached") and r["status"] != "missing" for r in results)
+        stats["missing"] = sum(r["status"] == "missing" for r in results)
+    return stats
+
+
+def invalidate_lab(cache_dir, name, labgroupid):
+    """Remove one lab from a cache so that its file is re-extracted on the next run."""
+    labs, records_df = _load(cache_dir, name)
+    if str(labgroupid) not in labs:
+        return False
+
+    labs.pop(str(labgroupid))
+    records_df = records_df[records_df["labgroupid"] != str(labgroupid)]
+    _save(cache_dir, name, labs, records_df)
+    return True
@@ -1,60 +1,115 @@
-def fill_with_equipment_mode(
+def _group_modes(frame, group_cols, value_col):
+    """
+    Mode of value_col within each group of group_cols (one row per group).
+
+    Counts every (group, value) combination in one groupby pass and keeps the most
+    frequent value of each group; among equally frequent values the smallest is kept,
+    as Series.mode().iloc[0] does.
+    """
+    counts = (
+        frame.groupby(group_cols + [value_col], dropna=False, sort=True)
+        .size()
+        .reset_index(name="_count")
+    )
+    # Stable sort: within a group, equally frequent values stay in ascending order
+    counts = counts.sort_values("_count", ascending=False, kind="stable")
+    return counts.drop_duplicates(subset=group_cols)[group_cols + [value_col]]
+
+
+def fill_with_equipment_modes(
     df,
-    value_col,
-    equipment_value,
+    value_cols,
     equipment_col="equipment",
     unknown_value="Unknown",
     groupby_cols=None,
     fallback_to_equipment_mode=True,
 ):
     """
-    Fill missing/Unknown values in value_col for one equipment type.
+    Fill missing/Unknown values in several value columns for several equipment types.
 
-    By default, fills using the mode within the selected equipment type.
-    Optionally, compute mode within additional grouping column(s), e.g.:
-    groupby_cols="institute" or groupby_cols=["institute", "survey"].
+    Same as calling fill_with_equipment_mode for every (equipment type, value column)
+    pair, but the modes of each value column are computed for all its equipment types
+    in one groupby pass and broadcast back with one merge.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Panel dataset (modified in place and returned).
+    value_cols : dict
+        Equipment type -> value column(s) to fill for that type,
+        e.g. {"fc": ["hours_open", "surface"], "freezer": "drawers"}.
+    equipment_col : str
+        Column with the equipment type.
+    unknown_value : str
+        Value treated as missing (in addition to NA).
+    groupby_cols : str or list, optional
+        Compute the mode within these groups (per equipment type), e.g. "institute_id".
+    fallback_to_equipment_mode : bool
+        With groupby_cols, fill rows whose group has no valid value with the mode of
+        the equipment type.
     """
-    is_target_equipment = df[equipment_col] == equipment_value
-    valid = is_target_equipment & df[value_col].notna() & (df[value_col] != unknown_value)
+    if isinstance(groupby_cols, str):
+        groupby_cols = [groupby_cols]
+    group_cols = [equipment_col] + list(groupby_cols or [])
 
-    if not valid.any():
-        return df
+    # Equipment types to fill for each value column
+    equipment_by_col = {}
+    for equipment_value, cols in value_cols.items():
+        for col in [cols] if isinstance(cols, str) else cols:
+            equipment_by_col.setdefault(col, []).append(equipment_value)
 
-    fill_mask = is_target_equipment & (
-        df[value_col].isna() | (df[value_col] == unknown_value)
-    )
-    if not fill_mask.any():
-        return df
+    for value_col, equipment_values in equipment_by_col.items():
+        is_target_equipment = df[equipment_col].isin(equipment_values)
+        missing = df[value_col].isna() | (df[value_col] == unknown_value)
+        valid = is_target_equipment & ~missing
+        fill_mask = is_target_equipment & missing
+        if not valid.any() or not fill_mask.any():
+            continue
 
-    # Backwards-compatible path: equipment-level mode only.
-    if groupby_cols is None:
-        mode = df.loc[valid, value_col].mode().iloc[0]
-        df.loc[fill_mask, value_col] = mode
-        return df
+        # Mode within each group (equipment type and groupby_cols), one merge back to the rows to fill
+        valid_rows = df.loc[valid, group_cols + [value_col]]
+        fill_values = (
+            df.loc[fill_mask, group_cols]
+            .merge(_group_modes(valid_rows, group_cols, value_col), on=group_cols, how="left",
+                   validate="many_to_one")[value_col]
+        )
+        fill_values.index = df.index[fill_mask]
 
-    if isinstance(groupby_cols, str):
-        groupby_cols = [groupby_cols]
+        # Rows whose group has no valid value: mode of the equipment type
+        if groupby_cols and fallback_to_equipment_mode:
+            equipment_modes = _group_modes(valid_rows, [equipment_col], value_col)
+            fallback = df.loc[fill_mask, equipment_col].map(
+                equipment_modes.set_index(equipment_col)[value_col]
+            )
+            fill_values = fill_values.where(fill_values.notna(), fallback)
 
-    # Build per-group modes within the selected equipment.
-    mode_by_group = (
-        df.loc[valid, groupby_cols + [value_col]]
-        .groupby(groupby_cols, dropna=False)[value_col]
-        .agg(lambda s: s.mode().iloc[0])
-    )
+        fill_values = fill_values[fill_values.notna()]
+        df.loc[fill_values.index, value_col] = fill_values
 
-    fallback_mode = None
-    if fallback_to_equipment_mode:
-        fallback_mode = df.loc[valid, value_col].mode().iloc[0]
+    return df
 
-    fill_index = df.index[fill_mask]
-    for idx in fill_index:
-        if len(groupby_cols) == 1:
-            key = df.at[idx, groupby_cols[0]]
-        else:
-            key = tuple(df.loc[idx, groupby_cols].tolist())
 
-        fill_value = mode_by_group.get(key, fallback_mode)
-        if fill_value is not None:
-            df.at[idx, value_col] = fill_value
+def fill_with_equipment_mode(
+    df,
+    value_col,
+    equipment_value,
+    equipment_col="equipment",
+    unknown_value="Unknown",
+    groupby_cols=None,
+    fallback_to_equipment_mode=True,
+):
+    """
+    Fill missing/Unknown values in value_col for one equipment type.
 
-    return df
+    By default, fills using the mode within the selected equipment type.
+    Optionally, compute mode within additional grouping column(s), e.g.:
+    groupby_cols="institute" or groupby_cols=["institute", "survey"].
+    """
+    return fill_with_equipment_modes(
+        df,
+        {equipment_value: [value_col]},
+        equipment_col=equipment_col,
+        unknown_value=unknown_value,
+        groupby_cols=groupby_cols,
+        fallback_to_equipment_mode=fallback_to_equipment_mode,
+    )
@@ -0,0 +1,130 @@
+# Functions to extract data from lab survey files in parallel:
+#   (1) Fan out one extraction call per lab file to a process pool (or run serially in-process)
+#   (2) Catch errors per lab (missing file, PermissionError, other exceptions) as structured results
+#   (3) Return the per-lab results in the same order as the lab list, whatever order the workers finish in
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+
+def _as_records(output):
+    """Normalise the output of an extraction function to (records, errors)."""
+    if isinstance(output, tuple):
+        records, errors = output
+    else:
+        records, errors = output, []
+    if isinstance(records, dict):
+        records = [records]
+    return list(records), list(errors)
+
+
+def _run_task(task):
+    """Run one extraction task and return a structured per-lab result (never raises)."""
+    labgroupid, path, func, kwargs = task
+
+    result = {
+        "labgroupid": labgroupid,
+        "path": str(path),
+        "status": "ok",
+        "records": [],
+        "errors": []
+    }
+
+    if not Path(path).exists():
+        result["status"] = "missing"
+        return result
+
+    try:
+        result["records"], result["errors"] = _as_records(func(path, **kwargs))
+    except PermissionError as e:
+        result["status"] = "permission_error"
+        result["errors"] = [{"error_type": "PermissionError", "message": str(e)}]
+    except Exception as e:
+        result["status"] = "error"
+        result["errors"] = [{"error_type": type(e).__name__, "message": str(e)}]
+
+    return result
+
+
+def extract_labs(labgroupids, paths, func, kwargs=None, max_workers=None):
+    """
+    Run an extraction function on one survey file per lab, in parallel.
+
+    Parameters
+    ----------
+    labgroupids : list
+        Labs to process.
+    paths : list[path-like]
+        Survey file of each lab (same order as labgroupids).
+    func : callable
+        Module-level function func(path, **kwargs) returning a record dict,
+        a list of record dicts, or a (records, errors) tuple for partial
+        failures within a file (e.g. read_survey_cells, read_equipment_updates).
+    kwargs : dict or list[dict], optional
+        Keyword arguments passed to func. Either one dict for all labs or one
+        dict per lab (e.g. specs that depend on the treatment status).
+    max_workers : int, optional
+        Number of worker processes (default: number of CPUs). With
+        max_workers=1 the files are read serially in the current process.
+
+    Returns
+    -------
+    list[dict]
+        One result per lab, in the order of labgroupids, with keys
+        "labgroupid", "path", "status" ("ok", "missing", "permission_error"
+        or "error"), "records" and "errors".
+    """
+    if len(paths) != len(labgroupids):
+        raise ValueError("paths must have the same length as labgroupids.")
+
+    if kwargs is None:
+        kwargs = {}
+    if isinstance(kwargs, dict):
+        kwargs = [kwargs] * len(labgroupids)
+    elif len(kwargs) != len(labgroupids):
+        raise ValueError("kwargs must be a dict or a list with one dict per lab.")
+
+    tasks = list(zip(labgroupids, paths, [func] * len(labgroupids), kwargs))
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, max(len(tasks), 1))
+
+    if max_workers == 1:
+        return [_run_task(task) for task in tasks]
+
+    # executor.map yields results in submission order
+    chunksize = max(1, len(tasks) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_run_task, tasks, chunksize=chunksize))
+
+
+def collect_records(results, add_labgroupid=True):
+    """Flatten the records of all successful labs (in lab order), optionally adding labgroupid."""
+    records = []
+    for result in results:
+        for record in result["records"]:
+            if add_labgroupid:
+                record = {"labgroupid": result["labgroupid"], **record}
+            records.append(record)
+    return records
+
+
+def print_errors(results, label=""):
+    """Print one line per lab (or per sheet within a lab) that could not be read."""
+    for result in results:
+        labgroupid = result["labgroupid"]
+
+        if result["status"] == "missing":
+            print(f"{label} survey file not found for labgroupid {labgroupid}. Skipping.".strip())
+            continue
+
+        for error in result["errors"]:
+            where = f"labgroupid {labgroupid}"
+            if "equipment" in error:
+                where += f" and equipment {error['equipment']}"
+            if error["error_type"] == "PermissionError":
+                print(f"PermissionError for {where}: {error['message']}")
+            else:
+                print(f"Error for {where}: {error['message']}")
@@ -0,0 +1,464 @@
+# Functions to profile the cleaning pipeline:
+#   (1) Record wall time, CPU time, peak memory, rows in/out and file bytes read/written of a
+#       block of code (profile_stage) or of every call of a helper function (@profiled)
+#   (2) Collect the records of one run (stages and the helpers called within them) into a
+#       JSON-serialisable report and write it as JSON and HTML
+#   (3) Compare two run reports (e.g. before and after a change)
+#
+# Helper calls are only recorded while a run is active (start_run, or the PIPELINE_PROFILE_HELPERS
+# environment variable set by run_all.py for notebook subprocesses), so @profiled has no cost otherwise.
+#
+# Usage:
+#   python pipeline_profiling.py old_report.json new_report.json [--html comparison.html]
+
+import argparse
+import atexit
+import functools
+import html
+import inspect
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    import psutil # peak memory and CPU time of child processes (optional)
+except ImportError:
+    psutil = None
+
+try:
+    import resource # fallback: peak memory of this process so far (not available on Windows)
+except ImportError:
+    resource = None
+
+# Metrics of each stage / helper, in report order
+METRICS = ["wall_time", "cpu_time", "peak_rss", "rows_in", "rows_out", "bytes_read", "bytes_written"]
+
+# Metrics that are summed over calls of a helper (peak_rss is the maximum)
+SUMMED_METRICS = [m for m in METRICS if m != "peak_rss"]
+
+# Set by run_all.py for notebook subprocesses: file to write the helper statistics to on exit
+HELPERS_ENV = "PIPELINE_PROFILE_HELPERS"
+
+# Active run ({"run": metadata, "stages": [...]}), None if not profiling
+_run = None
+
+# Helper statistics of the stage running in each thread ({helper name: stats} in _stage.helpers)
+_stage = threading.local()
+
+_lock = threading.Lock()
+
+
+# ---------------------------
+# Measurement
+# ---------------------------
+
+class ProcessSampler:
+    """
+    Track peak resident memory (bytes) and CPU time (seconds) of a process and its children
+    while in the block.
+
+    Samples in a background thread with psutil. Without psutil, CPU time is only available
+    for the current process and peak memory is the peak of the current process so far
+    (from resource), or None for other processes.
+    """
+
+    def __init__(self, pid=None, interval=0.05):
+        self.pid = pid or os.getpid()
+        self.interval = interval
+        self.peak_rss = None
+        self.cpu_time = None
+        self._cpu_start = {}
+        self._cpu_last = {}
+        self._process_time = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample_once(self):
+        try:
+            process = psutil.Process(self.pid)
+            processes = [process] + process.children(recursive=True)
+        except psutil.Error:
+            return
+        rss = 0
+        for p in processes:
+            try:
+                rss += p.memory_info().rss
+                cpu = p.cpu_times()
+                self._cpu_last[p.pid] = cpu.user + cpu.system
+            except psutil.Error:
+                continue
+        self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._sample_once()
+
+    def __enter__(self):
+        if self.pid == os.getpid():
+            self._process_time = time.process_time()
+        if psutil is not None:
+            self._sample_once()
+            self._cpu_start = dict(self._cpu_last)
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample_once()
+            # Processes that started in the block count from zero
+            self.cpu_time = sum(t - self._cpu_start.get(pid, 0.0) for pid, t in self._cpu_last.items())
+        elif resource is not None and self.pid == os.getpid():
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak_rss = maxrss if sys.platform == "darwin" else maxrss * 1024 # bytes on macOS, KB on Linux
+
+        # The own process: process_time is exact (psutil only sees completed samples)
+        if self._process_time is not None:
+            own = time.process_time() - self._process_time
+            self.cpu_time = own if self.cpu_time is None else max(self.cpu_time, own)
+        return False
+
+
+def file_bytes(path):
+    """Size of a file, or of all files in a folder (recursive), 0 if it does not exist."""
+    path = Path(path)
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+    if path.exists():
+        return path.stat().st_size
+    return 0
+
+
+def _mtime(path):
+    path = Path(path)
+    return path.stat().st_mtime_ns if path.is_file() else None
+
+
+def dataset_rows(path):
+    """Number of rows of a Parquet dataset (from its metadata), None for other files."""
+    path = Path(path)
+    if path.suffix != ".parquet" or not path.exists():
+        return None
+    import pyarrow.parquet as pq
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+def _sum_or_none(values):
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+@contextmanager
+def profile_stage(name, files_in=(), files_out=(), rows_in=None, **info):
+    """
+    Profile a block of code as one stage of the run.
+
+    Parameters
+    ----------
+    name : str
+        Stage name, e.g. "2_3".
+    files_in, files_out : list[path-like]
+        Files (or folders) read and written by the stage. Bytes read is the size of the
+        inputs; bytes written is the size of the outputs created or modified in the block.
+        Rows in/out are counted from Parquet datasets among them (unless set explicitly).
+    rows_in : int, optional
+        Number of input rows.
+    **info
+        Extra fields stored in the record (e.g. notebook="2_3_clean_calculations.ipynb").
+
+    Yields
+    ------
+    dict
+        The stage record. Fields can be set in the block (e.g. record["rows_out"] = len(df)).
+        Helper calls made in the block (in this process) are collected under "helpers".
+        Metrics set in the block are kept (e.g. memory and CPU time of a subprocess that
+        ran the stage), otherwise they are measured for this process and its children.
+        The record is appended to the active run, if any.
+    """
+    files_out = list(files_out)
+    record = {"name": name, **info, "status": "ok"}
+    record.update({m: None for m in METRICS})
+    record["rows_in"] = rows_in if rows_in is not None else _sum_or_none(dataset_rows(f) for f in files_in)
+    record["bytes_read"] = sum(file_bytes(f) for f in files_in)
+    mtimes_before = {str(f): _mtime(f) for f in files_out}
+
+    outer_helpers = getattr(_stage, "helpers", None)
+    _stage.helpers = {}
+    sampler = ProcessSampler()
+    start = time.perf_counter()
+    sampler.__enter__()
+    try:
+        yield record
+    except BaseException:
+        record["status"] = "failed"
+        raise
+    finally:
+        sampler.__exit__(None, None, None)
+        record["wall_time"] = time.perf_counter() - start
+        record["cpu_time"] = sampler.cpu_time if record["cpu_time"] is None else record["cpu_time"]
+        record["peak_rss"] = sampler.peak_rss if record["peak_rss"] is None else record["peak_rss"]
+
+        written = [f for f in files_out if _mtime(f) is not None and _mtime(f) != mtimes_before[str(f)]]
+        if record["bytes_written"] is None:
+            record["bytes_written"] = sum(file_bytes(f) for f in written)
+        if record["rows_out"] is None:
+            record["rows_out"] = _sum_or_none(dataset_rows(f) for f in files_out)
+
+        record["helpers"] = {**record.get("helpers", {}), **_stage.helpers}
+        _stage.helpers = outer_helpers
+
+        if _run is not None:
+            with _lock:
+                _run["stages"].append(record)
+
+
+# ---------------------------
+# Helper functions
+# ---------------------------
+
+def _record_helper(name, stats):
+    """Add the statistics of one helper call to the current stage."""
+    if getattr(_stage, "helpers", None) is None:
+        _stage.helpers = {} # helper called outside a stage (e.g. in a notebook subprocess)
+    with _lock:
+        total = _stage.helpers.setdefault(name, {"calls": 0, **{m: None for m in METRICS}})
+        total["calls"] += 1
+        for m in SUMMED_METRICS:
+            if stats.get(m) is not None:
+                total[m] = (total[m] or 0) + stats[m]
+        if stats.get("peak_rss") is not None:
+            total["peak_rss"] = max(total["peak_rss"] or 0, stats["peak_rss"])
+
+
+def profiled(func=None, *, name=None, file_args=("file_name",)):
+    """
+    Decorator recording every call of a helper while profiling is active.
+
+    Rows in is the length of the first DataFrame argument, rows out the length of a
+    returned DataFrame. Bytes read/written are the sizes of the files passed in the
+    arguments named in file_args (written if modified by the call).
+
+    Usage:
+        @profiled
+        def clean_unique_values(df, file_name, ...): ...
+    """
+    if func is None:
+        return functools.partial(profiled, name=name, file_args=file_args)
+
+    helper_name = name or func.__name__
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _run is None:
+            return func(*args, **kwargs)
+
+        bound = signature.bind_partial(*args, **kwargs).arguments
+        frames = [v for v in bound.values() if isinstance(v, pd.DataFrame)]
+        files = [bound[a] for a in file_args if bound.get(a) is not None]
+        mtimes_before = [_mtime(f) for f in files]
+
+        stats = {
+            "rows_in": len(frames[0]) if frames else None,
+            "bytes_read": sum(file_bytes(f) for f in files) if files else None,
+        }
+        start = time.perf_counter()
+        with ProcessSampler() as sampler:
+            out = func(*args, **kwargs)
+        stats["wall_time"] = time.perf_counter() - start
+        stats["cpu_time"] = sampler.cpu_time
+        stats["peak_rss"] = sampler.peak_rss
+        stats["rows_out"] = len(out) if isinstance(out, pd.DataFrame) else None
+        if files:
+            stats["bytes_written"] = sum(
+                file_bytes(f) for f, before in zip(files, mtimes_before) if _mtime(f) != before
+            )
+        _record_helper(helper_name, stats)
+        return out
+
+    return wrapper
+
+
+def _write_helpers_on_exit(path):
+    """Write the helper statistics of this process (a notebook run by run_all.py) to path."""
+    with _lock:
+        helpers = dict(getattr(_stage, "helpers", None) or {})
+    Path(path).write_text(json.dumps(helpers, indent=1), encoding="utf-8")
+
+
+def read_helpers_file(path):
+    """Read (and delete) the helper statistics written by a notebook subprocess, {} if none."""
+    path = Path(path)
+    if not path.exists():
+        return {}
+    helpers = json.loads(path.read_text(encoding="utf-8"))
+    path.unlink()
+    return helpers
+
+
+# ---------------------------
+# Runs and reports
+# ---------------------------
+
+def start_run(**info):
+    """Start collecting stage and helper records (info is stored in the report's run metadata)."""
+    global _run
+    _run = {
+        "run": {
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            **info,
+        },
+        "stages": [],
+    }
+
+
+def end_run():
+    """Stop collecting and return the report of the run (None if no run was started)."""
+    global _run
+    report, _run = _run, None
+    if report is not None:
+        report["run"]["finished"] = datetime.now().isoformat(timespec="seconds")
+        report["run"]["wall_time"] = (
+            datetime.fromisoformat(report["run"]["finished"]) - datetime.fromisoformat(report["run"]["started"])
+        ).total_seconds()
+    return report
+
+
+def report_table(report):
+    """One row per stage and per helper within a stage, with all metrics."""
+    rows = []
+    for stage in report["stages"]:
+        rows.append({"stage": stage["name"], "helper": "", "calls": 1, "status": stage["status"],
+                     **{m: stage.get(m) for m in METRICS}})
+        for helper, stats in sorted(stage.get("helpers", {}).items()):
+            rows.append({"stage": stage["name"], "helper": helper, "calls": stats["calls"], "status": "",
+                         **{m: stats.get(m) for m in METRICS}})
+    return pd.DataFrame(rows, columns=["stage", "helper", "calls", "status"] + METRICS)
+
+
+def compare_reports(base, new):
+    """
+    Compare two run reports.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per stage / helper in either report, with <metric>_base, <metric>_new and
+        <metric>_change (relative change, new / base - 1) for wall time, CPU time and peak memory.
+    """
+    keys = ["stage", "helper"]
+    compared = ["wall_time", "cpu_time", "peak_rss"]
+    base_table = report_table(base)[keys + compared]
+    new_table = report_table(new)[keys + compared]
+    out = base_table.merge(new_table, on=keys, how="outer", suffixes=("_base", "_new"), sort=False)
+    for m in compared:
+        b = pd.to_numeric(out[f"{m}_base"], errors="coerce")
+        n = pd.to_numeric(out[f"{m}_new"], errors="coerce")
+        out[f"{m}_change"] = (n / b.where(b > 0)) - 1
+    return out
+
+
+def _format(metric, value):
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return "-"
+    if metric.endswith("_change"):
+        return f"{value:+.0%}"
+    if metric.startswith(("wall_time", "cpu_time")):
+        return f"{value:,.2f} s"
+    if metric.startswith(("peak_rss", "bytes_")):
+        return f"{value / 1e6:,.1f} MB"
+    if isinstance(value, float) and value.is_integer():
+        return f"{int(value):,}"
+    if isinstance(value, (int, float)):
+        return f"{value:,}"
+    return html.escape(str(value))
+
+
+def _html_table(df):
+    header = "".join(f"<th>{html.escape(c)}</th>" for c in df.columns)
+    body = []
+    for row in df.itertuples(index=False):
+        cells = []
+        for c, v in zip(df.columns, row):
+            style = ""
+            if c.endswith("_change") and isinstance(v, float) and not pd.isna(v) and abs(v) >= 0.1:
+                style = ' class="worse"' if v > 0 else ' class="better"'
+            cells.append(f"<td{style}>{_format(c, v)}</td>")
+        helper_row = "helper" in df.columns and row[df.columns.get_loc("helper")]
+        body.append(f'<tr{" class=helper" if helper_row else ""}>{"".join(cells)}</tr>')
+    return f"<table><tr>{header}</tr>{''.join(body)}</table>"
+
+
+def report_html(report, baseline=None):
+    """HTML page with the run's stage/helper table (and a comparison with baseline, if given)."""
+    meta = "".join(f"<li>{html.escape(str(k))}: {html.escape(str(v))}</li>" for k, v in report["run"].items())
+    parts = [
+        "<!DOCTYPE html><html><head><meta charset='utf-8'><title>Pipeline run report</title><style>",
+        "body{font-family:sans-serif;font-size:13px} table{border-collapse:collapse;margin-bottom:2em}",
+        "td,th{border:1px solid #ccc;padding:3px 8px;text-align:right} td:first-child,td:nth-child(2){text-align:left}",
+        "tr.helper td{color:#555;font-size:12px} .worse{background:#f8d7da} .better{background:#d4edda}",
+        "</style></head><body>",
+        f"<h1>Pipeline run report</h1><ul>{meta}</ul>",
+        "<h2>Stages and helpers</h2>",
+        _html_table(report_table(report)),
+    ]
+    if baseline is not None:
+        parts.append(f"<h2>Comparison with run started {html.escape(str(baseline['run'].get('started')))}</h2>")
+        parts.append(_html_table(compare_reports(baseline, report)))
+    parts.append("</body></html>")
+    return "\n".join(parts)
+
+
+def write_report(report, path, baseline=None):
+    """Write a run report as JSON (path with .json) and HTML (same name, .html)."""
+    path = Path(path).with_suffix(".json")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(report, indent=1, default=str), encoding="utf-8")
+    path.with_suffix(".html").write_text(report_html(report, baseline), encoding="utf-8")
+    return path
+
+
+def load_report(path):
+    return json.loads(Path(path).read_text(encoding="utf-8"))
+
+
+# Notebook subprocess started by run_all.py: record helper calls and write them out on exit
+# (not in worker processes of the notebook, e.g. parallel_extraction, which inherit the variable)
+if os.environ.get(HELPERS_ENV) and _run is None and multiprocessing.parent_process() is None:
+    start_run(helpers_file=os.environ[HELPERS_ENV])
+    atexit.register(_write_helpers_on_exit, os.environ[HELPERS_ENV])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two pipeline run reports.")
+    parser.add_argument("base", help="earlier run report (.json)")
+    parser.add_argument("new", help="later run report (.json)")
+    parser.add_argument("--html", help="also write the comparison as HTML to this file")
+    args = parser.parse_args()
+
+    base, new = load_report(args.base), load_report(args.new)
+    comparison = compare_reports(base, new)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(comparison.to_string(index=False, formatters={
+            c: (lambda v, c=c: _format(c, v)) for c in comparison.columns if c not in ["stage", "helper"]
+        }))
+    if args.html:
+        Path(args.html).write_text(report_html(new, baseline=base), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
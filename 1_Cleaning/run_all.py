@@ -1,51 +1,547 @@
-"""Run all cleaning notebooks in order."""
+"""Run the cleaning notebooks as a dependency graph, skipping stages that are up to date.
 
+Each stage (notebook) declares the files it reads and writes. A stage is re-run only if its
+code (code cells, imported helper modules, config.py) or any of its inputs/outputs changed
+since its last successful run. Stages whose inputs are ready run concurrently.
+
+With --in-process, the code cells of all stages run one after another in this process (no
+kernel start-up per notebook, imports paid once) and processed datasets are passed between
+stages in memory (they are still written to disk, notebooks are not updated with outputs).
+Wall time, CPU time and peak memory of each stage are reported at the end. A JSON/HTML run
+report (stages, rows and bytes in/out, and the profiled helpers called in each stage) is written
+to PROCESSED_DATA/run_reports and compared with the previous run (see pipeline_profiling.py).
+
+Usage:
+    python run_all.py                  # run out-of-date stages
+    python run_all.py --force          # run all stages
+    python run_all.py --only 2_3 2_4   # only consider these stages (e.g. after editing them)
+    python run_all.py --dry-run        # show which stages would run
+    python run_all.py --workers 1      # run stages one after another
+    python run_all.py --in-process     # run stages in this process, datasets passed in memory
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
 import subprocess
 import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
 from pathlib import Path
 
-CLEANING_NOTEBOOKS = [
+from openpyxl import load_workbook
+
+here = Path(__file__).resolve().parent
+CODE_ROOT = here.parent
+sys.path.append(str(CODE_ROOT))
+import config
+
+from pipeline_profiling import (HELPERS_ENV, ProcessSampler, end_run, load_report, profile_stage,
+                                read_helpers_file, start_run, write_report)
+
+# State of the last successful run of each stage (code hash and input/output fingerprints)
+MANIFEST_FILE = config.PROCESSED_DATA / "run_all_manifest.json"
+
+# Profiling report of each run (JSON and HTML, compared with the previous run)
+REPORTS_DIR = config.PROCESSED_DATA / "run_reports"
+
+RAW_SAMPLE = config.EL_RAW_SAMPLE / "final_sample_with_EL_file_status.csv"
+BL_SURVEYS = config.BL_RAW_SURVEY / "1_LabExcels"
+EL_SURVEYS = config.EL_RAW_SURVEY / "1_LabExcels"
+BL_CHECKLISTS = config.BL_RAW_CHECKLIST / "1_LabExcels"
+HELPER_DICT = config.SURVEY_DICTIONARIES / "helper_survey_dictionary.xlsx"
+DATA_DICT = config.DATA_DICTIONARIES / "data_dictionary.xlsx"
+EL_VISITS = config.WAVE1_ENUMERATORS / "EL_visits_completed.xlsx"
+NO_BL_CHECKLIST = config.WAVE1_LABS_LIST / "labs_no_BL_SPARK_checklist.xlsx"
+AFFECTED_VARS = config.CLEANING_WORKBOOKS / "affected_variables_cleaning.xlsx"
+MERGE_OVERRIDES = config.CLEANING_WORKBOOKS / "merge_overrides.xlsx"
+SPARK_CALCULATIONS = [
+    config.SPARK_DATA / "2_Clean" / "equipment_calculations.csv",
+    config.SPARK_DATA / "2_Clean" / "fc_calculations.csv",
+]
+
+
+def processed(name):
+    return config.PROCESSED_DATA / f"{name}.parquet"
+
+
+# Inputs are paths (folders are fingerprinted by file names, sizes and modification times) or
+# (workbook, sheet) pairs for workbooks shared between stages. Cleaning workbooks that a stage
+# appends to are both inputs and outputs of that stage.
+STAGES = [
 
     # Individual dataset cleaning
-    "1_0_combine_individual_dataset.ipynb",
-    "1_1_check_unique_values.ipynb",
-    "1_2_clean_unique_values.ipynb",
-    "1_3_clean_certification.ipynb",
-    "1_4_clean_calculator.ipynb",
-    "1_5_anonymize_individual_data.ipynb",
+    {
+        "notebook": "1_0_combine_individual_dataset.ipynb",
+        "inputs": [RAW_SAMPLE, BL_SURVEYS, EL_SURVEYS, BL_CHECKLISTS, config.CALCULATORS_WITH_TIPS,
+                   HELPER_DICT, EL_VISITS, NO_BL_CHECKLIST],
+        "outputs": [processed("individual_processed_1")],
+    },
+    {
+        "notebook": "1_1_check_unique_values.ipynb",
+        "inputs": [processed("individual_processed_1"), DATA_DICT],
+        "outputs": [config.DATA_DICTIONARIES / "other_qs_unique_combinations.xlsx",
+                    config.DATA_DICTIONARIES / "checklist_qs_unique_combinations.xlsx"],
+    },
+    {
+        "notebook": "1_2_clean_unique_values.ipynb",
+        "inputs": [processed("individual_processed_1"), DATA_DICT,
+                   config.CLEANING_WORKBOOKS / "individual_cleaning_workbook.xlsx",
+                   (AFFECTED_VARS, "Individual Vars")],
+        "outputs": [processed("individual_processed_2"),
+                    config.CLEANING_WORKBOOKS / "individual_cleaning_workbook.xlsx",
+                    config.CLEANING_WORKBOOKS / "individual_cleaning_decisions.sqlite",
+                    (AFFECTED_VARS, "Individual Vars")],
+    },
+    {
+        "notebook": "1_3_clean_certification.ipynb",
+        "inputs": [processed("individual_processed_2"), NO_BL_CHECKLIST],
+        "outputs": [processed("individual_processed_3")],
+    },
+    {
+        "notebook": "1_4_clean_calculator.ipynb",
+        "inputs": [processed("individual_processed_3")],
+        "outputs": [processed("individual_processed_4")],
+    },
+    {
+        "notebook": "1_5_anonymize_individual_data.ipynb",
+        "inputs": [processed("individual_processed_4")],
+        "outputs": [processed("individual_processed_5"), config.SENSITIVE_DATA / "sensitive_data.csv"],
+    },
 
     # Panel dataset cleaning
-    "2_0_combine_panel_dataset.ipynb",
-    "2_1_check_unique_values.ipynb",
-    "2_2_clean_unique_values.ipynb",
-    "2_3_clean_calculations.ipynb",
-    "2_4_merge_calculator.ipynb",
-    "2_5_energy_use_formulas.ipynb",
-    
+    {
+        "notebook": "2_0_combine_panel_dataset.ipynb",
+        "inputs": [RAW_SAMPLE, BL_SURVEYS, EL_SURVEYS, HELPER_DICT, EL_VISITS],
+        "outputs": [processed("panel_processed_1")],
+    },
+    {
+        "notebook": "2_1_check_unique_values.ipynb",
+        "inputs": [processed("panel_processed_1"), DATA_DICT],
+        "outputs": [config.DATA_DICTIONARIES / "equipment_unique_combinations.xlsx"],
+    },
+    {
+        "notebook": "2_2_clean_unique_values.ipynb",
+        "inputs": [processed("panel_processed_1"), DATA_DICT,
+                   config.CLEANING_WORKBOOKS / "panel_cleaning_workbook.xlsx",
+                   config.CLEANING_WORKBOOKS / "equipment_to_exclude.xlsx",
+                   config.CLEANING_WORKBOOKS / "equipment_special_cases.xlsx",
+                   config.CLEANING_WORKBOOKS / "split_types_cleaning.xlsx",
+                   (AFFECTED_VARS, "Panel Vars")],
+        "outputs": [processed("panel_processed_2"),
+                    config.CLEANING_WORKBOOKS / "panel_cleaning_workbook.xlsx",
+                    config.CLEANING_WORKBOOKS / "panel_cleaning_decisions.sqlite",
+                    config.CLEANING_WORKBOOKS / "split_types_cleaning.xlsx",
+                    config.CLEANING_WORKBOOKS / "split_rows_differences_bl_el.xlsx",
+                    (AFFECTED_VARS, "Panel Vars")],
+    },
+    {
+        # Also needs the anonymized individual dataset (institute_id)
+        "notebook": "2_3_clean_calculations.ipynb",
+        "inputs": [processed("panel_processed_2"), processed("individual_processed_5"),
+                   MERGE_OVERRIDES, DATA_DICT] + SPARK_CALCULATIONS,
+        "outputs": [processed("panel_processed_3")],
+    },
+    {
+        "notebook": "2_4_merge_calculator.ipynb",
+        "inputs": [processed("panel_processed_3"), MERGE_OVERRIDES] + SPARK_CALCULATIONS,
+        "outputs": [processed("panel_processed_4")],
+    },
+    {
+        "notebook": "2_5_energy_use_formulas.ipynb",
+        "inputs": [processed("panel_processed_4")],
+        "outputs": [processed("panel_processed_5")],
+    },
+
     # Merging individual and panel datasets
-    "3_1_merge_individual_panel.ipynb",
+    {
+        "notebook": "3_1_merge_individual_panel.ipynb",
+        "inputs": [processed("individual_processed_5"), processed("panel_processed_5")],
+        "outputs": [config.CLEAN_DATA / "final_dataset.csv"],
+    },
 ]
 
-here = Path(__file__).parent
 
-for nb in CLEANING_NOTEBOOKS:
-    print(f"Running {nb} ...", flush=True)
-    result = subprocess.run(
+# ---------------------------
+# Fingerprints
+# ---------------------------
+
+def stage_name(stage):
+    """Short stage name, e.g. "2_3" for 2_3_clean_calculations.ipynb."""
+    return "_".join(stage["notebook"].split("_")[:2])
+
+
+def file_key(item):
+    """Path of an input/output (without sheet), used for file locks."""
+    return str(item[0] if isinstance(item, tuple) else item)
+
+
+def item_key(item):
+    if isinstance(item, tuple):
+        return f"{item[0]}#{item[1]}"
+    return str(item)
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _hash_folder(path):
+    """Hash of the names, sizes and modification times of all files in a folder (recursive)."""
+    h = hashlib.sha256()
+    for p in sorted(path.rglob("*")):
+        if p.is_file():
+            stat = p.stat()
+            h.update(f"{p.relative_to(path)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def _hash_workbook(path, sheet=None):
+    """
+    Hash of the cell values of a workbook (or of one sheet).
+
+    Workbooks saved by openpyxl change on every save (zip timestamps), so they are compared
+    by content rather than by bytes.
+    """
+    h = hashlib.sha256()
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheets = [sheet] if sheet is not None else wb.sheetnames
+        for name in sheets:
+            if name not in wb.sheetnames:
+                h.update(f"missing sheet {name}\n".encode())
+                continue
+            h.update(f"sheet {name}\n".encode())
+            for row in wb[name].iter_rows(values_only=True):
+                h.update(repr(row).encode())
+    finally:
+        wb.close()
+    return h.hexdigest()
+
+
+def fingerprint(item):
+    """Fingerprint of an input/output, or None if it does not exist."""
+    path, sheet = item if isinstance(item, tuple) else (item, None)
+    path = Path(path)
+    if not path.exists():
+        return None
+    if path.is_dir():
+        return _hash_folder(path)
+    if path.suffix == ".xlsx":
+        return _hash_workbook(path, sheet)
+    return _hash_file(path)
+
+
+def _helper_modules(source, seen):
+    """Helper modules in the cleaning folder imported by source (recursively)."""
+    for name in re.findall(r"^\s*(?:from\s+(\w+)\s+import|import\s+(\w+))", source, flags=re.M):
+        module = name[0] or name[1]
+        path = here / f"{module}.py"
+        if module not in seen and path.exists():
+            seen.add(module)
+            _helper_modules(path.read_text(encoding="utf-8"), seen)
+    return seen
+
+
+def code_hash(stage):
+    """Hash of the notebook code cells, the helper modules they import and config.py."""
+    nb = json.loads((here / stage["notebook"]).read_text(encoding="utf-8"))
+    source = "\n".join("".join(c["source"]) for c in nb["cells"] if c["cell_type"] == "code")
+
+    h = hashlib.sha256(source.encode())
+    for module in sorted(_helper_modules(source, set())):
+        h.update((here / f"{module}.py").read_bytes())
+    h.update((CODE_ROOT / "config.py").read_bytes())
+    return h.hexdigest()
+
+
+def stage_state(stage):
+    return {
+        "code": code_hash(stage),
+        "inputs": {item_key(i): fingerprint(i) for i in stage["inputs"]},
+        "outputs": {item_key(o): fingerprint(o) for o in stage["outputs"]},
+    }
+
+
+def is_up_to_date(stage, manifest):
+    """True if the code, inputs and outputs are unchanged since the last successful run."""
+    previous = manifest.get(stage_name(stage))
+    if previous is None:
+        return False
+    current = stage_state(stage)
+    if any(fp is None for fp in current["outputs"].values()):
+        return False
+    return all(previous.get(k) == current[k] for k in ["code", "inputs", "outputs"])
+
+
+def load_manifest():
+    if MANIFEST_FILE.exists():
+        return json.loads(MANIFEST_FILE.read_text(encoding="utf-8"))
+    return {}
+
+
+def save_manifest(manifest):
+    tmp = MANIFEST_FILE.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(manifest, indent=1, sort_keys=True), encoding="utf-8")
+    tmp.replace(MANIFEST_FILE)
+
+
+# ---------------------------
+# Graph
+# ---------------------------
+
+def dependencies(stages):
+    """{stage name: set of upstream stage names} from matching outputs to inputs."""
+    producers = {}
+    for stage in stages:
+        for o in stage["outputs"]:
+            producers.setdefault(item_key(o), []).append(stage_name(stage))
+
+    deps = {}
+    for stage in stages:
+        name = stage_name(stage)
+        deps[name] = {
+            p for i in stage["inputs"] for p in producers.get(item_key(i), []) if p != name
+        }
+    return deps
+
+
+def conflicts(stage, running):
+    """True if stage writes a file that a running stage reads or writes (or vice versa)."""
+    reads = {file_key(i) for i in stage["inputs"]}
+    writes = {file_key(o) for o in stage["outputs"]}
+    for other in running:
+        other_reads = {file_key(i) for i in other["inputs"]}
+        other_writes = {file_key(o) for o in other["outputs"]}
+        if writes & (other_reads | other_writes) or reads & other_writes:
+            return True
+    return False
+
+
+# ---------------------------
+# Execution
+# ---------------------------
+
+def run_notebook(stage):
+    """
+    Execute a notebook in place with nbconvert (in the interpreter running this script).
+
+    Returns peak memory and CPU time of the nbconvert process and its kernel, and the
+    statistics of the profiled helpers called in the notebook.
+    """
+    helpers_file = config.PROCESSED_DATA / f".profile_{stage_name(stage)}.json"
+    process = subprocess.Popen(
         [
-            "/Users/drutna/miniconda3/envs/labrct/bin/jupyter", "nbconvert",
+            sys.executable, "-m", "jupyter", "nbconvert",
             "--to", "notebook",
             "--execute",
             "--inplace",
             "--ExecutePreprocessor.timeout=600",
-            str(here / nb),
+            str(here / stage["notebook"]),
         ],
-        capture_output=True,
+        cwd=here,
+        env={**os.environ, HELPERS_ENV: str(helpers_file)},
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
         text=True,
     )
-    if result.returncode != 0:
-        print(f"\nFAILED: {nb}")
-        print(result.stderr)
+    with ProcessSampler(process.pid) as sampler:
+        _, stderr = process.communicate()
+    helpers = read_helpers_file(helpers_file)
+    if process.returncode != 0:
+        raise RuntimeError(stderr)
+    return {"peak_rss": sampler.peak_rss, "cpu_time": sampler.cpu_time, "helpers": helpers}
+
+
+def _display(*objs, **kwargs):
+    """Stand-in for IPython's display when running notebook code outside a kernel."""
+    for obj in objs:
+        print(obj)
+
+
+def run_notebook_in_process(stage):
+    """Execute the code cells of a notebook in this process (fresh namespace for each stage)."""
+    nb = json.loads((here / stage["notebook"]).read_text(encoding="utf-8"))
+    namespace = {"__name__": "__main__", "display": _display}
+
+    # Memory, CPU time and helper calls are measured by profile_stage in this process
+    for i, cell in enumerate(nb["cells"]):
+        if cell["cell_type"] != "code":
+            continue
+        code = compile("".join(cell["source"]), f"{stage['notebook']} [cell {i}]", "exec")
+        exec(code, namespace)
+    return {}
+
+
+def print_report(report):
+    """Print wall time, CPU time and peak memory of the stages that ran."""
+    if not report:
+        return
+    print("\nStage timings:")
+    print(f"  {'stage':<40} {'status':<8} {'time (s)':>9} {'CPU (s)':>9} {'peak memory (MB)':>17}")
+    for name, row in report.items():
+        peak = f"{row['peak_rss'] / 1e6:,.0f}" if row.get("peak_rss") else "-"
+        duration = f"{row['wall_time']:.1f}" if row.get("wall_time") is not None else "-"
+        cpu = f"{row['cpu_time']:.1f}" if row.get("cpu_time") is not None else "-"
+        print(f"  {row['notebook']:<40} {row['status']:<8} {duration:>9} {cpu:>9} {peak:>17}")
+
+
+def write_run_report():
+    """Write the profiling report of this run, compared with the previous run's report."""
+    run_report = end_run()
+    if not run_report or not run_report["stages"]:
+        return
+    previous = sorted(REPORTS_DIR.glob("run_*.json"))
+    baseline = load_report(previous[-1]) if previous else None
+    path = write_report(run_report, REPORTS_DIR / f"run_{datetime.now():%Y%m%d_%H%M%S_%f}.json", baseline)
+    print(f"\nRun report: {path.with_suffix('.html')}")
+
+
+def run_pipeline(stages, force=False, only=None, dry_run=False, workers=None, runner=run_notebook):
+    """
+    Run the stages in dependency order, concurrently where possible.
+
+    Returns
+    -------
+    bool
+        True if no stage failed.
+    """
+    manifest = load_manifest()
+    manifest_lock = threading.Lock()
+
+    by_name = {stage_name(s): s for s in stages}
+    deps = dependencies(stages)
+    selected = set(by_name) if not only else {n for n in by_name if any(n.startswith(o) for o in only)}
+
+    # Stages not selected are treated as done
+    done = set(by_name) - selected
+    report = {}
+    will_run = set()
+    failed = set()
+    running = {}
+
+    if dry_run:
+        for name in by_name:
+            if name not in selected:
+                continue
+            upstream_runs = deps[name] & will_run
+            if force or upstream_runs or not is_up_to_date(by_name[name], manifest):
+                will_run.add(name)
+                reason = "forced" if force else ("upstream" if upstream_runs else "changed")
+                print(f"would run  {by_name[name]['notebook']} ({reason})")
+            else:
+                print(f"up to date {by_name[name]['notebook']}")
+        return True
+
+    start_run(force=force, only=only, workers=workers, runner=runner.__name__)
+
+    def execute(name):
+        stage = by_name[name]
+        files_in = list(dict.fromkeys(file_key(i) for i in stage["inputs"]))
+        files_out = list(dict.fromkeys(file_key(o) for o in stage["outputs"]))
+        try:
+            with profile_stage(name, files_in=files_in, files_out=files_out,
+                               notebook=stage["notebook"]) as record:
+                record.update(runner(stage) or {})
+        finally:
+            report[name] = record
+        duration = record["wall_time"]
+
+        # Record fingerprints after the run (stages may update their own cleaning workbooks)
+        with manifest_lock:
+            manifest[name] = {**stage_state(stage), "duration": round(duration, 1),
+                              "cpu_time": round(record["cpu_time"], 1) if record["cpu_time"] is not None else None,
+                              "peak_memory_mb": round(record["peak_rss"] / 1e6) if record["peak_rss"] else None,
+                              "finished": datetime.now().isoformat(timespec="seconds")}
+            save_manifest(manifest)
+        return duration
+
+    workers = workers or len(stages)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Stages downstream of a failed stage are not run
+            blocked = {n for n in selected - done - failed if deps[n] & failed}
+            while blocked:
+                failed |= blocked
+                for name in sorted(blocked):
+                    print(f"Skipping {by_name[name]['notebook']} (upstream failed)", flush=True)
+                blocked = {n for n in selected - done - failed if deps[n] & failed}
+
+            # Start ready stages (upstream done) that do not touch files of running stages
+            progress = False
+            for name in by_name:
+                if name not in selected or name in done | failed or name in running.values():
+                    continue
+                if not deps[name] <= done or len(running) >= workers:
+                    continue
+                stage = by_name[name]
+                if conflicts(stage, [by_name[n] for n in running.values()]):
+                    continue
+                progress = True
+                if not force and is_up_to_date(stage, manifest):
+                    print(f"Up to date {stage['notebook']}", flush=True)
+                    report[name] = {"notebook": stage["notebook"], "status": "skipped"}
+                    done.add(name)
+                    continue
+                print(f"Running {stage['notebook']} ...", flush=True)
+                running[executor.submit(execute, name)] = name
+
+            if not running:
+                if progress:
+                    continue # stages marked up to date may have unblocked others
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    duration = future.result()
+                except Exception as e:
+                    failed.add(name)
+                    print(f"\nFAILED: {by_name[name]['notebook']}\n{e}", flush=True)
+                else:
+                    done.add(name)
+                    print(f"  done {by_name[name]['notebook']} ({duration:.1f}s)", flush=True)
+
+    print_report({n: report[n] for n in by_name if n in report})
+    write_run_report()
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--force", action="store_true", help="run stages even if up to date")
+    parser.add_argument("--only", nargs="+", metavar="STAGE", help="stages to consider, e.g. 2_3 2_4")
+    parser.add_argument("--dry-run", action="store_true", help="only show which stages would run")
+    parser.add_argument("--workers", type=int, default=None, help="maximum number of concurrent stages")
+    parser.add_argument("--in-process", action="store_true",
+                        help="run stages one after another in this process, passing datasets in memory")
+    args = parser.parse_args()
+
+    runner = run_notebook
+    workers = args.workers
+    if args.in_process:
+        from dataset_io import enable_memory_store
+        enable_memory_store()
+        os.chdir(here) # notebooks locate config relative to the working directory
+        os.environ.setdefault("MPLBACKEND", "Agg")
+        runner = run_notebook_in_process
+        workers = 1 # stages share the process (working directory, imported modules)
+
+    ok = run_pipeline(STAGES, force=args.force, only=args.only, dry_run=args.dry_run,
+                      workers=workers, runner=runner)
+    if not ok:
         sys.exit(1)
-    print(f"  done.")
+    print("\nAll notebooks completed successfully.")
+
 
-print("\nAll notebooks completed successfully.")
+if __name__ == "__main__":
+    main()
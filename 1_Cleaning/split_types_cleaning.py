@@ -3,10 +3,23 @@ import pandas as pd
 from openpyxl import Workbook, load_workbook
 from openpyxl.utils import get_column_letter
 
+import workbook_snapshot
+from pipeline_profiling import profiled
+from workbook_writer import append_frame
 
-def _row_key(row, id_cols, sep="||"):
-    parts = [str(row[c]).strip() for c in id_cols]
-    return sep.join(parts)
+
+def _row_keys(frame, id_cols, sep="||"):
+    """Key of every row of frame (stripped id values joined with sep), built column by column."""
+    keys = None
+    for c in id_cols:
+        col = frame[c]
+        if (col.dtype.kind in "iu" or isinstance(col.dtype, pd.StringDtype)) and not col.hasnans:
+            part = col.astype(str)
+        else:
+            part = col.astype(object).map(str)  # str() of each value, e.g. "1.0", "None", "2024-01-01 00:00:00"
+        part = part.astype(str).str.strip()
+        keys = part if keys is None else keys + sep + part
+    return keys.astype(object)
 
 
 def _ensure_split_sheet(file_name, sheet_name, headers):
@@ -39,6 +52,50 @@ def _ensure_split_sheet(file_name, sheet_name, headers):
     wb.close()
 
 
+def _replace_with_splits(out, candidates, valid_split_rows, id_cols, clean_cols):
+    """
+    Replace the original rows of out by their split rows.
+
+    Each split row is its original row (matched on original_key with one merge) with the
+    split row's non-missing id/clean values, marked with ind_split_type = 1. Returns the
+    combined dataset, the new rows and the replaced original keys.
+    """
+    # One row per split row: the original row, with the split row's non-missing id/clean values
+    new_rows_df = valid_split_rows[["original_key"]].merge(
+        candidates, on="original_key", how="left", validate="many_to_one"
+    )
+    for col in id_cols + clean_cols:
+        if col in valid_split_rows.columns:
+            split_values = valid_split_rows[col].to_numpy(dtype=object)
+            keep_split = pd.notna(split_values)
+            values = new_rows_df[col].to_numpy(dtype=object)
+            values[keep_split] = split_values[keep_split]
+            new_rows_df[col] = values
+    # Column dtypes inferred from the values (as when the rows are built one by one)
+    new_rows_df = new_rows_df[candidates.columns].astype(object).infer_objects()
+    # Mark these rows as coming from a split replacement
+    new_rows_df["ind_split_type"] = 1
+
+    keys_to_replace = set(valid_split_rows["original_key"].tolist())
+    out_keys = _row_keys(out, id_cols)
+    out_remaining = out.loc[~out_keys.isin(keys_to_replace)].copy()
+    # Ensure non-split rows have ind_split_type==0
+    if "ind_split_type" not in out_remaining.columns:
+        out_remaining["ind_split_type"] = 0
+    else:
+        out_remaining["ind_split_type"] = out_remaining["ind_split_type"].fillna(0).astype(int)
+
+    # Ensure new_rows_df contains all original output columns (fill missing with NaN)
+    for c in out.columns:
+        if c not in new_rows_df.columns:
+            new_rows_df[c] = pd.NA
+
+    combined = pd.concat([out_remaining, new_rows_df[out.columns.tolist() + [c for c in new_rows_df.columns if c not in out.columns]]], ignore_index=True)
+
+    return combined, new_rows_df, keys_to_replace
+
+
+@profiled
 def clean_split_types(
     df,
     file_name,
@@ -84,21 +141,20 @@ def clean_split_types(
         print(f"No rows found with any *_status == '{split_status}'.")
         return out
 
-    candidates["original_key"] = candidates.apply(lambda r: _row_key(r, id_cols), axis=1)
+    candidates["original_key"] = _row_keys(candidates, id_cols)
 
     headers = ["split_type", "original_key"] + id_cols + clean_cols
-    _ensure_split_sheet(file_name=file_name, sheet_name=sheet_name, headers=headers)
+    if not os.path.exists(file_name) or workbook_snapshot.sheet_rows(file_name, sheet_name) is None:
+        _ensure_split_sheet(file_name=file_name, sheet_name=sheet_name, headers=headers)
 
-    wb = load_workbook(file_name)
-    ws = wb[sheet_name]
-    rows = list(ws.values)
+    # Read the sheet (from the workbook's snapshot if it has not been edited since)
+    rows = workbook_snapshot.sheet_rows(file_name, sheet_name)
     sheet_cols = list(rows[0]) if rows else headers
     existing = pd.DataFrame(rows[1:], columns=sheet_cols) if len(rows) > 1 else pd.DataFrame(columns=sheet_cols)
 
     required = ["split_type", "original_key"] + id_cols + clean_cols
     missing_sheet_cols = [c for c in required if c not in existing.columns]
     if missing_sheet_cols:
-        wb.close()
         raise ValueError(f"Sheet '{sheet_name}' missing required columns: {missing_sheet_cols}")
 
     export_original = candidates[["original_key"] + id_cols + clean_cols].copy()
@@ -118,22 +174,15 @@ def clean_split_types(
             if c not in rows_to_write.columns:
                 rows_to_write[c] = ""
         rows_to_write = rows_to_write[sheet_cols]
-        rows_to_write = rows_to_write.where(rows_to_write.notna(), None)
 
-        next_row = ws.max_row + 1
-        for _, row in rows_to_write.iterrows():
-            for col_idx, val in enumerate(row, start=1):
-                ws.cell(row=next_row, column=col_idx, value=val)
-            next_row += 1
-        wb.save(file_name)
+        # One block below the last row (missing values as empty cells)
+        append_frame(file_name, sheet_name, rows_to_write)
         print(f"Appended {len(to_append)} new Original row(s) to '{sheet_name}'.")
 
         existing = pd.concat([existing, to_append[sheet_cols]], ignore_index=True)
     else:
         print("No new Original rows to append.")
 
-    wb.close()
-
     split_rows = existing[existing["split_type"].astype(str).str.strip().str.lower() == "split"].copy()
     split_rows = split_rows[split_rows["original_key"].notna()].copy()
     split_rows["original_key"] = split_rows["original_key"].astype(str).str.strip()
@@ -166,8 +215,7 @@ def clean_split_types(
         print("No Split rows found in workbook yet. Export completed.")
         return out
 
-    base_lookup = candidates.set_index("original_key", drop=False)
-    valid_split_rows = split_rows[split_rows["original_key"].isin(base_lookup.index)].copy()
+    valid_split_rows = split_rows[split_rows["original_key"].isin(candidates["original_key"])].copy()
 
     if valid_split_rows.empty:
         print("Split rows found, but none match exported original_key values.")
@@ -179,32 +227,9 @@ def clean_split_types(
             f"combination of id_cols: {id_cols}"
         )
 
-    new_rows = []
-    for _, split_row in valid_split_rows.iterrows():
-        base = base_lookup.loc[split_row["original_key"]].copy()
-        for col in id_cols + clean_cols:
-            if col in split_row.index and pd.notna(split_row[col]):
-                base[col] = split_row[col]
-        # Mark this row as coming from a split replacement
-        base["ind_split_type"] = 1
-        new_rows.append(base)
-
-    new_rows_df = pd.DataFrame(new_rows)
-    keys_to_replace = set(valid_split_rows["original_key"].tolist())
-    out_keys = out.apply(lambda r: _row_key(r, id_cols), axis=1)
-    out_remaining = out.loc[~out_keys.isin(keys_to_replace)].copy()
-    # Ensure non-split rows have ind_split_type==0
-    if "ind_split_type" not in out_remaining.columns:
-        out_remaining["ind_split_type"] = 0
-    else:
-        out_remaining["ind_split_type"] = out_remaining["ind_split_type"].fillna(0).astype(int)
-
-    # Ensure new_rows_df contains all original output columns (fill missing with NaN)
-    for c in out.columns:
-        if c not in new_rows_df.columns:
-            new_rows_df[c] = pd.NA
-
-    combined = pd.concat([out_remaining, new_rows_df[out.columns.tolist() + [c for c in new_rows_df.columns if c not in out.columns]]], ignore_index=True)
+    combined, new_rows_df, keys_to_replace = _replace_with_splits(
+        out, candidates, valid_split_rows, id_cols, clean_cols
+    )
     print(
         f"Replaced {len(keys_to_replace)} original row(s) with {len(new_rows_df)} split row(s)."
     )
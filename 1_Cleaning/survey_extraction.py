@@ -0,0 +1,337 @@
+# Functions to extract variables from individual survey files in a single pass:
+#   (1) Translate the survey dictionary rows into cell specs (one spec per variable)
+#   (2) Stream each workbook once (openpyxl read-only) and collect only the cells the specs need
+#   (3) Resolve every spec into one flat record per lab {var_name: value}, following the same
+#       string conventions as create_var (all values as strings, missing cells as "")
+#   (4) Read the equipment sheets of one survey file (opened once) into one record per equipment type
+#   (5) Read the energy use and CO2 results of one calculator (computed by Excel via xlwings)
+
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.utils import range_boundaries
+
+from pipeline_profiling import profiled
+
+
+def _cell_refs(ref):
+    """Return the (row, col) pairs of a cell or range reference, in row-major order."""
+    min_col, min_row, max_col, max_row = range_boundaries(ref)
+    if min_row is None or min_col is None:
+        raise ValueError(f"Cell reference '{ref}' must be a cell or a bounded range.")
+    return [
+        (r, c)
+        for r in range(min_row, max_row + 1)
+        for c in range(min_col, max_col + 1)
+    ]
+
+
+def _to_str(v):
+    return str(v) if v is not None else ""
+
+
+def build_var_specs(survey_dict, survey, treatment_status=None, only_vars=None):
+    """
+    Build cell specs from the "Other" sheet of the survey dictionary.
+
+    Parameters
+    ----------
+    survey_dict : pd.DataFrame
+        "Other" sheet of helper_survey_dictionary.xlsx.
+    survey : str
+        "BL" or "EL". Only rows for this survey are kept.
+    treatment_status : str, optional
+        Treatment status of the lab. Rows restricted to the other arm
+        ("T or C only") are skipped.
+    only_vars : list[str], optional
+        If given, keep only these variables (e.g. ["survey_date_el"] for labs
+        whose EL data is replaced with missing).
+
+    Returns
+    -------
+    list[dict]
+        One spec per variable with the create_var arguments.
+    """
+    specs = []
+    for _, row in survey_dict.iterrows():
+
+        if row["Survey"] != survey:
+            continue
+
+        tc_only = row["T or C only"]
+        if pd.notna(tc_only) and tc_only != treatment_status:
+            continue
+
+        if only_vars is not None and row["Variable"] not in only_vars:
+            continue
+
+        specs.append({
+            "var_name": row["Variable"],
+            "sheet": row["Sheet"],
+            "cell": row["Cell(s)"],
+            "multiple_cells": row["Multiple cells"] == "Y",
+            "no_variables": pd.notna(row["No variables"]),
+            "comment_cell": row["Comment"] if pd.notna(row["Comment"]) else None,
+            "fc_cell": row["Free text"] if pd.notna(row["Free text"]) else None,
+        })
+    return specs
+
+
+def build_spec_equip_specs(spec_equip_cols_dict, sheet="14. Specialized Equipment"):
+    """Build cell specs for the specialized equipment sheet (rows 6-9 of each column)."""
+    specs = []
+    for _, row in spec_equip_cols_dict.iterrows():
+        equip = row["Specialized equipment"]
+        col = row["Column"]
+        for suffix, excel_row in [("ind", 6), ("no", 7), ("share", 8), ("co", 9)]:
+            specs.append({
+                "var_name": f"{equip}_{suffix}",
+                "sheet": sheet,
+                "cell": f"{col}{excel_row}",
+            })
+    return specs
+
+
+def build_checklist_specs(checklist_dict, sheet, suffix):
+    """Build cell specs for a SPARK checklist sheet (answer in column C, comment in column F)."""
+    specs = []
+    for _, row in checklist_dict.iterrows():
+        row_no = row["Row"]
+        specs.append({
+            "var_name": f"{row['Category']}_q_{row['Question number']}_{suffix}",
+            "sheet": sheet,
+            "cell": f"C{row_no}",
+            "comment_cell": f"F{row_no}",
+        })
+    return specs
+
+
+def _spec_refs(spec):
+    refs = [spec["cell"]]
+    for key in ["comment_cell", "fc_cell"]:
+        if spec.get(key):
+            refs.append(spec[key])
+    return refs
+
+
+def _read_sheet_cells(ws, coords):
+    """Stream the bounding block of the requested cells once and keep only those cells."""
+    min_row = min(r for r, _ in coords)
+    max_row = max(r for r, _ in coords)
+    min_col = min(c for _, c in coords)
+    max_col = max(c for _, c in coords)
+
+    block = {}
+    rows = ws.iter_rows(min_row=min_row, max_row=max_row,
+                        min_col=min_col, max_col=max_col,
+                        values_only=True)
+    for r, values in enumerate(rows, start=min_row):
+        for c, v in enumerate(values, start=min_col):
+            if v is not None and (r, c) in coords:
+                block[(r, c)] = v
+    return block
+
+
+def _resolve_spec(spec, values, record):
+    """Write the variables of one spec into record (same conventions as create_var)."""
+    var_name = spec["var_name"]
+    comment_cell = spec.get("comment_cell")
+    fc_cell = spec.get("fc_cell")
+
+    def cell_values(ref):
+        return [_to_str(values.get(rc)) for rc in _cell_refs(ref)]
+
+    # Multiple cells
+    if spec.get("multiple_cells"):
+        parts = [("", cell_values(spec["cell"]))]
+        if comment_cell:
+            parts.append(("_co", cell_values(comment_cell)))
+        if fc_cell:
+            parts.append(("_fc", cell_values(fc_cell)))
+
+        # Create separate variables per cell (cell, comment, free text)
+        if spec.get("no_variables"):
+            for suffix, vals in parts:
+                for i, v in enumerate(vals, start=1):
+                    record[f"{var_name}_{i}{suffix}"] = v
+
+        # Create single variable with all cells joined by ";"
+        else:
+            for suffix, vals in parts:
+                record[f"{var_name}{suffix}"] = ";".join(v for v in vals if v != "")
+
+    # Single cell
+    else:
+        record[var_name] = _to_str(values.get(_cell_refs(spec["cell"])[0]))
+        if comment_cell:
+            record[f"{var_name}_co"] = _to_str(values.get(_cell_refs(comment_cell)[0]))
+        if fc_cell:
+            record[f"{var_name}_fc"] = _to_str(values.get(_cell_refs(fc_cell)[0]))
+
+
+@profiled(file_args=("path",))
+def read_survey_cells(path, specs):
+    """
+    Read every cell listed in specs from one workbook in a single streaming pass.
+
+    Parameters
+    ----------
+    path : path-like
+        Survey workbook (e.g. BL_{labgroupid}.xlsx).
+    specs : list[dict]
+        Cell specs from build_var_specs / build_spec_equip_specs / build_checklist_specs.
+
+    Returns
+    -------
+    dict
+        {var_name: value} for all variables of all specs. Values are strings,
+        missing cells are "" (as with create_var).
+    """
+    # Group the requested cells by sheet so that each sheet is streamed once
+    coords_by_sheet = {}
+    for spec in specs:
+        coords = coords_by_sheet.setdefault(spec["sheet"], set())
+        for ref in _spec_refs(spec):
+            coords.update(_cell_refs(ref))
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        values_by_sheet = {
+            sheet: _read_sheet_cells(wb[sheet], coords)
+            for sheet, coords in coords_by_sheet.items()
+        }
+    finally:
+        wb.close()
+
+    record = {}
+    for spec in specs:
+        _resolve_spec(spec, values_by_sheet[spec["sheet"]], record)
+    return record
+
+
+# Read excel settings to ensure "None" is always treated as a string and not converted to NaN
+READ_EXCEL_SETTINGS = {
+    "keep_default_na": False,
+    "na_values": [""]
+}
+
+
+def get_type_columns(type_number):
+    """Return the value and comment column indices of a type (e.g. 1 = C, D)."""
+    col_index = 2 + (type_number - 1) * 2
+    co_col_index = col_index + 1
+    return col_index, co_col_index
+
+
+@profiled(file_args=("path",))
+def read_equipment_updates(path, equip_mappings, survey):
+    """
+    Read the equipment sheets of one BL/EL survey file.
+
+    Parameters
+    ----------
+    path : path-like
+        Survey workbook (e.g. BL_{labgroupid}.xlsx).
+    equip_mappings : pd.DataFrame
+        "Equipment" sheet of helper_survey_dictionary.xlsx, with column names
+        stripped and spaces replaced by "_".
+    survey : str
+        "BL" or "EL". EL surveys also contain the el_check row.
+
+    Returns
+    -------
+    records : list[dict]
+        One record per equipment and type (labgroupid not included).
+    errors : list[dict]
+        One entry per equipment sheet that could not be read, with keys
+        "equipment", "error_type" and "message".
+    """
+    records = []
+    errors = []
+
+    # Open the workbook once and parse each equipment sheet once (a sheet may be listed for
+    # several equipment types). Whole sheets are parsed rather than only the value blocks so
+    # that pandas infers column dtypes exactly as with read_excel (e.g. "5" vs "5.0").
+    sheets = {}
+
+    with pd.ExcelFile(path) as xls:
+
+        for row in equip_mappings.itertuples(index=False): # Loop over equipments
+
+            equipment = row.Equipment_type
+            max_types = int(row.Max_types)
+            no_vars = int(row.No_Vars)
+
+            if row.Survey_sheet not in sheets:
+                try:
+                    sheets[row.Survey_sheet] = xls.parse(row.Survey_sheet, **READ_EXCEL_SETTINGS)
+                except Exception as e:
+                    sheets[row.Survey_sheet] = e
+
+            df_sheet = sheets[row.Survey_sheet]
+            if isinstance(df_sheet, Exception):
+                errors.append({"equipment": equipment, "error_type": type(df_sheet).__name__, "message": str(df_sheet)})
+                continue
+
+            for type_no in range(1, max_types + 1): # Loop over types
+
+                updates = {
+                    "survey": survey,
+                    "equipment": equipment,
+                    "type_no": type_no
+                }
+
+                col_index, co_col_index = get_type_columns(type_no)
+
+                for v in range(1, no_vars + 1): # Loop through variables
+                    var_name = getattr(row, f"Variable_{v}")
+                    excel_row = 3 + v
+
+                    updates[var_name] = df_sheet.iloc[excel_row, col_index]
+                    updates[f"{var_name}_co"] = df_sheet.iloc[excel_row, co_col_index]
+
+                # Sharing variable
+                updates["share"] = df_sheet.iloc[no_vars+4, col_index]
+                updates["share_co"] = df_sheet.iloc[no_vars+4, co_col_index]
+
+                # Check for changes (EL only)
+                if survey == "EL":
+                    updates["el_check"] = df_sheet.iloc[no_vars+5, col_index]
+                    updates["el_check_co"] = df_sheet.iloc[no_vars+5, co_col_index]
+
+                records.append(updates)
+
+    return records, errors
+
+
+def read_calculator_values(path, calculator_equip):
+    """
+    Read total and per-equipment energy use and CO2 from one Energy_Use_Report.xlsx.
+
+    The values are formulas, so the workbook is opened in Excel with xlwings
+    (run serially, i.e. with max_workers=1 in extract_labs).
+
+    Returns
+    -------
+    dict
+        {"calc_total_energy": ..., "calc_total_co2": ..., "calc_{equipment}_energy": ..., ...}
+    """
+    import xlwings as xw # only needed for calculators (requires Excel)
+
+    record = {}
+    wb = xw.Book(path)
+    try:
+        # Read total energy use and CO2
+        ws = wb.sheets["Introduction"]
+        record["calc_total_energy"] = ws.range("B12").value
+        record["calc_total_co2"] = ws.range("B13").value
+
+        # Read equipment energy use and CO2
+        for _, row in calculator_equip.iterrows():
+            equip_type = row["Equipment type"]
+            ws = wb.sheets[row["Calculator sheet"]]
+            record[f"calc_{equip_type}_energy"] = ws.range("B2").value
+            record[f"calc_{equip_type}_co2"] = ws.range("B3").value
+    finally:
+        wb.close()
+
+    return record
@@ -5,23 +5,24 @@
 #       (3) If cleaned, pull cleaned value and status for use in cleaning the main dataset
 #       (4) If specified, produce short report of cleaning progress (e.g. no unique values, % cleaned, 
 #           % pending, % exclude, etc.)
+# Batch version (clean_unique_values_batch): same steps for many variables of one cleaning workbook,
+# loading and saving the workbook only once
+# Sheets are read from the workbook's snapshot (workbook_snapshot.py) unless the workbook was edited,
+# and the workbook is only rewritten when new rows are appended (workbook_writer.append_rows)
 
 import pandas as pd
 import openpyxl
-from openpyxl import Workbook, load_workbook
+from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment
 from openpyxl.utils.dataframe import dataframe_to_rows
 import os
 
-def clean_unique_values(df, file_name, var_name, sheet_name, 
-                        dtype="string",
-                        comment=False, 
-                        free_text=False, 
-                        mc_fc_vars=False,
-                        report=False,
-                        affected_vars=False):
-    
-    # Step 1: Prepare the data for merging with the cleaning sheet
+import workbook_snapshot
+from pipeline_profiling import profiled
+from workbook_writer import append_rows
+
+# Helper function to get the merge columns and renaming dicts of one variable
+def _merge_settings(var_name, comment=False, free_text=False, mc_fc_vars=False):
 
     # List of cols to merge on (depends on whether comment, free text, and mc_fc_vars)
     merge_cols = ["raw_value"]
@@ -51,29 +52,47 @@ def clean_unique_values(df, file_name, var_name, sheet_name,
                         "comment": f"{var_name}_co",
                         "raw_value_fc": f"{var_name}_fc",
                         "comment_fc": f"{var_name}_fc_co"}
+
+    return merge_cols, rename_dict, rename_back_dict
+
+
+# Helper function to enforce correct dtypes
+def _enforce_dtypes(_df, dtype="string"):
+
+    out = _df.copy()
+
+    # comment and free text cols should be string
+    string_cols = [c for c in ["comment", "comment_fc", "raw_value_fc"] if c in out.columns]
+    for c in string_cols:
+        out[c] = out[c].astype("string").str.strip()
+        out.loc[out[c] == "", c] = pd.NA
     
-    # Helper function to enforce correct dtypes
-    def enforce_dtypes(_df):
-
-        out = _df.copy()
-
-        # comment and free text cols should be string
-        string_cols = [c for c in ["comment", "comment_fc", "raw_value_fc"] if c in out.columns]
-        for c in string_cols:
-            out[c] = out[c].astype("string").str.strip()
-            out.loc[out[c] == "", c] = pd.NA
-        
-        # main raw value follows selected dtype
-        if "raw_value" in out.columns:
-            if dtype == "numeric":
-                out["raw_value"] = pd.to_numeric(out["raw_value"], errors="coerce")
-            elif dtype == "date":
-                out["raw_value"] = pd.to_datetime(out["raw_value"], errors="coerce").dt.normalize()
-            else:  # string
-                out["raw_value"] = out["raw_value"].astype("string").str.strip()
-                out.loc[out["raw_value"] == "", "raw_value"] = pd.NA
-
-        return out
+    # main raw value follows selected dtype
+    if "raw_value" in out.columns:
+        if dtype == "numeric":
+            out["raw_value"] = pd.to_numeric(out["raw_value"], errors="coerce")
+        elif dtype == "date":
+            out["raw_value"] = pd.to_datetime(out["raw_value"], errors="coerce").dt.normalize()
+        else:  # string
+            out["raw_value"] = out["raw_value"].astype("string").str.strip()
+            out.loc[out["raw_value"] == "", "raw_value"] = pd.NA
+
+    return out
+
+
+# Helper function to read a cleaning sheet (rows incl. header) into a dataframe (dtypes not enforced)
+def _read_sheet(rows):
+    cleaning_df = pd.DataFrame(rows)
+    cleaning_df.columns = cleaning_df.iloc[0]  # Set the first row as variable names
+    cleaning_df = cleaning_df[1:].copy()  # Remove the header row from the data
+    return cleaning_df
+
+
+# Step 1 for one variable: rename and type the variable's columns in the main dataset. Returns the
+# prepared dataset, its unique merge key combinations, the merge columns and the rename-back dict
+def _prepare_df(df, var_name, dtype="string", comment=False, free_text=False, mc_fc_vars=False):
+
+    merge_cols, rename_dict, rename_back_dict = _merge_settings(var_name, comment, free_text, mc_fc_vars)
 
     # Quick check to make sure all the columns to merge on are in the main dataset
     required_source_cols = list(rename_dict.keys())
@@ -86,7 +105,7 @@ def clean_unique_values(df, file_name, var_name, sheet_name,
     
     # Rename relevant cols in main dataset to match cleaning sheet for merging
     df = df.rename(columns=rename_dict).copy()
-    df = enforce_dtypes(df)
+    df = _enforce_dtypes(df, dtype)
 
     # Check that relevant cols are there after renaming
     missing_merge_cols = [c for c in merge_cols if c not in df.columns]
@@ -99,18 +118,63 @@ def clean_unique_values(df, file_name, var_name, sheet_name,
     # Keep only relevant cols for merging and drop duplicates to get unique combinations, drop any with NA in all merge cols
     df_subset = df[merge_cols].drop_duplicates().reset_index(drop=True).copy()
     df_subset = df_subset.dropna(subset=merge_cols, how="all") # Drop any rows where variable, comment, and free text are all NA
+
+    return df, df_subset, merge_cols, rename_back_dict
+
+
+# Step 3 helper: the new rows as they are appended to the sheet (sheet columns in sheet order, no NA)
+def _rows_to_append(new_rows, sheet_headers):
+
+    # keep only sheet columns, in sheet order
+    rows_to_append = new_rows.drop(columns=["_merge"], errors="ignore").copy()
+    for col in sheet_headers:
+        if col not in rows_to_append.columns:
+            rows_to_append[col] = ""
+    rows_to_append = rows_to_append[sheet_headers]
+
+    # Ensure no pd.NA to avoid issues with excel
+    return rows_to_append.fillna("")
+
+
+# Step 4 helper: merge the lookup (merge keys, cleaned_value, status and affects_vars, first
+# match per key combination) onto the dataset and rename back to variable-specific names
+def _merge_lookup(df, lookup_df, merge_cols, rename_back_dict, var_name, affected_vars=False):
+
+    # Merge lookup onto df using merge keys
+    df = df.merge(lookup_df, on=merge_cols, how="left")
+
+    # Rename back to variable-specific names
+    rename_out = {
+        "cleaned_value": f"{var_name}_clean",
+        "status": f"{var_name}_status",
+    }
+    if affected_vars:
+        rename_out["affects_vars"] = f"{var_name}_aff_vars"
     
-    # Step 2: Merge with the cleaning worksheet to check if combination has already been added
+    for generic_col, original_col in rename_back_dict.items():
+        if generic_col in df.columns:
+            rename_out[generic_col] = original_col
+
+    return df.rename(columns=rename_out)
 
-    # Load the cleaning sheet
-    wb = load_workbook(file_name)
-    if sheet_name not in wb.sheetnames:
-        raise ValueError(f"Sheet {sheet_name} does not exist. Please create it first.")
-    ws = wb[sheet_name]
-    cleaning_df = pd.DataFrame(ws.values)
-    cleaning_df.columns = cleaning_df.iloc[0]  # Set the first row as variable names
-    cleaning_df = cleaning_df[1:].copy()  # Remove the header row from the data
-    cleaning_df = enforce_dtypes(cleaning_df)
+
+# Steps 1-4 for one variable, given the cleaning sheet as a dataframe. Returns the cleaned
+# dataset, the new rows to append to the sheet (in sheet column order) and the merged
+# unique combinations (for the report)
+def _clean_with_sheet(df, sheet_df, sheet_headers, var_name,
+                      dtype="string",
+                      comment=False,
+                      free_text=False,
+                      mc_fc_vars=False,
+                      affected_vars=False):
+
+    # Step 1: Prepare the data for merging with the cleaning sheet
+    df, df_subset, merge_cols, rename_back_dict = _prepare_df(
+        df, var_name, dtype, comment, free_text, mc_fc_vars
+    )
+    
+    # Step 2: Merge with the cleaning worksheet to check if combination has already been added
+    cleaning_df = _enforce_dtypes(sheet_df, dtype)
 
     # Merge the unique values dataframe with the cleaning sheet dataframe
     merged_df = df_subset.merge(cleaning_df, on=merge_cols, how="left", indicator=True)
@@ -121,33 +185,14 @@ def clean_unique_values(df, file_name, var_name, sheet_name,
     if affected_vars:
         merged_df.loc[merged_df["_merge"] == "left_only", "affects_vars"] = pd.NA
 
-    # Step 3: If not already in cleaning sheet (i.e. _merge = "left_only"), add to the 
-    # bottom of the cleaning sheet with status "Unchecked" for review
-
+    # Step 3: If not already in cleaning sheet (i.e. _merge = "left_only"), collect the rows
+    # to add to the bottom of the cleaning sheet with status "Unchecked" for review
     new_rows = merged_df[merged_df["_merge"] == "left_only"].copy()
-
-    # Append ONLY new rows (no header)
-    if not new_rows.empty:
-        # keep only sheet columns, in sheet order
-        sheet_headers = [c.value for c in ws[1]]
-        rows_to_append = new_rows.drop(columns=["_merge"], errors="ignore").copy()
-        for col in sheet_headers:
-            if col not in rows_to_append.columns:
-                rows_to_append[col] = ""
-        rows_to_append = rows_to_append[sheet_headers]
-
-        # Ensure no pd.NA to avoid issues with excel
-        rows_to_append = rows_to_append.fillna("")
-
-        for r in dataframe_to_rows(rows_to_append, index=False, header=False):
-            ws.append(r)
-
-    wb.save(file_name)
-    wb.close()
+    rows_to_append = _rows_to_append(new_rows, sheet_headers)
 
     # Step 4: Create clean and status variables in main dataset from cleaning sheet
 
-    # Include rows just appended in Step 3 (so new combinations are available immediately)
+    # Include rows appended in Step 3 (so new combinations are available immediately)
     lookup_cols = merge_cols + ["cleaned_value", "status"]
     if affected_vars:
         lookup_cols.append("affects_vars")
@@ -160,35 +205,119 @@ def clean_unique_values(df, file_name, var_name, sheet_name,
     lookup_df = pd.concat(lookup_parts, ignore_index=True)
     lookup_df = lookup_df.drop_duplicates(subset=merge_cols, keep="first")
 
-    # Merge lookup onto df using merge keys
-    df = df.merge(lookup_df, on=merge_cols, how="left")
+    df = _merge_lookup(df, lookup_df, merge_cols, rename_back_dict, var_name, affected_vars)
+
+    return df, rows_to_append, merged_df
+
+
+# Step 5: short report of cleaning progress (e.g. no unique values, % cleaned, % pending, % exclude, etc.)
+def _print_report(var_name, merged_df):
+    total_unique = len(merged_df)
+    num_cleaned = len(merged_df[merged_df["status"] == "Cleaned"])
+    num_exclude = len(merged_df[merged_df["status"] == "Exclude"])
+    num_pending = len(merged_df[merged_df["status"] == "Pending"])
+    num_unchecked = len(merged_df[merged_df["status"] == "Unchecked"])
+
+    print(f"Cleaning progress for {var_name}:")
+    print(f"Total unique value combinations: {total_unique}")
+    print(f"Cleaned combinations: {num_cleaned}")
+    print(f"Pending combinations: {num_pending}")
+    print(f"Excluded combinations: {num_exclude}")
+    print(f"Unchecked combinations: {num_unchecked}")
 
-    # Rename back to variable-specific names
-    rename_out = {
-        "cleaned_value": f"{var_name}_clean",
-        "status": f"{var_name}_status",
-    }
-    if affected_vars:
-        rename_out["affects_vars"] = f"{var_name}_aff_vars"
-    
-    for generic_col, original_col in rename_back_dict.items():
-        if generic_col in df.columns:
-            rename_out[generic_col] = original_col
 
-    df = df.rename(columns=rename_out)
+@profiled
+def clean_unique_values(df, file_name, var_name, sheet_name, 
+                        dtype="string",
+                        comment=False, 
+                        free_text=False, 
+                        mc_fc_vars=False,
+                        report=False,
+                        affected_vars=False):
+
+    # Load the cleaning sheet (from the workbook's snapshot if it has not been edited since)
+    sheet_rows = workbook_snapshot.sheet_rows(file_name, sheet_name)
+    if sheet_rows is None:
+        raise ValueError(f"Sheet {sheet_name} does not exist. Please create it first.")
+    sheet_headers = list(sheet_rows[0])
+
+    # Steps 1-4: merge with the cleaning sheet and create clean and status variables
+    df, rows_to_append, merged_df = _clean_with_sheet(
+        df, _read_sheet(sheet_rows), sheet_headers, var_name,
+        dtype=dtype, comment=comment, free_text=free_text,
+        mc_fc_vars=mc_fc_vars, affected_vars=affected_vars
+    )
+
+    # Append ONLY new rows (no header), the workbook is only rewritten if there are any
+    if not rows_to_append.empty:
+        append_rows(file_name, {
+            sheet_name: list(dataframe_to_rows(rows_to_append, index=False, header=False))
+        })
     
-    # Step 5: If specified, produce short report of cleaning progress (e.g. no unique values, % cleaned, % pending, % exclude, etc.)
+    # Step 5: If specified, produce short report of cleaning progress
     if report:
-        total_unique = len(merged_df)
-        num_cleaned = len(merged_df[merged_df["status"] == "Cleaned"])
-        num_exclude = len(merged_df[merged_df["status"] == "Exclude"])
-        num_pending = len(merged_df[merged_df["status"] == "Pending"])
-        num_unchecked = len(merged_df[merged_df["status"] == "Unchecked"])
-
-        print(f"Cleaning progress for {var_name}:")
-        print(f"Total unique value combinations: {total_unique}")
-        print(f"Cleaned combinations: {num_cleaned}")
-        print(f"Pending combinations: {num_pending}")
-        print(f"Excluded combinations: {num_exclude}")
-        print(f"Unchecked combinations: {num_unchecked}")
-    return df
\ No newline at end of file
+        _print_report(var_name, merged_df)
+    return df
+
+
+@profiled
+def clean_unique_values_batch(df, file_name, variables, report=False):
+    """
+    Clean the unique values of many variables against one cleaning workbook.
+
+    Same result as calling clean_unique_values for each variable in turn (including
+    variables that share a sheet, which see the rows appended for earlier variables),
+    but the sheets are read once and the workbook is saved once, only if new rows
+    were appended.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Main dataset.
+    file_name : path-like
+        Cleaning workbook (all sheets must exist, see create_empty_cleaning_sheet).
+    variables : list[dict]
+        One dict per variable, in cleaning order, with "var_name" and the other
+        keyword arguments of clean_unique_values ("sheet_name" defaults to
+        var_name; "dtype", "comment", "free_text", "mc_fc_vars", "report" and
+        "affected_vars" as in clean_unique_values).
+    report : bool, default False
+        Print the cleaning progress of every variable (unless set per variable).
+
+    Returns
+    -------
+    pd.DataFrame
+        df with the *_clean, *_status (and *_aff_vars) columns of all variables.
+    """
+    sheets = {}  # {sheet name: (headers, rows incl. those appended, as they will be read back)}
+    new_rows = {}  # {sheet name: rows to append}
+
+    for spec in variables:
+        spec = dict(spec)
+        var_name = spec.pop("var_name")
+        sheet_name = spec.pop("sheet_name", var_name)
+        var_report = spec.pop("report", report)
+
+        if sheet_name not in sheets:
+            sheet_rows = workbook_snapshot.sheet_rows(file_name, sheet_name)
+            if sheet_rows is None:
+                raise ValueError(f"Sheet {sheet_name} does not exist. Please create it first.")
+            sheets[sheet_name] = (list(sheet_rows[0]), sheet_rows)
+        sheet_headers, sheet_rows = sheets[sheet_name]
+
+        # The sheet includes the rows appended for earlier variables of the same sheet
+        df, rows_to_append, merged_df = _clean_with_sheet(
+            df, _read_sheet(sheet_rows), sheet_headers, var_name, **spec
+        )
+
+        for r in dataframe_to_rows(rows_to_append, index=False, header=False):
+            new_rows.setdefault(sheet_name, []).append(r)
+            sheet_rows.append(tuple(workbook_snapshot.read_back_value(v) for v in r))
+
+        if var_report:
+            _print_report(var_name, merged_df)
+
+    if new_rows:
+        append_rows(file_name, new_rows)
+
+    return df
@@ -0,0 +1,276 @@
+# Functions to read cleaning workbooks through a sidecar snapshot instead of parsing the xlsx on every call:
+#   (1) Keep the cell values of all sheets of a workbook in a Parquet snapshot next to it
+#       (.snapshots/<workbook name>.parquet, values type-tagged as in extraction_cache), together with
+#       the workbook's size, modification time and sha256 (not computed after appends, see extend_snapshot)
+#   (2) Serve sheet rows from the snapshot while the workbook is unchanged (same size and modification
+#       time, or same content after it was only touched); parse the workbook once and rebuild the
+#       snapshot when someone edited it
+#   (3) Update the snapshot from the in-memory workbook after a cleaning function saved it, or extend it
+#       with the rows workbook_writer.append_rows appended (written as an extra Parquet part, the rows
+#       already in the snapshot are not rewritten), so that the next call does not parse the workbook again
+#
+# Rows are returned as list(ws.values) would return them for the workbook loaded with load_workbook.
+
+import datetime
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+from extraction_cache import decode_value, encode_value, hash_file
+
+# Bump to rebuild all snapshots when the stored format changes
+SNAPSHOT_VERSION = 1
+
+CELL_COLUMNS = ["sheet", "value_type", "value"]
+
+# Appended parts kept before the snapshot is rewritten as one file
+MAX_APPENDED_PARTS = 20
+
+# Snapshots already read in this process ({resolved workbook path: (size, mtime_ns, {sheet: rows})})
+_loaded = {}
+
+
+def _paths(file_name):
+    file_name = Path(file_name)
+    folder = file_name.parent / ".snapshots"
+    return folder / f"{file_name.name}.parquet", folder / f"{file_name.name}.json"
+
+
+def _appended_path(snapshot_path, i):
+    """Parquet file of the i-th block of appended rows (1, 2, ...)."""
+    return snapshot_path.with_name(f"{snapshot_path.stem}.{i}.parquet")
+
+
+def _read_manifest(manifest_path):
+    """Manifest of a snapshot, or None if there is none (or it has another version)."""
+    if not manifest_path.exists():
+        return None
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    return manifest if manifest.get("version") == SNAPSHOT_VERSION else None
+
+
+def _pad(rows):
+    """Rows padded with None to the width of the widest (as list(ws.values) returns them)."""
+    width = max((len(r) for r in rows), default=0)
+    if all(len(r) == width for r in rows):
+        return rows
+    return [tuple(r) + (None,) * (width - len(r)) for r in rows]
+
+
+def read_back_value(v):
+    """Value of a cell written with openpyxl as it is read back from the saved workbook."""
+    if isinstance(v, np.generic):
+        v = v.item()
+    if isinstance(v, str) and v == "":
+        return None  # empty strings are not written
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        if isinstance(v, float) and not np.isfinite(v):
+            return None  # NaN and infinity are written as empty
+        # Numbers are written with 16 significant digits and read as int if there is no "." or exponent
+        text = "%.16g" % v
+        return float(text) if any(c in text for c in ".eE") else int(text)
+    if isinstance(v, pd.Timestamp):
+        return v.to_pydatetime()
+    if isinstance(v, datetime.date) and not isinstance(v, datetime.datetime):
+        return datetime.datetime.combine(v, datetime.time())  # dates are read as datetimes
+    return v
+
+
+def _encode_cells(sheets):
+    """Cells of {sheet: rows} in row-major order (a DataFrame of CELL_COLUMNS) and the shape of each sheet."""
+    cells = []
+    shapes = {}
+    for sheet, rows in sheets.items():
+        width = max((len(r) for r in rows), default=0)
+        shapes[sheet] = [len(rows), width]
+        for row in rows:
+            for v in tuple(row) + (None,) * (width - len(row)):
+                cells.append((sheet, *encode_value(v)))
+    return pd.DataFrame(cells, columns=CELL_COLUMNS), shapes
+
+
+def _remove(snapshot_path, manifest_path):
+    """Remove a snapshot (its file, appended parts and manifest)."""
+    manifest = _read_manifest(manifest_path)
+    for i in range(1, len(manifest.get("appended", [])) + 1 if manifest else 1):
+        _appended_path(snapshot_path, i).unlink(missing_ok=True)
+    snapshot_path.unlink(missing_ok=True)
+    manifest_path.unlink(missing_ok=True)
+
+
+def _write_manifest(manifest_path, manifest):
+    Path(f"{manifest_path}.tmp").write_text(json.dumps(manifest, indent=1), encoding="utf-8")
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def _write(file_name, sheets, content_hash=True):
+    """Write the snapshot of a workbook ({sheet: rows}) with the workbook's current size, mtime and hash (if content_hash)."""
+    snapshot_path, manifest_path = _paths(file_name)
+    snapshot_path.parent.mkdir(exist_ok=True)
+
+    stat = os.stat(file_name)
+    _loaded[Path(file_name).resolve()] = (stat.st_size, stat.st_mtime_ns, sheets)
+
+    try:
+        cells, shapes = _encode_cells(sheets)
+    except TypeError:
+        # Cell type that cannot be stored (e.g. array formulas): no snapshot for this workbook
+        _remove(snapshot_path, manifest_path)
+        return
+
+    manifest = {
+        "version": SNAPSHOT_VERSION,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": hash_file(file_name) if content_hash else None,
+        "sheets": shapes,
+    }
+
+    cells.to_parquet(f"{snapshot_path}.tmp", index=False)
+    _remove(snapshot_path, manifest_path)
+    os.replace(f"{snapshot_path}.tmp", snapshot_path)
+    _write_manifest(manifest_path, manifest)
+
+
+def _read(snapshot_path, shapes):
+    """Rebuild {sheet: rows} from a snapshot file."""
+    cells = pd.read_parquet(snapshot_path)
+    types = cells["value_type"].to_numpy()
+    values = cells["value"].to_numpy(dtype=object).copy()
+
+    # Strings and empty cells are most cells, decode the rest one by one
+    values[types == "none"] = None
+    for i in np.flatnonzero((types != "str") & (types != "none")):
+        values[i] = decode_value(types[i], values[i])
+
+    sheets = {}
+    start = 0
+    for sheet, (n_rows, width) in shapes.items():
+        block = values[start:start + n_rows * width].reshape(n_rows, width)
+        sheets[sheet] = [tuple(row) for row in block]
+        start += n_rows * width
+    return sheets
+
+
+def _read_all(snapshot_path, manifest):
+    """Rebuild {sheet: rows} from a snapshot file and its appended parts."""
+    sheets = _read(snapshot_path, manifest["sheets"])
+    for i, shapes in enumerate(manifest.get("appended", []), start=1):
+        for sheet, rows in _read(_appended_path(snapshot_path, i), shapes).items():
+            sheets[sheet] = _pad(sheets[sheet] + rows)
+    return sheets
+
+
+def load_rows(file_name):
+    """
+    Return the rows of all sheets of a workbook ({sheet name: list of row tuples, header first}).
+
+    Served from the snapshot if the workbook is unchanged since it was written, otherwise the
+    workbook is parsed and the snapshot rebuilt. The returned lists must not be modified.
+    """
+    file_name = Path(file_name)
+    stat = os.stat(file_name)
+    key = file_name.resolve()
+
+    if key in _loaded and _loaded[key][:2] == (stat.st_size, stat.st_mtime_ns):
+        return _loaded[key][2]
+
+    snapshot_path, manifest_path = _paths(file_name)
+    manifest = _read_manifest(manifest_path) if snapshot_path.exists() else None
+
+    if manifest is not None:
+        unchanged = (manifest["size"], manifest["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns)
+        if not unchanged and manifest["sha256"] is not None and manifest["sha256"] == hash_file(file_name):
+            # Touched or copied, content unchanged: keep the snapshot, record the new mtime
+            manifest.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            _write_manifest(manifest_path, manifest)
+            unchanged = True
+        if unchanged:
+            sheets = _read_all(snapshot_path, manifest)
+            _loaded[key] = (stat.st_size, stat.st_mtime_ns, sheets)
+            return sheets
+
+    # Edited (or no snapshot yet): parse the workbook once for all sheets
+    wb = load_workbook(file_name)
+    try:
+        sheets = {ws.title: list(ws.values) for ws in wb.worksheets}
+    finally:
+        wb.close()
+    _write(file_name, sheets)
+    return sheets
+
+
+def sheet_rows(file_name, sheet_name):
+    """Rows of one sheet (a new list, header first), or None if the sheet does not exist."""
+    sheets = load_rows(file_name)
+    if sheet_name not in sheets:
+        return None
+    return list(sheets[sheet_name])
+
+
+def update_snapshot(file_name, wb):
+    """Refresh the snapshot of a workbook just saved with wb.save(file_name), without re-parsing it."""
+    sheets = {
+        ws.title: [tuple(read_back_value(v) for v in row) for row in ws.values]
+        for ws in wb.worksheets
+    }
+    _write(file_name, sheets)
+
+
+def is_current(file_name):
+    """True if the workbook has a snapshot written for its current size and modification time."""
+    stat = os.stat(file_name)
+    snapshot_path, manifest_path = _paths(file_name)
+    manifest = _read_manifest(manifest_path)
+    return manifest is not None and snapshot_path.exists() \
+        and (manifest["size"], manifest["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns)
+
+
+def extend_snapshot(file_name, appended_rows, signature):
+    """
+    Add rows just appended to sheets of a workbook ({sheet: rows as read back}) to its snapshot.
+
+    signature is the workbook's (size, mtime_ns) before the rows were appended; the snapshot must
+    have been current then (see is_current). The new rows are written as an extra Parquet part, or the
+    snapshot is rewritten as one file once it has MAX_APPENDED_PARTS parts.
+    """
+    snapshot_path, manifest_path = _paths(file_name)
+    manifest = _read_manifest(manifest_path)
+    if manifest is None or (manifest["size"], manifest["mtime_ns"]) != tuple(signature):
+        return
+    key = Path(file_name).resolve()
+
+    if len(manifest.get("appended", [])) >= MAX_APPENDED_PARTS:
+        if key in _loaded and _loaded[key][:2] == tuple(signature):
+            sheets = dict(_loaded[key][2])
+        else:
+            sheets = _read_all(snapshot_path, manifest)
+        for sheet, rows in appended_rows.items():
+            sheets[sheet] = _pad(sheets[sheet] + list(rows))
+        _write(file_name, sheets, content_hash=False)
+        return
+
+    try:
+        cells, shapes = _encode_cells(appended_rows)
+    except TypeError:
+        _remove(snapshot_path, manifest_path)
+        return
+
+    stat = os.stat(file_name)
+    manifest["appended"] = manifest.get("appended", []) + [shapes]
+    # The workbook is not hashed again (that would read the whole file on every append): without a hash, a
+    # workbook that is only touched later is parsed again instead of being recognised as unchanged
+    manifest.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=None)
+    cells.to_parquet(_appended_path(snapshot_path, len(manifest["appended"])), index=False)
+    _write_manifest(manifest_path, manifest)
+
+    # Rows already read in this process: extend them as well
+    if key in _loaded and _loaded[key][:2] == tuple(signature):
+        sheets = dict(_loaded[key][2])
+        for sheet, rows in appended_rows.items():
+            sheets[sheet] = _pad(sheets[sheet] + list(rows))
+        _loaded[key] = (stat.st_size, stat.st_mtime_ns, sheets)
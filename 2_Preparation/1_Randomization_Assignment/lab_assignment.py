@@ -1,20 +1,190 @@
 import pandas as pd
 import numpy as np 
+from scipy.optimize import Bounds, LinearConstraint, milp
+from scipy.sparse import coo_matrix
 
-# Assignment function
-def assign_enumerators(labs_df, enum_df, n_treat = 3, n_control = 3, seed = 110):
-    """ Assign enumerators to lab groups.
-    
-    - Each enumerator is assigned to 3 treatment and 3 control lab groups by default.
-    - Takes into account n_treated and n_control for each enumerator if given.
-    - Takes into account 2 location restrictions.
-    - No lab is assigned twice.
-    
-    Returns:
-    - assignments: labs with assigned enumerators
-    - leftover_treatment: treatment labs without enumerators
-    - leftover_control: control labs without enumerators
-    """
+ARMS = ["treatment", "control"]
+
+# Enumerator info added to the assigned labs (assignment column -> enumerator column)
+ENUM_INFO = {
+    "enum_lastname": "lastname",
+    "enum_firstname": "firstname",
+    "enum_id": "id",
+    "enum_email": "email_cleaned",
+    "enum_foldername": "foldername",
+    "enum_restriction": "restriction",
+}
+
+
+# Helper: labs with the enumerator's info
+def _add_enum_info(assigned, enum):
+    assigned = assigned.copy()
+    for col, enum_col in ENUM_INFO.items():
+        assigned[col] = enum[enum_col]
+    return assigned
+
+
+# Helper: number of treatment and control labs wanted by each enumerator (n_treated/n_control if
+# given, otherwise the defaults)
+def _quotas(enum_df, n_treat, n_control):
+    quotas = []
+    for col, default in [("n_treated", n_treat), ("n_control", n_control)]:
+        values = pd.to_numeric(enum_df[col], errors="raise") if col in enum_df else pd.Series(np.nan, index=enum_df.index)
+        quotas.append(values.fillna(default).astype(int).to_numpy())
+    return quotas
+
+
+# Helper: location flags of the labs and location restrictions of the enumerators, one column per
+# restriction that some enumerator has (enumerators with a restriction only visit labs in that location)
+def _locations(labs_df, enum_df):
+    lab_flags, enum_flags = [], []
+    for restriction_col, location_col in [("restriction_sch", "Location SCH"), ("restriction_bot", "Location BOT")]:
+        if restriction_col in enum_df and (enum_df[restriction_col] == 1).any():
+            lab_flags.append((labs_df[location_col] == 1).to_numpy())
+            enum_flags.append((enum_df[restriction_col] == 1).to_numpy())
+    return (np.array(lab_flags, dtype=bool).reshape(len(lab_flags), len(labs_df)).T,
+            np.array(enum_flags, dtype=bool).reshape(len(enum_flags), len(enum_df)).T)
+
+
+# Helper: number of labs of each kind (columns) given to each group of enumerators (rows), solved as
+# an integer programme over x = (labs of each allowed group-kind pair, treatment labs above the
+# treatment quota and control labs above the control quota of each group):
+#   (1) as many labs as possible are assigned (weight M on each lab)
+#   (2) then as few labs as possible replace a lab of the other arm (weight 1 on each excess lab)
+#   (3) then a random choice among the remaining optimal solutions (random weights summing to < 1)
+def _solve_counts(quota_treat, quota_control, allowed, kind_arm, kind_size, rng):
+    n_groups = len(quota_treat)
+    quota = quota_treat + quota_control
+    pair_group, pair_kind = np.nonzero(allowed & (kind_size > 0))
+    n_pairs = len(pair_group)
+
+    big_m = quota.sum() + 2
+    noise = rng.uniform(size=n_pairs) / (quota.sum() + 1)
+    cost = np.concatenate([-big_m + noise, np.ones(2 * n_groups)])
+
+    pairs = np.arange(n_pairs)
+    groups = np.arange(n_groups)
+    constraints = [
+        (pair_group, pairs, np.ones(n_pairs), quota),  # labs per group <= its quota
+        (pair_kind, pairs, np.ones(n_pairs), kind_size),  # labs of each kind assigned at most once
+    ]
+    for arm, arm_quota in enumerate([quota_treat, quota_control]):
+        # labs of the arm - labs above the arm's quota <= the arm's quota
+        arm_pairs = kind_arm[pair_kind] == arm
+        constraints.append((np.concatenate([pair_group[arm_pairs], groups]),
+                            np.concatenate([pairs[arm_pairs], n_pairs + arm * n_groups + groups]),
+                            np.concatenate([np.ones(arm_pairs.sum()), -np.ones(n_groups)]),
+                            arm_quota))
+
+    rows, cols, vals, upper = [], [], [], []
+    for constraint_rows, constraint_cols, constraint_vals, constraint_upper in constraints:
+        rows.append(constraint_rows + sum(len(u) for u in upper))
+        cols.append(constraint_cols)
+        vals.append(constraint_vals)
+        upper.append(constraint_upper)
+    upper = np.concatenate(upper).astype(float)
+    matrix = coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                        shape=(len(upper), len(cost)))
+    result = milp(
+        cost,
+        constraints=LinearConstraint(matrix.tocsr(), -np.inf, upper),
+        integrality=np.ones(len(cost)),
+        bounds=Bounds(0, np.concatenate([np.minimum(quota[pair_group], kind_size[pair_kind]),
+                                         np.full(2 * n_groups, np.inf)])),
+    )
+    if not result.success:
+        raise RuntimeError(f"Assignment could not be solved: {result.message}")
+
+    counts = np.zeros(allowed.shape, dtype=int)
+    counts[pair_group, pair_kind] = np.round(result.x[:n_pairs]).astype(int)
+    return counts
+
+
+# Optimal assignment: the number of labs of each kind (treatment status × location) every group of
+# interchangeable enumerators (same restrictions and quotas) gets is solved for all groups at once, then
+# the labs of each kind are shuffled and dealt out to the enumerators
+def _assign_optimal(labs_df, enum_df, n_treat, n_control, seed):
+    rng = np.random.RandomState(seed)
+    n_enums = len(enum_df)
+    quota_treat, quota_control = _quotas(enum_df, n_treat, n_control)
+    quota = quota_treat + quota_control
+
+    # Kinds of labs (arm 0 = treatment, 1 = control, and location flags)
+    status = labs_df["Treatment Status"].to_numpy()
+    in_arm = np.isin(status, ARMS)
+    arm_labs = labs_df[in_arm]
+    lab_flags, enum_flags = _locations(arm_labs, enum_df)
+    kinds, kind_of_lab = np.unique(
+        np.column_stack([(status[in_arm] == ARMS[1]).astype(int), lab_flags.astype(int)]),
+        axis=0, return_inverse=True,
+    )
+    kind_of_lab = kind_of_lab.ravel()
+    kind_arm, kind_flags = kinds[:, 0], kinds[:, 1:].astype(bool)
+    kind_size = np.bincount(kind_of_lab, minlength=len(kinds))
+
+    # Groups of enumerators and the kinds of labs their location restrictions allow
+    groups, group_of_enum = np.unique(
+        np.column_stack([enum_flags.astype(int), quota_treat, quota_control]), axis=0, return_inverse=True
+    )
+    group_of_enum = group_of_enum.ravel()
+    group_size = np.bincount(group_of_enum, minlength=len(groups))
+    group_flags = groups[:, :-2].astype(bool)
+    allowed = ~(group_flags[:, None, :] & ~kind_flags[None, :, :]).any(axis=2)
+    counts = _solve_counts(group_size * groups[:, -2], group_size * groups[:, -1], allowed, kind_arm, kind_size, rng)
+
+    # Deal out the labs: shuffled labs of each kind to the groups, then within each group (enumerators in
+    # random order) first up to each enumerator's treatment and control quota, then the labs replacing
+    # a lab of the other arm to enumerators with room left
+    labs_by_kind = [list(rng.permutation(np.flatnonzero(kind_of_lab == k))) for k in range(len(kinds))]
+    lab_positions = [[[], []] for _ in range(n_enums)]  # per enumerator: treatment, control
+    arm_quotas = [quota_treat, quota_control]
+    for g in range(len(groups)):
+        pool = [[], []]
+        for k in np.flatnonzero(counts[g]):
+            pool[kind_arm[k]] += labs_by_kind[k][:counts[g, k]]
+            labs_by_kind[k] = labs_by_kind[k][counts[g, k]:]
+        members = rng.permutation(np.flatnonzero(group_of_enum == g))
+        for arm in (0, 1):
+            for i in members:
+                take = min(arm_quotas[arm][i], len(pool[arm]))
+                lab_positions[i][arm] += pool[arm][:take]
+                pool[arm] = pool[arm][take:]
+        for arm in (0, 1):
+            for i in members:
+                take = min(quota[i] - len(lab_positions[i][0]) - len(lab_positions[i][1]), len(pool[arm]))
+                lab_positions[i][arm] += pool[arm][:take]
+                pool[arm] = pool[arm][take:]
+
+    enum_ids = enum_df["id"].to_numpy()
+    positions, enum_of_lab = [], []
+    for i, (treat_positions, control_positions) in enumerate(lab_positions):
+        n_t, n_c = len(treat_positions), len(control_positions)
+        if n_t + n_c == 0:
+            if quota[i] > 0:
+                print(f"No labs available for enumerator {enum_ids[i]}. Skipping.")
+            continue
+        if n_t < quota_treat[i] or n_c < quota_control[i]:
+            print(f"Warning: Only {n_t} treatment and {n_c} control labs available for enumerator {enum_ids[i]} "
+                  f"({quota_treat[i]} treatment and {quota_control[i]} control wanted).")
+        positions += sorted(treat_positions) + sorted(control_positions)
+        enum_of_lab += [i] * (n_t + n_c)
+
+    # Assign enumerator info (all labs at once)
+    assignments = arm_labs.iloc[positions].copy()
+    enum_info = enum_df.iloc[enum_of_lab]
+    for col, enum_col in ENUM_INFO.items():
+        assignments[col] = enum_info[enum_col].to_numpy()
+
+    # Leftover labs
+    leftover_labs = labs_df[~labs_df["labgroupid"].isin(assignments["labgroupid"])]
+    leftover_treatment = leftover_labs[leftover_labs["Treatment Status"] == "treatment"]
+    leftover_control = leftover_labs[leftover_labs["Treatment Status"] == "control"]
+
+    return assignments, leftover_treatment, leftover_control
+
+
+# Greedy assignment (enumerators one after another, in row order)
+def _assign_greedy(labs_df, enum_df, n_treat, n_control, seed):
     rng = np.random.RandomState(seed)
 
     leftover_labs = labs_df.copy()
@@ -72,13 +242,7 @@ def assign_enumerators(labs_df, enum_df, n_treat = 3, n_control = 3, seed = 110)
         assigned = pd.concat([assigned_treat, assigned_control])
 
         # Assign enumerator info
-        assigned = assigned.copy()
-        assigned["enum_lastname"] = enum["lastname"]
-        assigned["enum_firstname"] = enum["firstname"]
-        assigned["enum_id"] = enum["id"]
-        assigned["enum_email"] = enum["email_cleaned"]
-        assigned["enum_foldername"] = enum["foldername"]
-        assigned["enum_restriction"] = enum["restriction"]
+        assigned = _add_enum_info(assigned, enum)
 
         # Append to assignments and remove from leftover labs
         assignments = pd.concat([assignments, assigned])
@@ -92,3 +256,33 @@ def assign_enumerators(labs_df, enum_df, n_treat = 3, n_control = 3, seed = 110)
     leftover_control = leftover_labs[leftover_labs["Treatment Status"] == "control"]
 
     return assignments, leftover_treatment, leftover_control
+
+
+# Assignment function
+def assign_enumerators(labs_df, enum_df, n_treat = 3, n_control = 3, seed = 110, method = "greedy"):
+    """ Assign enumerators to lab groups.
+    
+    - Each enumerator is assigned to 3 treatment and 3 control lab groups by default.
+    - Takes into account n_treated and n_control for each enumerator if given.
+    - Takes into account 2 location restrictions.
+    - If there are not enough labs of one arm, labs of the other arm are assigned instead.
+    - No lab is assigned twice.
+
+    method="greedy" (default) walks the enumerators in row order and samples labs from those left over
+    (the method of all assignments so far, so re-running their notebooks gives the same assignments;
+    late enumerators with location restrictions can end up short).
+    method="optimal" solves the assignment for all enumerators at once (integer programme over groups
+    of enumerators × kinds of labs): as many labs as possible are assigned, then as few as possible
+    replace a lab of the other arm, and the choice among equally good assignments is random (seeded).
+    Which enumerators end up short does not depend on their order. Opt in for new assignments only.
+    
+    Returns:
+    - assignments: labs with assigned enumerators
+    - leftover_treatment: treatment labs without enumerators
+    - leftover_control: control labs without enumerators
+    """
+    if method == "optimal":
+        return _assign_optimal(labs_df, enum_df, n_treat, n_control, seed)
+    if method == "greedy":
+        return _assign_greedy(labs_df, enum_df, n_treat, n_control, seed)
+    raise ValueError(f"Unknown method '{method}', use 'optimal' or 'greedy'.")
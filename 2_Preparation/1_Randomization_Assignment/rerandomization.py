@@ -0,0 +1,202 @@
+# Functions for stratified re-randomization of lab groups into treatment and control:
+#   (1) draw_assignments: draw many candidate assignments at once, as a draws × labs 0/1 matrix
+#       (1 = treatment), 50/50 within each stratum and the extra lab of odd strata assigned at
+#       random, as stratified_randomize in the randomization notebooks
+#   (2) balance_statistics: covariate balance of all draws in one pass (matrix products)
+#   (3) rerandomize: accept the first draw (or the best one) that passes a balance threshold
+# All draws come from one np.random.default_rng(seed), so the same seed (config.SEED) and the same labs
+# in the same order give the same assignment.
+
+import numpy as np
+import pandas as pd
+
+ARMS = ["treatment", "control"]
+
+
+# Helper: numeric covariate matrix (categorical covariates as one dummy per category, missing values
+# replaced by the column mean so that they do not affect balance)
+def _covariate_matrix(df, covariates):
+    X = pd.get_dummies(df[covariates], dtype=float)
+    X = X.apply(pd.to_numeric, errors="raise").astype(float)
+    X = X.fillna(X.mean())
+    return X.loc[:, X.std(ddof=0) > 0]
+
+
+def draw_assignments(strata, n_draws, rng, n_treated=None):
+    """
+    Draw stratified 50/50 assignments (or a fixed number of treated labs per stratum).
+
+    Parameters
+    ----------
+    strata : array-like
+        Stratum of each lab (e.g. faculty).
+    n_draws : int
+        Number of assignments to draw.
+    rng : np.random.Generator
+    n_treated : array-like, optional
+        Number of treated labs in each stratum (strata in order of first appearance), the same in
+        every draw, e.g. the observed numbers for a permutation test. By default 50/50.
+
+    Returns
+    -------
+    np.ndarray
+        n_draws × labs matrix, 1 = treatment, 0 = control. By default, in each draw and stratum, half
+        of the labs are treated; the extra lab of an odd stratum is treated with probability 1/2.
+    """
+    codes = pd.factorize(pd.Series(strata), use_na_sentinel=False)[0]
+    n_labs = len(codes)
+    stratum_size = np.bincount(codes)
+    stratum_start = np.concatenate([[0], np.cumsum(stratum_size)[:-1]])
+
+    # Random order of the labs within each stratum (strata in code order): sort code + uniform
+    order = np.argsort(codes + rng.random((n_draws, n_labs)), axis=1)
+
+    # The first n_treated labs of each stratum (in the random order) are treated
+    if n_treated is None:
+        n_treated = stratum_size // 2 + (stratum_size % 2) * rng.integers(0, 2, (n_draws, len(stratum_size)))
+    else:
+        n_treated = np.broadcast_to(np.asarray(n_treated), (n_draws, len(stratum_size)))
+    sorted_codes = np.sort(codes)
+    rank = np.arange(n_labs) - stratum_start[sorted_codes]
+    treated = (rank < n_treated[:, sorted_codes]).astype(np.int8)
+
+    draws = np.empty((n_draws, n_labs), dtype=np.int8)
+    np.put_along_axis(draws, order, treated, axis=1)
+    return draws
+
+
+def balance_statistics(draws, X):
+    """
+    Covariate balance of every draw.
+
+    Parameters
+    ----------
+    draws : np.ndarray
+        Draws × labs 0/1 matrix (draw_assignments).
+    X : np.ndarray
+        Labs × covariates matrix.
+
+    Returns
+    -------
+    smd : np.ndarray
+        Draws × covariates standardized mean differences (treatment - control mean, over the
+        covariate's standard deviation in the sample).
+    mahalanobis : np.ndarray
+        Mahalanobis distance between treatment and control means of every draw,
+        n_t n_c / n (m_t - m_c)' S^-1 (m_t - m_c).
+    """
+    Z = draws.astype(float)
+    n = Z.shape[1]
+    n_t = Z.sum(axis=1, keepdims=True)
+    n_c = n - n_t
+    sum_t = Z @ X
+    diff = sum_t / n_t - (X.sum(axis=0) - sum_t) / n_c
+
+    smd = diff / X.std(axis=0, ddof=1)
+    S_inv = np.linalg.pinv(np.atleast_2d(np.cov(X, rowvar=False)))
+    mahalanobis = (n_t[:, 0] * n_c[:, 0] / n) * np.einsum("dk,kl,dl->d", diff, S_inv, diff)
+    return smd, mahalanobis
+
+
+def rerandomize(
+    df,
+    group_col,
+    covariates,
+    seed,
+    n_draws=10_000,
+    criterion="max_smd",
+    threshold=0.1,
+    accept="first",
+    treatment_col="Treatment Status",
+    batch_size=1_000,
+):
+    """
+    Stratified 50/50 randomization, re-drawn until the covariates are balanced.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Labs to randomize (one row per lab group).
+    group_col : str or list
+        Strata column(s), e.g. "Faculty".
+    covariates : list
+        Balance covariates (numeric, or categorical as dummies per category).
+    seed : int
+        Seed of the draws, e.g. config.SEED.
+    n_draws : int
+        Maximum number of draws (accept="first") or number of draws (accept="best").
+    criterion : str
+        "max_smd" (largest absolute standardized mean difference) or "mahalanobis".
+    threshold : float
+        A draw passes if its criterion is at most threshold (None: all draws pass).
+    accept : str
+        "first": the first draw that passes; "best": the draw with the smallest criterion of all
+        n_draws draws (it must pass as well).
+    treatment_col : str
+        Column for the assignment ("treatment" / "control").
+    batch_size : int
+        Draws generated and checked at once.
+
+    Returns
+    -------
+    assigned : pd.DataFrame
+        df with treatment_col.
+    balance : pd.DataFrame
+        Per covariate (dummy): mean in treatment and control and standardized mean difference of
+        the accepted draw.
+    summary : dict
+        Accepted draw number, its criterion, number of draws made and share of them that passed.
+    """
+    if criterion not in ["max_smd", "mahalanobis"]:
+        raise ValueError(f"Unknown criterion '{criterion}', use 'max_smd' or 'mahalanobis'.")
+    if accept not in ["first", "best"]:
+        raise ValueError(f"Unknown accept '{accept}', use 'first' or 'best'.")
+    if isinstance(group_col, str):
+        group_col = [group_col]
+
+    rng = np.random.default_rng(seed)
+    strata = pd.MultiIndex.from_frame(df[group_col]).to_flat_index()
+    X_frame = _covariate_matrix(df, covariates)
+    X = X_frame.to_numpy()
+
+    best = (np.inf, None, None)  # criterion, draw number, assignment
+    n_done, n_passed = 0, 0
+    while n_done < n_draws:
+        draws = draw_assignments(strata, min(batch_size, n_draws - n_done), rng)
+        smd, mahalanobis = balance_statistics(draws, X)
+        values = np.abs(smd).max(axis=1, initial=0.0) if criterion == "max_smd" else mahalanobis
+        passed = values <= threshold if threshold is not None else np.ones(len(values), dtype=bool)
+        n_passed += passed.sum()
+
+        if accept == "first" and passed.any():
+            i = np.argmax(passed)
+            best = (values[i], n_done + i, draws[i])
+            n_done += len(draws)
+            break
+        i = np.argmin(values)
+        if accept == "best" and passed[i] and values[i] < best[0]:
+            best = (values[i], n_done + i, draws[i])
+        n_done += len(draws)
+
+    value, draw_no, assignment = best
+    if assignment is None:
+        raise ValueError(f"No draw out of {n_done} has {criterion} <= {threshold}; "
+                         f"increase n_draws or the threshold.")
+
+    assigned = df.copy()
+    assigned[treatment_col] = np.where(assignment == 1, ARMS[0], ARMS[1])
+
+    treated = assignment == 1
+    balance = pd.DataFrame({
+        "covariate": X_frame.columns,
+        "mean_treatment": X[treated].mean(axis=0),
+        "mean_control": X[~treated].mean(axis=0),
+        "smd": balance_statistics(assignment[None, :], X)[0][0],
+    })
+    summary = {
+        "draw": int(draw_no),
+        criterion: float(value),
+        "n_draws": int(n_done),
+        "share_passed": float(n_passed / n_done),
+    }
+    return assigned, balance, summary
@@ -0,0 +1,209 @@
+# Batched estimation of one fixed effects model for several outcomes and subsamples (e.g. the heterogeneity analysis):
+#   (1) Fixed effect codes, clusters and regressors are built once on the base frame; a subsample is a boolean
+#       mask of its rows, so no subsample frame is copied
+#   (2) Per subsample, all outcomes and regressors are demeaned together in one pass (fe_demean.demean)
+#   (3) Each (outcome, subsample) fit is a BatchFit with the pyfixest accessors used in the notebooks and in
+#       make_regression_table (coef, se, tstat, pvalue, _N, _r2_within, ...), with CRV1 standard errors and the
+#       small sample correction of pf.feols (singletons dropped, fixed effects nested in clusters not counted)
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from fe_demean import demean, fixed_effect_codes
+
+
+class BatchFit:
+    """Results of one regression of feols_batch, with the accessors of a pyfixest Feols fit."""
+
+    def __init__(self, depvar, coefnames, beta, vcov, df_t, N, r2, adj_r2, r2_within, rows, base):
+        self._depvar = depvar
+        self._coefnames = coefnames
+        self._beta = beta
+        self._vcov = vcov
+        self._df_t = df_t
+        self._N = N
+        self._r2 = r2
+        self._adj_r2 = adj_r2
+        self._r2_within = r2_within
+        self._rows = rows
+        self._base = base
+
+    @property
+    def _data(self):
+        # Estimation sample (only built when asked for, e.g. for the baseline mean in make_regression_table)
+        return self._base.iloc[self._rows]
+
+    def coef(self):
+        return pd.Series(self._beta, index=self._coefnames, name="Estimate")
+
+    def se(self):
+        return pd.Series(np.sqrt(np.diag(self._vcov)), index=self._coefnames, name="Std. Error")
+
+    def tstat(self):
+        return (self.coef() / self.se()).rename("t value")
+
+    def pvalue(self):
+        return pd.Series(2 * stats.t.sf(np.abs(self.tstat()), self._df_t), index=self._coefnames, name="Pr(>|t|)")
+
+    def confint(self, alpha=0.05):
+        z = stats.t.ppf(1 - alpha / 2, self._df_t)
+        return pd.DataFrame({
+            f"{alpha / 2 * 100:.1f}%": self.coef() - z * self.se(),
+            f"{(1 - alpha / 2) * 100:.1f}%": self.coef() + z * self.se(),
+        })
+
+    def tidy(self):
+        return pd.concat([self.coef(), self.se(), self.tstat(), self.pvalue(), self.confint()], axis=1)
+
+    def summary(self):
+        print(f"Dep. var.: {self._depvar}, Observations: {self._N:,}, R2 Within: {self._r2_within:.3f}")
+        print(self.tidy().to_string())
+
+
+# Helper: regressor columns of a pyfixest-style right-hand side, e.g. "treated:post + no_researchers"
+def _regressors(df, regressors):
+    if isinstance(regressors, str):
+        regressors = [term.strip() for term in regressors.split("+")]
+    columns = {}
+    for term in regressors:
+        values = np.ones(len(df))
+        for col in term.split(":"):
+            values = values * df[col.strip()].to_numpy(dtype=float, na_value=np.nan)
+        columns[term] = values
+    return list(columns), np.column_stack(list(columns.values()))
+
+
+# Helper: drop observations of fixed effect levels with a single observation, until there are none
+def _drop_singletons(rows, fe_codes):
+    while True:
+        keep = np.ones(len(rows), dtype=bool)
+        for codes in fe_codes:
+            subset = codes[rows]
+            keep &= np.bincount(subset)[subset] > 1
+        if keep.all():
+            return rows
+        rows = rows[keep]
+
+
+# Helper: number of fixed effect parameters counted in the small sample correction (pyfixest's
+# k_fixef="nonnested": all levels, one less per extra fixed effect, without fixed effects nested in clusters).
+# Fixed effect and cluster codes are 0, ..., n - 1
+def _fixef_dof(fe_codes, cluster_codes):
+    n_levels = [codes.max() + 1 for codes in fe_codes]
+    nested = []
+    for codes, n in zip(fe_codes, n_levels):
+        # Nested: all observations of a level are in the same cluster
+        level_cluster = np.empty(n, dtype=cluster_codes.dtype)
+        level_cluster[codes] = cluster_codes
+        nested.append(bool((level_cluster[codes] == cluster_codes).all()))
+    k_fe = sum(n_levels) - (len(fe_codes) - 1) if len(fe_codes) > 1 else sum(n_levels)
+    if not any(nested):
+        return k_fe
+    return k_fe - sum(n for n, is_nested in zip(n_levels, nested) if is_nested) + sum(nested)
+
+
+# Helper: demeaned regressors that are not collinear with the previous ones (e.g. time-invariant regressors
+# absorbed by the lab fixed effects), like pf.feols these are dropped from the fit
+def _independent_columns(X, X_raw, tol=1e-9):
+    keep = []
+    for j in range(X.shape[1]):
+        column = X[:, j]
+        if keep:
+            column = column - X[:, keep] @ np.linalg.lstsq(X[:, keep], column, rcond=None)[0]
+        if column @ column > tol * max(X_raw[:, j] @ X_raw[:, j], 1.0):
+            keep.append(j)
+    return keep
+
+
+# Helper: one regression on demeaned data, CRV1 standard errors
+def _fit(depvar, coefnames, y, X, y_raw, fe_codes, clusters, rows, base):
+    N, k = X.shape
+    XX_inv = np.linalg.pinv(X.T @ X)
+    beta = XX_inv @ (X.T @ y)
+    resid = y - X @ beta
+
+    # Cluster sums of the scores
+    cluster_codes, cluster_ids = pd.factorize(clusters)
+    G = len(cluster_ids)
+    scores = np.zeros((G, k))
+    np.add.at(scores, cluster_codes, X * resid[:, None])
+    df_k = k + _fixef_dof(fe_codes, cluster_codes)
+    ssc = (N - 1) / (N - df_k) * G / (G - 1)
+    vcov = ssc * XX_inv @ (scores.T @ scores) @ XX_inv
+
+    ssu = resid @ resid
+    n_fe = sum(codes.max() for codes in fe_codes) + 1
+    r2 = 1 - ssu / np.sum((y_raw - y_raw.mean()) ** 2)
+    return BatchFit(
+        depvar, coefnames, beta, vcov, df_t=G - 1, N=N,
+        r2=r2,
+        adj_r2=1 - (1 - r2) * (N - 1) / (N - k - n_fe),
+        r2_within=1 - ssu / (y @ y),
+        rows=rows, base=base,
+    )
+
+
+def feols_batch(df, outcomes, masks, regressors="treated:post", fe="labgroupid + post", cluster="labgroupid"):
+    """
+    Fit "outcome ~ regressors | fe" with CRV1 standard errors for every outcome and subsample.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Base frame (all subsamples).
+    outcomes : list
+        Outcome columns, e.g. ["annual_electricity_total", "log_electricity"].
+    masks : dict
+        Subsample name -> boolean mask of the rows of df (array or Series aligned with df, missing = False),
+        e.g. {"MNF": df["faculty"] == "Faculty of Science (MNF)", "All": None} (None: all rows).
+    regressors : str or list
+        Right-hand side as in pf.feols, e.g. "treated:post" (a:b is the product of a and b).
+    fe : str or list
+        Fixed effects as in pf.feols, e.g. "labgroupid + post".
+    cluster : str
+        Cluster column of the CRV1 standard errors.
+
+    Returns
+    -------
+    dict
+        Outcome -> subsample name -> BatchFit. Same coefficients, standard errors and p-values as
+        pf.feols(f"{outcome} ~ {regressors} | {fe}", data=df[mask], vcov={"CRV1": cluster}).
+    """
+    if isinstance(outcomes, str):
+        outcomes = [outcomes]
+
+    # Shared across subsamples: fixed effect codes, clusters, regressors and outcomes of the base frame
+    fe_codes = fixed_effect_codes(df, fe)
+    clusters = df[cluster].to_numpy()
+    coefnames, X_all = _regressors(df, regressors)
+    Y_all = np.column_stack([df[outcome].to_numpy(dtype=float, na_value=np.nan) for outcome in outcomes])
+    complete = ~np.isnan(X_all).any(axis=1) & pd.notna(clusters)
+    for codes in fe_codes:
+        complete &= codes >= 0
+
+    fits = {outcome: {} for outcome in outcomes}
+    for name, mask in masks.items():
+        in_sample = complete.copy()
+        if mask is not None:
+            in_sample &= np.asarray(pd.Series(mask, index=df.index).fillna(False), dtype=bool)
+
+        # Outcomes with the same missing rows share the demeaning
+        outcome_missing = np.isnan(Y_all[in_sample])
+        patterns = {}
+        for j in range(len(outcomes)):
+            patterns.setdefault(outcome_missing[:, j].tobytes(), []).append(j)
+
+        for columns in patterns.values():
+            rows = np.flatnonzero(in_sample)[~outcome_missing[:, columns[0]]]
+            rows = _drop_singletons(rows, fe_codes)
+            sub_codes = [pd.factorize(codes[rows])[0] for codes in fe_codes]
+            demeaned = demean(np.column_stack([Y_all[rows][:, columns], X_all[rows]]), sub_codes)
+            keep = _independent_columns(demeaned[:, len(columns):], X_all[rows])
+            X = demeaned[:, len(columns):][:, keep]
+            for i, j in enumerate(columns):
+                fits[outcomes[j]][name] = _fit(
+                    outcomes[j], [coefnames[c] for c in keep], demeaned[:, i], X, Y_all[rows, j],
+                    sub_codes, clusters[rows], rows, df,
+                )
+    return fits
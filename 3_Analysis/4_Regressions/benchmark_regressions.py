@@ -0,0 +1,138 @@
+# Benchmark of the heterogeneity regressions of 4_2 on a synthetic balanced panel:
+#   (1) Build a synthetic panel (labgroupid × survey) with the columns used in 4_2 and its nine subsamples
+#   (2) Time the notebook's previous loop (a copy per subsample and one pf.feols call per subsample and outcome)
+#       against batch_estimation.feols_batch (boolean masks, one demeaning per subsample) and check that both
+#       give the same coefficients, standard errors, p-values and observation counts
+#
+# Usage (from the regressions folder):
+#   python benchmark_regressions.py                  # 2,000 lab groups
+#   python benchmark_regressions.py --labs 20000 --repeat 3
+
+import argparse
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import pyfixest as pf
+
+from batch_estimation import feols_batch
+
+OUTCOMES = ["annual_electricity_total", "log_electricity"]
+FACULTIES = ["Faculty of Science (MNF)", "Faculty of Medicine (MeF)", "Both MNF and MeF"]
+
+
+# ---------------------------
+# Synthetic data
+# ---------------------------
+
+def make_panel(n_labs=2_000, seed=0):
+    """Synthetic balanced panel with one BL and one EL observation per lab group."""
+    rng = np.random.default_rng(seed)
+    labs = pd.DataFrame({
+        "labgroupid": np.arange(n_labs) + 1,
+        "treated": rng.integers(0, 2, n_labs),
+        "faculty": rng.choice(FACULTIES, n_labs),
+        "no_researchers": rng.integers(1, 30, n_labs),
+    })
+    df = labs.loc[labs.index.repeat(2)].reset_index(drop=True)
+    df["survey"] = np.tile(["BL", "EL"], n_labs)
+    df["post"] = (df["survey"] == "EL").astype(int)
+
+    level = np.exp(rng.normal(8, 1.5, n_labs))[np.repeat(np.arange(n_labs), 2)]
+    df["annual_electricity_total"] = level * np.exp(rng.normal(0, 0.2, len(df))) * (1 - 0.05 * df["treated"] * df["post"])
+    it_share = np.where(rng.random(n_labs) < 0.3, 1.0, rng.uniform(0.05, 0.5, n_labs))[np.repeat(np.arange(n_labs), 2)]
+    df["annual_electricity_it"] = df["annual_electricity_total"] * it_share
+    df["log_electricity"] = np.log1p(df["annual_electricity_total"])
+    return df
+
+
+def subsample_masks(df):
+    """The nine subsamples of 4_2 as boolean masks of df."""
+    bl = df[df["survey"] == "BL"]
+    median_energy = bl["annual_electricity_total"].median()
+    it_only = bl["annual_electricity_it"] == bl["annual_electricity_total"]
+    median_size = df["no_researchers"].median()
+    return {
+        "MNF":             df["faculty"] == FACULTIES[0],
+        "MeF":             df["faculty"] == FACULTIES[1],
+        "Both":            df["faculty"] == FACULTIES[2],
+        "Low BL Energy":   df["labgroupid"].isin(bl.loc[bl["annual_electricity_total"] <= median_energy, "labgroupid"]),
+        "High BL Energy":  df["labgroupid"].isin(bl.loc[bl["annual_electricity_total"] > median_energy, "labgroupid"]),
+        "IT Only":         df["labgroupid"].isin(bl.loc[it_only, "labgroupid"]),
+        "Other Equipment": df["labgroupid"].isin(bl.loc[~it_only, "labgroupid"]),
+        "Small Labs":      df["no_researchers"] <= median_size,
+        "Large Labs":      df["no_researchers"] > median_size,
+    }
+
+
+# ---------------------------
+# Legacy reference (the notebook's previous loop)
+# ---------------------------
+
+def legacy_subsample_fits(df, masks):
+    subsamples = {name: df[mask].copy() for name, mask in masks.items()}
+    fits = {outcome: {} for outcome in OUTCOMES}
+    for name, df_sub in subsamples.items():
+        for outcome in OUTCOMES:
+            fits[outcome][name] = pf.feols(
+                f"{outcome} ~ treated:post | labgroupid + post",
+                data=df_sub, vcov={"CRV1": "labgroupid"}
+            )
+    return fits
+
+
+# ---------------------------
+# Benchmarks
+# ---------------------------
+
+def _time(func, repeat):
+    """Best wall time of repeat calls (seconds) and the result of the last call."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_heterogeneity(n_labs=2_000, repeat=1):
+    """Subsample regressions of 4_2, one pf.feols call per fit vs feols_batch."""
+    df = make_panel(n_labs)
+    masks = subsample_masks(df)
+
+    # First pf.feols call compiles pyfixest's numba functions, not part of the timing
+    pf.feols("log_electricity ~ treated:post | labgroupid + post", data=df, vcov={"CRV1": "labgroupid"})
+
+    t_old, old = _time(lambda: legacy_subsample_fits(df, masks), repeat)
+    t_new, new = _time(lambda: feols_batch(df, OUTCOMES, masks), repeat)
+
+    for outcome in OUTCOMES:
+        for name in masks:
+            a, b = old[outcome][name], new[outcome][name]
+            assert a._N == b._N, (outcome, name)
+            for accessor in ["coef", "se", "pvalue"]:
+                np.testing.assert_allclose(getattr(a, accessor)(), getattr(b, accessor)(), rtol=1e-6, atol=1e-12,
+                                           err_msg=f"{accessor} of {outcome}, {name}")
+    n_fits = len(OUTCOMES) * len(masks)
+    return [(f"heterogeneity fits (4_2, {n_fits} fits)", len(df), t_old, t_new)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the heterogeneity regressions on a synthetic panel.")
+    parser.add_argument("--labs", type=int, default=2_000, help="lab groups of the synthetic panel")
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs of each implementation")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore", module="pyfixest")
+    results = bench_heterogeneity(args.labs, args.repeat)
+
+    print(f"Synthetic panel: {args.labs:,} lab groups (BL and EL)")
+    print("(coefficients, standard errors and p-values identical to pf.feols)")
+    print(f"{'step':<38} {'rows':>8} {'legacy (s)':>11} {'current (s)':>12} {'speed-up':>9}")
+    for step, n_items, t_old, t_new in results:
+        print(f"{step:<38} {n_items:>8,} {t_old:>11.3f} {t_new:>12.3f} {t_old / t_new:>8.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# Functions to load the final dataset in the regression notebooks:
+#   (1) Convert final_dataset.csv once into an uncompressed Arrow IPC file next to it (final_dataset.arrow),
+#       adding the derived columns used by the regressions (post, log_electricity, balanced_panel)
+#   (2) Rebuild the Arrow file only when the CSV changed (CSV size and modification time stored in its metadata)
+#   (3) Load through a memory map, reading only the requested columns and (optionally) the balanced panel rows
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Bump to rebuild existing Arrow files when the derived columns change
+ARROW_VERSION = "1"
+
+DERIVED_COLUMNS = ["post", "log_electricity", "balanced_panel"]
+
+# Always loaded (needed for the balanced panel filter and the baseline means in make_regression_table)
+KEY_COLUMNS = ["labgroupid", "survey"]
+
+
+def _arrow_path(csv_path):
+    return Path(csv_path).with_suffix(".arrow")
+
+
+def _source_metadata(csv_path):
+    stat = os.stat(csv_path)
+    return {
+        b"arrow_version": ARROW_VERSION.encode(),
+        b"source_size": str(stat.st_size).encode(),
+        b"source_mtime_ns": str(stat.st_mtime_ns).encode(),
+    }
+
+
+def _is_stale(csv_path, arrow_path):
+    if not arrow_path.exists():
+        return True
+    with pa.memory_map(str(arrow_path), "r") as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    expected = _source_metadata(csv_path)
+    return any(metadata.get(k) != v for k, v in expected.items())
+
+
+def build_final_dataset_arrow(csv_path):
+    """
+    Convert final_dataset.csv into final_dataset.arrow (same folder) with derived columns.
+
+    Derived columns
+    ---------------
+    post            : 1 for EL observations, 0 for BL
+    log_electricity : log(1 + annual_electricity_total)
+    balanced_panel  : True for labgroups with both BL and EL observations
+    """
+    csv_path = Path(csv_path)
+    arrow_path = _arrow_path(csv_path)
+
+    df = pd.read_csv(
+        csv_path,
+        keep_default_na=False, # Keep "None" as a string, not NaN
+        na_values=[""] # Only treat empty strings as NaN
+    )
+
+    # Construct post variable
+    df["post"] = (df["survey"] == "EL").astype(int)
+
+    # Log electricity use
+    df["log_electricity"] = np.log1p(df["annual_electricity_total"])
+
+    # Labgroups that have both pre and post observations
+    labgroup_counts = df.groupby("labgroupid")["survey"].nunique()
+    df["balanced_panel"] = df["labgroupid"].isin(labgroup_counts[labgroup_counts == 2].index)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **_source_metadata(csv_path)})
+
+    # Uncompressed so that columns can be memory-mapped without copying
+    tmp_path = arrow_path.with_suffix(".arrow.tmp")
+    with pa.OSFile(str(tmp_path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    tmp_path.replace(arrow_path)
+
+    return arrow_path
+
+
+def dataset_columns(csv_path):
+    """Return all column names of the final dataset (including derived columns)."""
+    csv_path = Path(csv_path)
+    arrow_path = _arrow_path(csv_path)
+    if _is_stale(csv_path, arrow_path):
+        build_final_dataset_arrow(csv_path)
+
+    with pa.memory_map(str(arrow_path), "r") as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def load_final_dataset(csv_path, columns=None, balanced=True):
+    """
+    Load the final dataset from its memory-mapped Arrow copy.
+
+    Parameters
+    ----------
+    csv_path : path-like
+        final_dataset.csv (the Arrow file is rebuilt from it if missing or outdated).
+    columns : list[str], optional
+        Columns to load (labgroupid and survey are always included). All
+        columns if None.
+    balanced : bool, default True
+        Keep only labgroups that have both BL and EL observations.
+
+    Returns
+    -------
+    pd.DataFrame
+        Same values and dtypes as reading the CSV with keep_default_na=False,
+        na_values=[""] (missing values in string columns as NaN).
+    """
+    csv_path = Path(csv_path)
+    arrow_path = _arrow_path(csv_path)
+    if _is_stale(csv_path, arrow_path):
+        build_final_dataset_arrow(csv_path)
+
+    with pa.memory_map(str(arrow_path), "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+
+        if columns is not None:
+            columns = [c for c in KEY_COLUMNS if c not in columns] + list(columns)
+            missing = [c for c in columns if c not in table.schema.names]
+            if missing:
+                raise KeyError(f"Columns not in final dataset: {missing}")
+
+        # Project before filtering, so that only the selected columns are copied by the filter
+        if columns is not None:
+            table = table.select(columns + (["balanced_panel"] if balanced and "balanced_panel" not in columns else []))
+
+        if balanced:
+            table = table.filter(table["balanced_panel"])
+            if columns is not None and "balanced_panel" not in columns:
+                table = table.drop_columns(["balanced_panel"])
+
+        df = table.to_pandas()
+
+    # Missing values in string columns as NaN (as read_csv)
+    obj_cols = df.columns[df.dtypes == object]
+    if len(obj_cols):
+        df[obj_cols] = df[obj_cols].where(df[obj_cols].notna(), np.nan)
+
+    return df
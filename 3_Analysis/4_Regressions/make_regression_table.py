@@ -15,6 +15,8 @@ def make_regression_table(
     col1_width="5.5cm",
     coln_width="2cm",
     col_widths=None,
+    pvalues=None,
+    conf_ints=None,
 ):
     """
     Create LaTeX tables for pyfixest and statsmodels results.
@@ -42,6 +44,11 @@ def make_regression_table(
     col1_width      : width of the first column (row labels)
     coln_width      : width of model number columns (if the same)
     col_widths      : optional list of column widths for model columns i.e. 2 onwards (overrides coln_width)
+    pvalues         : optional list, one entry per model: None (p-values of the fit) or a dict
+                      {var: p-value} used for the stars instead, e.g. wild cluster bootstrap p-values
+                      [None, {"treated:post": wcb["pvalue"]}, ...]
+    conf_ints       : optional list, one entry per model: None or a dict {var: (lower, upper)},
+                      shown in brackets below the SE, e.g. {"treated:post": wcb["conf_int"]}
     """
 
     n_models = len(fit_list)
@@ -57,6 +64,11 @@ def make_regression_table(
         elif pval < 0.10: return "*"
         else:             return ""
 
+    def format_bound(val, fmt):
+        if val == float("inf"):    return r"\infty"
+        elif val == float("-inf"): return r"-\infty"
+        else:                      return fmt.format(val)
+
     def checkmark_or_dash(val):
         return r"\checkmark" if val else r"\textemdash"
 
@@ -158,12 +170,15 @@ def make_regression_table(
         label_str = var_labels.get(var, var.replace("_", " "))
         coef_row = []
         se_row   = []
+        ci_row   = []
         for i, fit in enumerate(fit_list):
             fmt = f"{{:.{decimals_list[i]}f}}"
             try:
                 coef  = get_coef(fit, var)
                 se    = get_se(fit, var)
                 pval  = get_pval(fit, var)
+                if pvalues is not None and pvalues[i] is not None and var in pvalues[i]:
+                    pval = pvalues[i][var]
                 if se == 0 or se != se:  # se is zero or NaN — unidentified
                     coef_row.append(r"\textemdash")
                     se_row.append("")
@@ -175,8 +190,16 @@ def make_regression_table(
                 coef_row.append("")
                 se_row.append("")
 
+            if conf_ints is not None and conf_ints[i] is not None and var in conf_ints[i]:
+                lower, upper = conf_ints[i][var]
+                ci_row.append(f"$[{format_bound(lower, fmt)}, {format_bound(upper, fmt)}]$")
+            else:
+                ci_row.append("")
+
         lines.append(f"{label_str} & " + " & ".join(coef_row) + r" \\")
         lines.append(r" & " + " & ".join(se_row) + r" \\")
+        if conf_ints is not None:
+            lines.append(r" & " + " & ".join(ci_row) + r" \\")
         lines.append(r"\addlinespace[0.2cm]")
 
     lines.append(r"\hline")
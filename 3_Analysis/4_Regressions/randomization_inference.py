@@ -0,0 +1,147 @@
+# Randomization inference for the diff-in-diff estimates (coefficient on treated:post):
+#   (1) Re-draw the lab-level treatment many times with the randomization design (stratified_randomize:
+#       50/50 within each stratum, the extra lab of an odd stratum to treatment or control at random),
+#       with rerandomization.draw_assignments
+#   (2) Demean once: for any assignment t (one 0/1 per lab), the demeaned treated:post regressor is A t,
+#       with A the demeaned lab × post indicators (observations × labs). Each draw's estimate is then
+#       (t'A'y) / (t'A'A t), i.e. matrix-vector products instead of a pf.feols call per draw
+#   (3) Draws are evaluated in chunks in parallel threads (numpy releases the GIL). Each chunk has its own
+#       seed spawned from np.random.SeedSequence(seed), so the draws do not depend on the number of threads
+
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from fe_demean import demean, fixed_effect_codes
+
+# Assignments are drawn as in the re-randomization (2_Preparation/1_Randomization_Assignment)
+CODE_ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(CODE_ROOT / "2_Preparation" / "1_Randomization_Assignment"))
+from rerandomization import draw_assignments
+
+
+# Helper: treated:post coefficient of each assignment (rows of T), from A'y and A'A
+def _estimates(T, Ay, AA):
+    numerator = T @ Ay
+    denominator = np.einsum("pl,pl->p", T @ AA, T)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator > 0, numerator / denominator, np.nan)
+
+
+def randomization_inference(
+    df,
+    outcome,
+    seed,
+    fe="labgroupid + post",
+    controls=None,
+    treatment_col="treated",
+    post_col="post",
+    unit_col="labgroupid",
+    strata_col="faculty",
+    design="stratified",
+    n_draws=5_000,
+    n_jobs=None,
+    chunk_size=500,
+):
+    """
+    Randomization inference p-value of the treated:post coefficient.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Panel used in the regression (one row per lab and survey).
+    outcome : str
+        Outcome column, e.g. "annual_electricity_total".
+    seed : int
+        Seed of the draws, e.g. config.SEED.
+    fe : str or list
+        Fixed effects as in pf.feols, e.g. "labgroupid + post" or "labgroupid + faculty^post".
+    controls : list, optional
+        Other regressors of the model.
+    treatment_col, post_col : str
+        Lab-level treatment (0/1, constant within a lab) and post period (0/1) columns.
+    unit_col : str
+        Randomization unit (lab group).
+    strata_col : str, optional
+        Randomization strata (None: no strata).
+    design : str
+        "stratified": re-draw 50/50 within each stratum, as in the randomization (stratified_randomize);
+        "permute": permute treatment within strata, keeping the observed number of treated labs.
+    n_draws : int
+        Number of re-drawn assignments.
+    n_jobs : int, optional
+        Number of threads (default: number of cores).
+    chunk_size : int
+        Draws evaluated at once per thread.
+
+    Returns
+    -------
+    dict
+        estimate (treated:post coefficient, as pf.feols), pvalue (two-sided: share of the draws and the
+        observed assignment with an absolute estimate at least as large), n_draws and draws (the
+        estimate of every draw).
+    """
+    if design not in ["stratified", "permute"]:
+        raise ValueError(f"Unknown design '{design}', use 'stratified' or 'permute'.")
+    controls = [] if controls is None else list(controls)
+
+    # Rows used in the regression
+    fe_codes = fixed_effect_codes(df, fe)
+    keep = df[[outcome, treatment_col, post_col, unit_col] + controls].notna().all(axis=1).to_numpy(copy=True)
+    for codes in fe_codes:
+        keep &= codes >= 0
+    data = df.loc[keep]
+    fe_codes = [pd.factorize(codes[keep])[0] for codes in fe_codes]
+
+    # Lab-level treatment and strata
+    unit_codes, units = pd.factorize(data[unit_col])
+    labs = data.groupby(unit_codes)
+    if (labs[treatment_col].nunique() > 1).any():
+        raise ValueError(f"{treatment_col} is not constant within {unit_col}.")
+    t_observed = labs[treatment_col].first().to_numpy(dtype=float)
+    if strata_col is None:
+        strata_codes = np.zeros(len(units), dtype=int)
+    else:
+        strata_codes = pd.factorize(labs[strata_col].first(), use_na_sentinel=False)[0]
+    n_treated_observed = np.bincount(strata_codes, weights=t_observed).astype(int)
+
+    # Demeaned outcome and lab × post indicators (A), with the controls partialled out
+    post = data[post_col].to_numpy(dtype=float)
+    indicators = np.zeros((len(data), len(units)))
+    indicators[np.arange(len(data)), unit_codes] = post
+    demeaned = demean(np.column_stack([data[outcome].to_numpy(dtype=float), indicators]), fe_codes)
+    y, A = demeaned[:, 0], demeaned[:, 1:]
+    if controls:
+        C = demean(data[controls].to_numpy(dtype=float), fe_codes)
+        y = y - C @ np.linalg.lstsq(C, y, rcond=None)[0]
+        A = A - C @ np.linalg.lstsq(C, A, rcond=None)[0]
+    Ay, AA = A.T @ y, A.T @ A
+
+    estimate = _estimates(t_observed[None, :], Ay, AA)[0]
+
+    # Re-drawn assignments, in chunks with their own seeds
+    chunks = [min(chunk_size, n_draws - start) for start in range(0, n_draws, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+
+    def run_chunk(i):
+        n_treated = n_treated_observed if design == "permute" else None
+        T = draw_assignments(strata_codes, chunks[i], np.random.default_rng(seeds[i]), n_treated=n_treated)
+        return _estimates(T, Ay, AA)
+
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        draws = np.concatenate(list(pool.map(run_chunk, range(len(chunks))))) if chunks else np.empty(0)
+
+    valid = draws[~np.isnan(draws)]
+    # The observed assignment counts as one of the draws, so that the p-value is never 0
+    n_extreme = np.sum(np.abs(valid) >= np.abs(estimate) * (1 - 1e-12))
+    pvalue = (1 + n_extreme) / (1 + len(valid)) if len(valid) else np.nan
+    return {
+        "estimate": float(estimate),
+        "pvalue": float(pvalue),
+        "n_draws": int(len(valid)),
+        "draws": draws,
+    }
@@ -0,0 +1,177 @@
+# Wild cluster restricted (WCR) bootstrap for specifications with few clusters (e.g. clustered by institute or enumerator):
+#   (1) Absorb the fixed effects once (fe_demean.demean) and fit the model on the demeaned data
+#   (2) Impose the null on the coefficient, then draw bootstrap outcomes y* = restricted fit + v_g × restricted residual,
+#       one Rademacher or Webb weight v_g per cluster and draw
+#   (3) The bootstrap estimates and cluster-robust t statistics of all draws are linear in the weights, so they are
+#       computed for all draws at once from per-cluster sums (draws × clusters matrices), without refitting
+#   (4) p-value of the null coefficient = 0, and a confidence interval by inverting the test (bisection on the null,
+#       with the same weights)
+# Rademacher weights are enumerated (all 2^G sign patterns) when there are at most B of them.
+
+import numpy as np
+import pandas as pd
+
+from batch_estimation import _drop_singletons, _fixef_dof, _independent_columns, _regressors
+from fe_demean import demean, fixed_effect_codes
+
+WEBB_WEIGHTS = np.array([-np.sqrt(1.5), -1, -np.sqrt(0.5), np.sqrt(0.5), 1, np.sqrt(1.5)])
+
+
+# Helper: draws × clusters bootstrap weights
+def _bootstrap_weights(weights, n_clusters, B, rng):
+    if weights == "rademacher":
+        if 2 ** n_clusters <= B:
+            patterns = np.arange(2 ** n_clusters)[:, None] >> np.arange(n_clusters)[None, :] & 1
+            return 2.0 * patterns - 1
+        return rng.choice([-1.0, 1.0], size=(B, n_clusters))
+    return rng.choice(WEBB_WEIGHTS, size=(B, n_clusters))
+
+
+# Helper: sums of the rows of values (observations × columns) per cluster
+def _cluster_sums(values, cluster_codes, n_clusters):
+    sums = np.zeros((n_clusters, values.shape[1]))
+    np.add.at(sums, cluster_codes, values)
+    return sums
+
+
+def wild_cluster_bootstrap(
+    df,
+    outcome,
+    cluster,
+    seed,
+    regressors="treated:post",
+    param="treated:post",
+    fe="labgroupid + post",
+    B=9_999,
+    weights="rademacher",
+    alpha=0.05,
+    conf_int=True,
+):
+    """
+    Wild cluster restricted bootstrap p-value and confidence interval of one coefficient.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Regression data.
+    outcome : str
+        Outcome column.
+    cluster : str
+        Cluster column, e.g. "institute_id" or "enum_id".
+    seed : int
+        Seed of the bootstrap weights, e.g. config.SEED.
+    regressors : str or list
+        Right-hand side as in pf.feols, e.g. "treated:post".
+    param : str
+        Coefficient to test (one of the regressors).
+    fe : str or list
+        Fixed effects as in pf.feols, e.g. "labgroupid + institute_id^post".
+    B : int
+        Number of bootstrap draws.
+    weights : str
+        "rademacher" or "webb" (better with very few clusters).
+    alpha : float
+        1 - confidence level of the interval.
+    conf_int : bool
+        Compute the confidence interval (test inversion).
+
+    Returns
+    -------
+    dict
+        estimate and se (CRV1 at the cluster level, as pf.feols), t_stat, pvalue (symmetric, H0: coefficient = 0),
+        conf_int ((lower, upper) or None), n_clusters and B (number of draws).
+    """
+    if weights not in ["rademacher", "webb"]:
+        raise ValueError(f"Unknown weights '{weights}', use 'rademacher' or 'webb'.")
+
+    # Estimation sample, as pf.feols (complete rows, no singletons) and demeaned design
+    fe_codes = fixed_effect_codes(df, fe)
+    coefnames, X_raw = _regressors(df, regressors)
+    y_raw = df[outcome].to_numpy(dtype=float, na_value=np.nan)
+    complete = ~np.isnan(X_raw).any(axis=1) & ~np.isnan(y_raw) & df[cluster].notna().to_numpy()
+    for codes in fe_codes:
+        complete &= codes >= 0
+    rows = _drop_singletons(np.flatnonzero(complete), fe_codes)
+    sub_codes = [pd.factorize(codes[rows])[0] for codes in fe_codes]
+    demeaned = demean(np.column_stack([y_raw[rows], X_raw[rows]]), sub_codes)
+    keep = _independent_columns(demeaned[:, 1:], X_raw[rows])
+    coefnames = [coefnames[c] for c in keep]
+    if param not in coefnames:
+        raise KeyError(f"{param} is not a regressor of the model (or is collinear with the fixed effects).")
+    y, X = demeaned[:, 0], demeaned[:, 1:][:, keep]
+    j = coefnames.index(param)
+
+    N, k = X.shape
+    cluster_codes, cluster_ids = pd.factorize(df[cluster].to_numpy()[rows])
+    G = len(cluster_ids)
+    ssc = (N - 1) / (N - k - _fixef_dof(sub_codes, cluster_codes)) * G / (G - 1)
+
+    # Observed estimate and CRV1 standard error; w' X_g'u_g is cluster g's contribution to the score of param
+    bread = np.linalg.pinv(X.T @ X)
+    w = bread[:, j]
+    beta = bread @ (X.T @ y)
+    Xw = X @ w
+    estimate = beta[j]
+    se = np.sqrt(ssc * np.sum(_cluster_sums((Xw * (y - X @ beta))[:, None], cluster_codes, G) ** 2))
+
+    # Per-cluster sums that do not depend on the null: X_g'X_g w
+    HW = _cluster_sums(X * Xw[:, None], cluster_codes, G)
+
+    rng = np.random.default_rng(seed)
+    V = _bootstrap_weights(weights, G, B, rng)
+
+    # Restricted model under the null coefficient = beta0: regress y - beta0 x_param on the other regressors
+    controls = np.delete(X, j, axis=1)
+
+    def pvalue(beta0):
+        y0 = y - beta0 * X[:, j]
+        fitted = beta0 * X[:, j]
+        if controls.shape[1]:
+            fitted = fitted + controls @ np.linalg.lstsq(controls, y0, rcond=None)[0]
+        resid = y - fitted
+
+        # X'y* = sum_g X_g'fitted_g + v_g X_g'resid_g for all draws at once
+        a = _cluster_sums(X * fitted[:, None], cluster_codes, G)
+        S = _cluster_sums(X * resid[:, None], cluster_codes, G)
+        beta_star = (a.sum(axis=0) + V @ S) @ bread
+        scores = (a @ w)[None, :] + V * (S @ w)[None, :] - beta_star @ HW.T
+        se_star = np.sqrt(ssc * np.sum(scores ** 2, axis=1))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_star = (beta_star[:, j] - beta0) / se_star
+        return np.mean(np.abs(t_star) >= np.abs(estimate - beta0) / se * (1 - 1e-12))
+
+    # Confidence interval: the nulls not rejected at alpha, bounds found by bisection
+    bounds = None
+    if conf_int:
+        bounds = []
+        for direction in [-1, 1]:
+            # Step out (doubling the step) until the null is rejected, an infinite bound if it never is
+            inside, step = estimate, 2 * se
+            for _ in range(60):
+                outside = inside + direction * step
+                if pvalue(outside) <= alpha:
+                    break
+                inside, step = outside, 2 * step
+            else:
+                bounds.append(direction * np.inf)
+                continue
+            for _ in range(60):
+                middle = (inside + outside) / 2
+                if pvalue(middle) > alpha:
+                    inside = middle
+                else:
+                    outside = middle
+                if abs(outside - inside) <= 1e-6 * se:
+                    break
+            bounds.append((inside + outside) / 2)
+        bounds = tuple(bounds)
+
+    return {
+        "estimate": float(estimate),
+        "se": float(se),
+        "t_stat": float(estimate / se),
+        "pvalue": float(pvalue(0.0)),
+        "conf_int": bounds,
+        "n_clusters": G,
+        "B": len(V),
+    }
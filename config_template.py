@@ -70,6 +70,9 @@ EL_RAW_SURVEY_BACKUP = EL_DATA_BACKUP / "2_Raw_Survey"
 # Processed data folder
 PROCESSED_DATA = DATA_ROOT / "16_Processed_Data"
 
+# Extraction cache folder (records extracted from lab workbooks, re-read only when files change)
+EXTRACTION_CACHE = PROCESSED_DATA / "extraction_cache"
+
 # Clean data folder
 CLEAN_DATA = DATA_ROOT / "17_Clean_Data"
 